@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# Benchmark of ChargeAnalytical on ToyMC clusters: FillEstimate time per thread count,
+# FillEstimateBatch against one FillEstimate per x-offset, and the largest relative
+# difference w.r.t. the original per-point formula (evaluated here with numpy).
+#
+# Usage: benchmark_charge_analytical.py [cfg=FILE] [num_tracks=N] [repeat=N] [threads=1,2,4] [offsets=N]
+#
+import os
+import re
+import sys
+import time
+import tempfile
+import numpy as np
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+current_directory = os.path.dirname(current_directory)
+sys.path.insert(0, current_directory)
+from flashmatch import flashmatch, toymc
+from ROOT import std
+
+cfg_file = os.path.join(os.environ['FMATCH_BASEDIR'],
+                        'dat', 'flashmatch.cfg')
+num_tracks = 100
+repeat = 10
+threads = [1, 2, 4]
+num_offsets = 32
+if len(sys.argv) > 1:
+    for argv in sys.argv[1:]:
+        if argv.startswith('cfg='):
+            cfg_file = argv.replace('cfg=','')
+        elif argv.startswith('num_tracks='):
+            num_tracks = int(argv.replace('num_tracks=',''))
+        elif argv.startswith('repeat='):
+            repeat = int(argv.replace('repeat=',''))
+        elif argv.startswith('threads='):
+            threads = [int(n) for n in argv.replace('threads=','').split(',')]
+        elif argv.startswith('offsets='):
+            num_offsets = int(argv.replace('offsets=',''))
+
+det = flashmatch.DetectorSpecs.GetME()
+n_pmt = det.NOpDets()
+global_qe = 0.07
+cfg_text = open(cfg_file).read()
+
+def make_toymc(num_threads):
+    # same configuration with ChargeAnalytical as the hypothesis algorithm
+    text = re.sub(r'(?m)^(\s*)HypothesisAlgo:.*$', r'\g<1>HypothesisAlgo: "ChargeAnalytical"', cfg_text)
+    text += '\nChargeAnalytical: {\n  GlobalQE: %g\n  CCVCorrection: [%s]\n  NumThreads: %d\n  MinParallelPoints: 0\n}\n' \
+            % (global_qe, ','.join(['1.'] * n_pmt), num_threads)
+    fd, name = tempfile.mkstemp(suffix='.cfg')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    mc = toymc.ToyMC(name)
+    os.remove(name)
+    return mc
+
+pmt_v = np.array([[det.PMTPosition(ch)[i] for i in range(3)] for ch in range(n_pmt)])
+
+def reference(qcluster):
+    # original formula: sum over points of q |dx| / sqrt(r2) / r2, times global QE
+    pts = np.array([[qcluster[i].x, qcluster[i].y, qcluster[i].z, qcluster[i].q] for i in range(qcluster.size())])
+    if not len(pts):
+        return np.zeros(n_pmt)
+    d = pmt_v[:, None, :] - pts[None, :, :3]
+    r2 = (d ** 2).sum(axis=2)
+    return (pts[None, :, 3] * np.abs(d[:, :, 0]) / np.sqrt(r2) / r2).sum(axis=1) * global_qe
+
+mc = None
+qcluster_v = None
+flash = flashmatch.Flash_t()
+print('%-10s %14s %8s' % ('threads', 'ms/cluster', 'speedup'))
+base_time = None
+for num_threads in threads:
+    mc = make_toymc(num_threads)
+    if qcluster_v is None:
+        qcluster_v = [mc.make_qcluster(track) for track in mc.gen_trajectories(num_tracks)]
+    hypothesis = mc._flash_algo
+    flash.pe_v.resize(n_pmt)
+    start = time.time()
+    for _ in range(repeat):
+        for qcluster in qcluster_v:
+            hypothesis.FillEstimate(qcluster, flash)
+    elapsed = (time.time() - start) / max(1, repeat * len(qcluster_v))
+    if base_time is None:
+        base_time = elapsed
+    print('%-10d %14.4f %8.2f' % (num_threads, elapsed * 1.e3, base_time / max(elapsed, 1.e-12)))
+
+# Equivalence with the original formula
+max_diff = 0.
+for qcluster in qcluster_v:
+    hypothesis.FillEstimate(qcluster, flash)
+    ref = reference(qcluster)
+    pe = np.array([flash.pe_v[i] for i in range(n_pmt)])
+    scale = np.maximum(np.abs(ref), 1.e-300)
+    max_diff = max(max_diff, float(np.max(np.abs(pe - ref) / scale)))
+print('Max. relative difference w.r.t. the original formula: %g' % max_diff)
+
+# Batched offsets against one call per offset
+xoffset_v = std.vector('double')()
+for x in np.linspace(0., 300., num_offsets):
+    xoffset_v.push_back(float(x))
+flash_v = std.vector(flashmatch.Flash_t)()
+start = time.time()
+for qcluster in qcluster_v:
+    hypothesis.FillEstimateBatch(qcluster, xoffset_v, flash_v)
+batch_time = time.time() - start
+start = time.time()
+for qcluster in qcluster_v:
+    for x in xoffset_v:
+        hypothesis.FillEstimate(qcluster + x, flash)
+single_time = time.time() - start
+print('%d offsets: batch %.3f ms/cluster, one call per offset %.3f ms/cluster (%.2fx)'
+      % (num_offsets, batch_time / max(1, len(qcluster_v)) * 1.e3,
+         single_time / max(1, len(qcluster_v)) * 1.e3, single_time / max(batch_time, 1.e-12)))
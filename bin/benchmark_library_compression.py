@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Compare the compressed-tile photon library (PhotonLibraryTileSize) with the flat float
+# library on a ToyMC sample: library memory, cache hit rate, FillEstimate time, and a check
+# that the hypotheses are identical.
+#
+# Usage: benchmark_library_compression.py [cfg=FILE] [num_tracks=N] [tile=8,8,8]
+#                                         [compression=101] [cache_mb=64]
+#
+import os
+import sys
+import time
+import numpy as np
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+current_directory = os.path.dirname(current_directory)
+sys.path.insert(0, current_directory)
+from flashmatch import flashmatch, phot, toymc
+from ROOT import std
+
+cfg_file = os.path.join(os.environ['FMATCH_BASEDIR'],
+                        'dat', 'flashmatch.cfg')
+num_tracks = 100
+tile = [8, 8, 8]
+compression = 101
+cache_mb = 64
+if len(sys.argv) > 1:
+    for argv in sys.argv[1:]:
+        if argv.startswith('cfg='):
+            cfg_file = argv.replace('cfg=','')
+        elif argv.startswith('num_tracks='):
+            num_tracks = int(argv.replace('num_tracks=',''))
+        elif argv.startswith('tile='):
+            tile = [int(v) for v in argv.replace('tile=','').split(',')]
+        elif argv.startswith('compression='):
+            compression = int(argv.replace('compression=',''))
+        elif argv.startswith('cache_mb='):
+            cache_mb = int(argv.replace('cache_mb=',''))
+
+mc = toymc.ToyMC(cfg_file)
+service = phot.PhotonVisibilityService.GetME()
+hypothesis = mc._flash_algo
+
+def use_tiles(tile_size):
+    # the storage mode is applied when the library is loaded again
+    service.UnloadLibrary()
+    tile_v = std.vector('int')()
+    for v in tile_size:
+        tile_v.push_back(v)
+    service.SetLibraryCompression(tile_v, compression, cache_mb)
+    service.GetLibraryData()
+
+def run(qcluster_v):
+    flash = flashmatch.Flash_t()
+    hypothesis_v = []
+    start = time.time()
+    for qcluster in qcluster_v:
+        hypothesis.FillEstimate(qcluster, flash)
+        hypothesis_v.append(np.array(flash.pe_v))
+    elapsed = (time.time() - start) / max(1, len(qcluster_v))
+    return np.array(hypothesis_v), elapsed
+
+qcluster_v = [mc.make_qcluster(track) for track in mc.gen_trajectories(num_tracks)]
+
+use_tiles([])
+data = service.GetLibraryData()
+flat_mb = data.size() * data.Stride() * 4 / 1048576.
+ref_hypothesis, ref_time = run(qcluster_v)
+
+use_tiles(tile)
+tiles = service.GetLibraryTiles()
+hypothesis_v, elapsed = run(qcluster_v)
+# second pass: tiles touched by the sample are cached
+tiles.ResetStats()
+_, warm = run(qcluster_v)
+
+compressed_mb = tiles.CompressedBytes() / 1048576.
+cached_mb = tiles.NumCachedTiles() * tiles.TileBytes() / 1048576.
+lookups = max(1, tiles.NumHits() + tiles.NumMisses())
+print('Tiles               : %d of %s voxels (codec %d)' % (tiles.NumTiles(), 'x'.join([str(v) for v in tile]), compression))
+print('Flat library        : %.1f MB' % flat_mb)
+print('Compressed tiles    : %.1f MB (%.2fx)' % (compressed_mb, flat_mb / max(compressed_mb, 1.e-9)))
+print('Cached tiles        : %d / %d (%.1f MB)' % (tiles.NumCachedTiles(), tiles.CacheCapacity(), cached_mb))
+print('Resident library    : %.1f MB (%.2fx less)' % (compressed_mb + cached_mb,
+                                                      flat_mb / max(compressed_mb + cached_mb, 1.e-9)))
+print('Cache hit rate      : %.4f (warm, %d evictions)' % (tiles.NumHits() / float(lookups), tiles.NumEvictions()))
+print('FillEstimate flat   : %.3f ms/cluster' % (ref_time * 1.e3))
+print('FillEstimate tiles  : %.3f ms/cluster cold, %.3f ms/cluster warm' % (elapsed * 1.e3, warm * 1.e3))
+print('Identical hypotheses: %s' % bool((hypothesis_v == ref_hypothesis).all()))
+use_tiles([])
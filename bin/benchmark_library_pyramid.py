@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Compare QLLMatch coarse-to-fine MIGRAD schedules on a ToyMC sample: matching time,
+# number of hypothesis evaluations and change of the match results w.r.t. the
+# full-resolution schedule [0]. The coarse levels are those of PhotonLibraryLevels
+# in detector_specs.cfg (e.g. [2, 4] gives levels 1 and 2).
+#
+# Usage: benchmark_library_pyramid.py [cfg=FILE] [num_tracks=N] [repeat=N] [schedules=1,0:2,1,0]
+#
+import os
+import re
+import sys
+import time
+import tempfile
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+current_directory = os.path.dirname(current_directory)
+sys.path.insert(0, current_directory)
+from flashmatch import flashmatch, toymc
+
+cfg_file = os.path.join(os.environ['FMATCH_BASEDIR'],
+                        'dat', 'flashmatch.cfg')
+num_tracks = 10
+repeat = 5
+schedules = None
+if len(sys.argv) > 1:
+    for argv in sys.argv[1:]:
+        if argv.startswith('cfg='):
+            cfg_file = argv.replace('cfg=','')
+        elif argv.startswith('num_tracks='):
+            num_tracks = int(argv.replace('num_tracks=',''))
+        elif argv.startswith('repeat='):
+            repeat = int(argv.replace('repeat=',''))
+        elif argv.startswith('schedules='):
+            schedules = [[int(level) for level in s.split(',')]
+                         for s in argv.replace('schedules=','').split(':')]
+
+num_levels = flashmatch.DetectorSpecs.GetME().NumLibraryLevels()
+if num_levels < 2:
+    sys.stderr.write('No coarse library level: set PhotonLibraryLevels in detector_specs.cfg\n')
+    sys.exit(1)
+if schedules is None:
+    schedules = [list(range(level, -1, -1)) for level in range(1, num_levels)]
+    schedules += [[level, 0] for level in range(2, num_levels)]
+
+cfg_text = open(cfg_file).read()
+
+def make_toymc(schedule):
+    # same configuration with the QLLMatch LevelSchedule replaced
+    line = 'LevelSchedule: [%s]' % ', '.join([str(level) for level in schedule])
+    text, count = re.subn(r'(?m)^(\s*)LevelSchedule:.*$', r'\g<1>' + line, cfg_text)
+    if not count:
+        text = re.sub(r'(?m)^(QLLMatch\s*:\s*\{)', r'\1\n  ' + line, cfg_text)
+    fd, name = tempfile.mkstemp(suffix='.cfg')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    mc = toymc.ToyMC(name)
+    os.remove(name)
+    return mc
+
+def run(mc, event_v):
+    match_m = {}
+    num_steps = 0
+    start = time.time()
+    for ievent, (tpc_v, pmt_v) in enumerate(event_v):
+        for match in mc.match(tpc_v, pmt_v):
+            match_m[(ievent, match.tpc_id, match.flash_id)] = (match.tpc_point.x, match.score)
+            num_steps += match.num_steps
+    elapsed = (time.time() - start) / max(1, len(event_v))
+    return match_m, elapsed, num_steps
+
+ref_mc = make_toymc([0])
+event_v = []
+for _ in range(repeat):
+    _, pmt_v, tpc_v, _ = ref_mc.gen_input(num_tracks)
+    event_v.append((tpc_v, pmt_v))
+ref_match, ref_time, ref_steps = run(ref_mc, event_v)
+
+print('%-12s %10s %8s %10s %8s %10s %12s' % ('schedule', 'ms/event', 'speedup', 'evaluations',
+                                          'changed', 'max|dx|', 'max dscore/s'))
+print('%-12s %10.2f %8.2f %10d' % ('0', ref_time * 1.e3, 1., ref_steps))
+for schedule in schedules:
+    mc = make_toymc(schedule)
+    match_m, elapsed, num_steps = run(mc, event_v)
+    changed = len(set(match_m.keys()) ^ set(ref_match.keys()))
+    common = set(match_m.keys()) & set(ref_match.keys())
+    dx = max([abs(match_m[k][0] - ref_match[k][0]) for k in common] + [0.])
+    dscore = max([abs(match_m[k][1] - ref_match[k][1]) / max(abs(ref_match[k][1]), 1.e-12)
+                  for k in common] + [0.])
+    print('%-12s %10.2f %8.2f %10d %8d %10.4g %12.4g' % (','.join([str(l) for l in schedule]),
+                                                     elapsed * 1.e3, ref_time / max(elapsed, 1.e-12),
+                                                     num_steps, changed, dx, dscore))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Benchmark of the per-voxel charge binning in PhotonLibHypothesis::FillEstimate.
+# Generates ToyMC tracks, then reports the number of photon library multiply-adds
+# with one row per point (before) and one row per binned voxel (after), and the
+# average FillEstimate time.
+#
+# Usage: benchmark_voxel_aggregation.py [cfg=FILE] [num_tracks=N] [repeat=N]
+#
+import os
+import sys
+import time
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+current_directory = os.path.dirname(current_directory)
+sys.path.insert(0, current_directory)
+from flashmatch import flashmatch, toymc
+from ROOT import std
+
+cfg_file = os.path.join(os.environ['FMATCH_BASEDIR'],
+                        'dat', 'flashmatch.cfg')
+num_tracks = 100
+repeat = 10
+if len(sys.argv) > 1:
+    for argv in sys.argv[1:]:
+        if argv.startswith('cfg='):
+            cfg_file = argv.replace('cfg=','')
+        elif argv.startswith('num_tracks='):
+            num_tracks = int(argv.replace('num_tracks=',''))
+        elif argv.startswith('repeat='):
+            repeat = int(argv.replace('repeat=',''))
+
+mc = toymc.ToyMC(cfg_file)
+hypothesis = mc._flash_algo
+n_pmt = mc.det.NOpDets()
+
+qcluster_v = [mc.make_qcluster(track) for track in mc.gen_trajectories(num_tracks)]
+
+vox_def = mc.det.GetVoxelDef()
+vox_q_v = std.vector('std::pair<int,double>')()
+num_points, num_voxels = 0, 0
+for qcluster in qcluster_v:
+    for idx in range(qcluster.size()):
+        pt = qcluster[idx]
+        if vox_def.GetVoxelID(pt.x, pt.y, pt.z) >= 0:
+            num_points += 1
+    hypothesis.BinCharge(qcluster, vox_q_v)
+    num_voxels += vox_q_v.size()
+
+flash = flashmatch.Flash_t()
+start = time.time()
+for _ in range(repeat):
+    for qcluster in qcluster_v:
+        hypothesis.FillEstimate(qcluster, flash)
+elapsed = time.time() - start
+
+print('Tracks              : %d' % len(qcluster_v))
+print('Points in library   : %d' % num_points)
+print('Binned voxels       : %d' % num_voxels)
+print('Multiply-adds before: %d' % (num_points * n_pmt))
+print('Multiply-adds after : %d' % (num_voxels * n_pmt))
+if num_voxels:
+    print('Reduction           : %.2fx' % (float(num_points) / num_voxels))
+print('FillEstimate        : %.3f ms/cluster' % (elapsed / max(1, repeat * len(qcluster_v)) * 1.e3))
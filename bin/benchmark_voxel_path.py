@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# Comparison of the LightPath (point every SegmentSize) and VoxelPath (point per crossed
+# voxel) charge clusters on ToyMC tracks: number of points, total charge, FillEstimate time
+# and the largest relative difference of the hypotheses.
+#
+# Usage: benchmark_voxel_path.py [cfg=FILE] [num_tracks=N] [repeat=N]
+#
+import os
+import sys
+import time
+import numpy as np
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+current_directory = os.path.dirname(current_directory)
+sys.path.insert(0, current_directory)
+from flashmatch import flashmatch, toymc
+
+cfg_file = os.path.join(os.environ['FMATCH_BASEDIR'],
+                        'dat', 'flashmatch.cfg')
+num_tracks = 100
+repeat = 10
+if len(sys.argv) > 1:
+    for argv in sys.argv[1:]:
+        if argv.startswith('cfg='):
+            cfg_file = argv.replace('cfg=','')
+        elif argv.startswith('num_tracks='):
+            num_tracks = int(argv.replace('num_tracks=',''))
+        elif argv.startswith('repeat='):
+            repeat = int(argv.replace('repeat=',''))
+
+mc = toymc.ToyMC(cfg_file)
+hypothesis = mc._flash_algo
+n_pmt = mc.det.NOpDets()
+algo_v = [(name, mc.mgr.GetCustomAlgo(name)) for name in ('LightPath', 'VoxelPath')]
+for name, algo in algo_v:
+    if not algo:
+        sys.stderr.write('%s is not in the CustomAlgo list of %s\n' % (name, cfg_file))
+        sys.exit(1)
+
+track_v = mc.gen_trajectories(num_tracks)
+flash = flashmatch.Flash_t()
+pe_m = {}
+print('%-10s %10s %14s %14s' % ('algo', 'points', 'total q', 'ms/cluster'))
+for name, algo in algo_v:
+    start = time.time()
+    qcluster_v = [algo.MakeQCluster(track) for track in track_v]
+    make_time = time.time() - start
+    start = time.time()
+    for _ in range(repeat):
+        for qcluster in qcluster_v:
+            hypothesis.FillEstimate(qcluster, flash)
+    elapsed = (time.time() - start) / max(1, repeat * len(qcluster_v))
+    pe_v = []
+    for qcluster in qcluster_v:
+        hypothesis.FillEstimate(qcluster, flash)
+        pe_v.append(np.array([flash.pe_v[i] for i in range(n_pmt)]))
+    pe_m[name] = pe_v
+    num_points = sum([qcluster.size() for qcluster in qcluster_v])
+    total_q = sum([qcluster.sum() for qcluster in qcluster_v])
+    print('%-10s %10d %14.6g %14.4f   (MakeQCluster %.3f ms/track)'
+          % (name, num_points, total_q, elapsed * 1.e3, make_time / max(1, len(track_v)) * 1.e3))
+
+max_diff = 0.
+for ref, pe in zip(pe_m['LightPath'], pe_m['VoxelPath']):
+    if ref.sum() <= 0.:
+        continue
+    max_diff = max(max_diff, float(np.abs(pe - ref).sum() / ref.sum()))
+print('Max. relative hypothesis difference (sum |dPE| / sum PE): %g' % max_diff)
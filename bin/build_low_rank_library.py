@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Build a rank-k factorization V ~ U.W of the photon library (voxel x PMT visibility
+# matrix) for LowRankHypothesis, and report the reconstruction error per rank.
+# The input is a binary photon library (.plib, see bin/convert_photon_library.py).
+# W holds the leading eigenvectors of V^T.V (= right singular vectors of V), U = V.W^T.
+#
+# Usage: build_low_rank_library.py INPUT.plib [out=OUTPUT.lowrank] [rank=32]
+#                                  [ranks=1,2,4,8,16,32,64] [samples=20000]
+#
+import os
+import sys
+import struct
+import numpy as np
+
+PLIB_HEADER = '<8sIIQQQQ3d3d3ii'
+LOWRANK_HEADER = '<8sIIQQQ3d3d3ii'
+
+if len(sys.argv) < 2:
+    print('Usage: %s INPUT.plib [out=OUTPUT.lowrank] [rank=32] [ranks=...] [samples=N]' % sys.argv[0])
+    sys.exit(1)
+
+in_file = sys.argv[1]
+out_file = os.path.splitext(in_file)[0] + '.lowrank'
+rank = 32
+ranks = [1, 2, 4, 8, 16, 32, 64]
+num_samples = 20000
+chunk = 65536
+for argv in sys.argv[2:]:
+    if argv.startswith('out='):
+        out_file = argv.replace('out=','')
+    elif argv.startswith('rank='):
+        rank = int(argv.replace('rank=',''))
+    elif argv.startswith('ranks='):
+        ranks = [int(r) for r in argv.replace('ranks=','').split(',')]
+    elif argv.startswith('samples='):
+        num_samples = int(argv.replace('samples=',''))
+
+with open(in_file, 'rb') as f:
+    header = struct.unpack(PLIB_HEADER, f.read(struct.calcsize(PLIB_HEADER)))
+magic, version, header_size, nvoxels, nchannels, stride, data_offset = header[:7]
+lower, upper, steps = header[7:10], header[10:13], header[13:16]
+if magic != b'FMPHLIB1' or version != 1:
+    print('Not a binary photon library: %s' % in_file)
+    sys.exit(1)
+rank = min(rank, nchannels)
+ranks = sorted(set([r for r in ranks if r <= nchannels] + [rank]))
+
+data = np.memmap(in_file, dtype=np.float32, mode='r', offset=data_offset, shape=(nvoxels, stride))
+print('%s: %d voxels, %d channels' % (in_file, nvoxels, nchannels))
+
+# Gram matrix V^T.V (double precision, one chunk of voxels at a time)
+gram = np.zeros((nchannels, nchannels), dtype=np.float64)
+for start in range(0, nvoxels, chunk):
+    v = data[start:start+chunk, :nchannels].astype(np.float64)
+    gram += v.T.dot(v)
+eigval, eigvec = np.linalg.eigh(gram)
+order = np.argsort(eigval)[::-1]
+eigval = np.maximum(eigval[order], 0.)
+eigvec = eigvec[:, order]
+total = eigval.sum()
+
+# Reconstruction error per rank: Frobenius from the discarded eigenvalues, max error on a sample
+sample = np.sort(np.random.choice(nvoxels, min(num_samples, nvoxels), replace=False))
+v = data[sample, :nchannels].astype(np.float64)
+row_max = np.maximum(v.max(axis=1), 1.e-30)
+print('%6s %14s %14s %14s %10s' % ('rank', 'rel. Frobenius', 'max |dV|', 'max |dV|/Vmax', 'size'))
+for r in ranks:
+    w = eigvec[:, :r]
+    diff = np.abs(v - v.dot(w).dot(w.T))
+    frob = np.sqrt(eigval[r:].sum() / total) if total > 0 else 0.
+    print('%6d %14.4g %14.4g %14.4g %9.1f%%' % (r, frob, diff.max(), (diff.max(axis=1) / row_max).max(),
+                                                 100. * r / nchannels))
+
+# Write U (voxel-major) and W for the requested rank
+w = eigvec[:, :rank].T.astype(np.float64)
+with open(out_file, 'wb') as f:
+    f.write(struct.pack(LOWRANK_HEADER, b'FMLRANK1', 1, struct.calcsize(LOWRANK_HEADER),
+                        nvoxels, nchannels, rank, *(tuple(lower) + tuple(upper) + tuple(steps) + (0,))))
+    for start in range(0, nvoxels, chunk):
+        v = data[start:start+chunk, :nchannels].astype(np.float64)
+        f.write(v.dot(w.T).astype(np.float32).tobytes())
+    f.write(w.astype(np.float32).tobytes())
+print('Wrote rank %d factorization to %s' % (rank, out_file))
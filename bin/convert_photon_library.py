@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#
+# One-time conversion of a ROOT photon library (PhotonLibraryData TTree) into the
+# native binary format (.plib) that PhotonVisibilityService maps read-only.
+# The voxel definition written in the header is the one of PhotonVisibilityService.
+#
+# Usage: convert_photon_library.py INPUT.root [OUTPUT.plib]
+#
+import os
+import sys
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+current_directory = os.path.dirname(current_directory)
+sys.path.insert(0, current_directory)
+from flashmatch import flashmatch, phot
+
+if len(sys.argv) < 2:
+    print('Usage: %s INPUT.root [OUTPUT.plib]' % sys.argv[0])
+    sys.exit(1)
+
+in_file = sys.argv[1]
+out_file = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(in_file)[0] + '.plib'
+if not out_file.endswith('.plib'):
+    print('Output file name must end with .plib: %s' % out_file)
+    sys.exit(1)
+
+service = phot.PhotonVisibilityService.GetME()
+voxel_def = service.GetVoxelDef()
+library = phot.PhotonLibrary()
+library.LoadLibraryFromFile(in_file, voxel_def.GetNVoxels(), service.GetNOpChannels())
+library.StoreLibraryToBinary(out_file, voxel_def)
+
+# Read back and compare
+check = phot.PhotonLibrary()
+check.LoadLibraryFromBinary(out_file, voxel_def)
+if check.NVoxels() != library.NVoxels() or check.NOpChannels() != library.NOpChannels():
+    print('Mismatch between %s and %s!' % (in_file, out_file))
+    sys.exit(1)
+print('Wrote %s (%d voxels, %d channels)' % (out_file, check.NVoxels(), check.NOpChannels()))
@@ -18,6 +18,9 @@ else:
     libs=[x for x in commands.getoutput('flashmatch-config --libs').split() if not x.startswith('-lflashmatch')]
     libs+= ['-L%s' % commands.getoutput('root-config --libdir').rstrip('\n'), '-lMinuit']
     libs+= commands.getoutput('root-config --libs').split()
+# shm_open/shm_unlink (shared-memory photon library) live in librt on older glibc
+if sys.platform.startswith('linux'):
+    libs+= ['-lrt']
 if 'PYTHON_LIB' in os.environ:
     libs+= [" -L{} -lpython{}.{}".format(os.environ["PYTHON_LIB"].strip(), 
         sys.version_info.major, 
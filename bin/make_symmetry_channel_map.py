@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Print the SymmetryChannelMapX/Y/Z line of detector_specs.cfg for a mirror plane: for each
+# channel, the channel whose PMT sits at the mirror image of its position. Also tells if the
+# plane is on a voxel center or boundary of the photon library grid (required for folding).
+#
+# Usage: make_symmetry_channel_map.py axis=y plane=-23.45 [channels=N] [tolerance=CM]
+#
+import sys
+import os
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+current_directory = os.path.dirname(current_directory)
+sys.path.insert(0, current_directory)
+from flashmatch import flashmatch
+
+axis = None
+plane = None
+num_channels = None
+tolerance = 0.5
+if len(sys.argv) > 1:
+    for argv in sys.argv[1:]:
+        if argv.startswith('axis='):
+            axis = argv.replace('axis=','')
+        elif argv.startswith('plane='):
+            plane = float(argv.replace('plane=',''))
+        elif argv.startswith('channels='):
+            num_channels = int(argv.replace('channels=',''))
+        elif argv.startswith('tolerance='):
+            tolerance = float(argv.replace('tolerance=',''))
+if axis not in ('x', 'y', 'z') or plane is None:
+    sys.stderr.write('Usage: %s axis=x|y|z plane=CM [channels=N] [tolerance=CM]\n' % sys.argv[0])
+    sys.exit(1)
+iaxis = 'xyz'.index(axis)
+
+det = flashmatch.DetectorSpecs.GetME()
+if num_channels is None:
+    num_channels = det.NOpDets()
+pos_v = [[det.PMTPosition(ch)[i] for i in range(3)] for ch in range(num_channels)]
+
+channel_map = []
+for ch, pos in enumerate(pos_v):
+    image = list(pos)
+    image[iaxis] = 2. * plane - pos[iaxis]
+    dist_v = [sum([(a - b)**2 for a, b in zip(image, other)])**0.5 for other in pos_v]
+    match = min(range(num_channels), key=lambda i: dist_v[i])
+    if dist_v[match] > tolerance:
+        sys.stderr.write('Channel %d has no mirror image within %g cm (closest: channel %d at %g cm)\n'
+                         % (ch, tolerance, match, dist_v[match]))
+        sys.exit(1)
+    channel_map.append(match)
+if sorted(channel_map) != list(range(num_channels)):
+    sys.stderr.write('Mirror images do not form a permutation of the channels\n')
+    sys.exit(1)
+
+vox_def = det.GetVoxelDef()
+lower = vox_def.GetRegionLowerCorner()[iaxis]
+size = vox_def.GetVoxelSize()[iaxis]
+mirror_sum = 2. * (plane - lower) / size - 1.
+if abs(mirror_sum - round(mirror_sum)) > 1.e-3:
+    sys.stderr.write('Warning: plane %g is neither on a voxel center nor on a voxel boundary along %s\n'
+                     % (plane, axis))
+
+print('SymmetryChannelMap%s: [%s]' % (axis.upper(), ', '.join([str(ch) for ch in channel_map])))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Compare hypotheses and match results obtained with a compact photon library encoding
+# (float16, uint16, uint16log, sparse) against the float32 library on a ToyMC sample.
+# A sparse variant is given as sparse:THRESHOLD[:TOPK] (see SparseThreshold/SparseTopK);
+# for those the light lost w.r.t. float32 is the figure to weigh against the speedup.
+#
+# Usage: validate_library_encoding.py [cfg=FILE] [num_tracks=N]
+#                                     [encodings=float16,uint16,uint16log,sparse:0.01,sparse:0:32]
+#
+import os
+import sys
+import time
+import numpy as np
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+current_directory = os.path.dirname(current_directory)
+sys.path.insert(0, current_directory)
+from flashmatch import flashmatch, phot, toymc
+
+cfg_file = os.path.join(os.environ['FMATCH_BASEDIR'],
+                        'dat', 'flashmatch.cfg')
+num_tracks = 100
+encodings = ['float16', 'uint16', 'uint16log', 'sparse:0.001', 'sparse:0.01', 'sparse:0:32']
+if len(sys.argv) > 1:
+    for argv in sys.argv[1:]:
+        if argv.startswith('cfg='):
+            cfg_file = argv.replace('cfg=','')
+        elif argv.startswith('num_tracks='):
+            num_tracks = int(argv.replace('num_tracks=',''))
+        elif argv.startswith('encodings='):
+            encodings = argv.replace('encodings=','').split(',')
+
+mc = toymc.ToyMC(cfg_file)
+service = phot.PhotonVisibilityService.GetME()
+hypothesis = mc._flash_algo
+
+def use_encoding(name):
+    # the encoding is applied when the library is loaded again
+    service.UnloadLibrary()
+    option_v = name.split(':')
+    if option_v[0] == 'sparse':
+        threshold = float(option_v[1]) if len(option_v) > 1 else 0.
+        topk = int(option_v[2]) if len(option_v) > 2 else 0
+        service.SetSparseLibrary(threshold, topk)
+    service.SetLibraryEncoding(option_v[0])
+    service.GetLibraryData()
+
+def run(qcluster_v, tpc_v, pmt_v):
+    flash = flashmatch.Flash_t()
+    hypothesis_v = []
+    start = time.time()
+    for qcluster in qcluster_v:
+        hypothesis.FillEstimate(qcluster, flash)
+        hypothesis_v.append(np.array(flash.pe_v))
+    elapsed = (time.time() - start) / max(1, len(qcluster_v))
+    match_v = mc.match(tpc_v, pmt_v)
+    match_v = dict([((m.tpc_id, m.flash_id), (m.tpc_point.x, m.score)) for m in match_v])
+    return np.array(hypothesis_v), match_v, elapsed
+
+use_encoding('float32')
+qcluster_v = [mc.make_qcluster(track) for track in mc.gen_trajectories(num_tracks)]
+_, pmt_v, tpc_v, _ = mc.gen_input(num_tracks)
+ref_hypothesis, ref_match, ref_time = run(qcluster_v, tpc_v, pmt_v)
+ref_total = np.maximum(ref_hypothesis.sum(axis=1), 1.e-12)
+
+print('%-14s %9s %8s %10s %12s %12s %12s %8s %10s %10s' % ('encoding', 'ms/clus', 'speedup', 'light lost',
+                                                         'max|dPE|', 'max dPE/PE', 'max dPE/sum',
+                                                         'changed', 'max|dx|', 'max|dscore|'))
+print('%-14s %9.3f %8.2f' % ('float32', ref_time * 1.e3, 1.))
+for name in encodings:
+    use_encoding(name)
+    hypothesis_v, match_v, elapsed = run(qcluster_v, tpc_v, pmt_v)
+    diff = np.abs(hypothesis_v - ref_hypothesis)
+    # relative error on channels with at least 1 PE
+    mask = ref_hypothesis >= 1.
+    rel = (diff[mask] / ref_hypothesis[mask]).max() if mask.any() else 0.
+    rel_sum = (diff.max(axis=1) / ref_total).max()
+    changed = len(set(match_v.keys()) ^ set(ref_match.keys()))
+    common = set(match_v.keys()) & set(ref_match.keys())
+    dx = max([abs(match_v[k][0] - ref_match[k][0]) for k in common] + [0.])
+    dscore = max([abs(match_v[k][1] - ref_match[k][1]) for k in common] + [0.])
+    lost = 1. - hypothesis_v.sum() / max(ref_hypothesis.sum(), 1.e-12)
+    print('%-14s %9.3f %8.2f %10.4g %12.4g %12.4g %12.4g %8d %10.4g %10.4g' % (name, elapsed * 1.e3,
+                                                                         ref_time / max(elapsed, 1.e-12),
+                                                                         lost, diff.max(), rel, rel_sum,
+                                                                         changed, dx, dscore))
+use_encoding('float32')
@@ -4,14 +4,86 @@
 #include "ChargeAnalytical.h"
 #include "flashmatch/Base/FMWKInterface.h"
 #include "flashmatch/Base/OpT0FinderException.h"
-#include <math.h>
+#include <cmath>
+#include <omp.h>
 
 namespace flashmatch {
 
   static ChargeAnalyticalFactory __global_ChargeAnalyticalFactory__;
-  
+
+  namespace {
+
+    /// Point coordinates and charge as contiguous arrays (structure of arrays)
+    struct PointArrays_t {
+      std::vector<double> x, y, z, q;
+    };
+
+    void FillPointArrays(const QCluster_t& trk, PointArrays_t& pts, double xoffset=0.)
+    {
+      size_t npt = trk.size();
+      pts.x.resize(npt);
+      pts.y.resize(npt);
+      pts.z.resize(npt);
+      pts.q.resize(npt);
+      for(size_t i = 0; i < npt; ++i) {
+	pts.x[i] = trk[i].x + xoffset;
+	pts.y[i] = trk[i].y;
+	pts.z[i] = trk[i].z;
+	pts.q[i] = trk[i].q;
+      }
+    }
+
+    /// Sum over points of q |dx| / r^3 for one PMT (vectorized over points)
+    inline double PMTSum(double px, double py, double pz, const PointArrays_t& pts)
+    {
+      const double* x = pts.x.data();
+      const double* y = pts.y.data();
+      const double* z = pts.z.data();
+      const double* q = pts.q.data();
+      const size_t npt = pts.x.size();
+      double pe = 0.;
+      #pragma omp simd reduction(+:pe)
+      for(size_t i = 0; i < npt; ++i) {
+	double dx = px - x[i];
+	double dy = py - y[i];
+	double dz = pz - z[i];
+	double r2 = dx * dx + dy * dy + dz * dz;
+	pe += q[i] * std::fabs(dx) / (r2 * std::sqrt(r2));
+      }
+      return pe;
+    }
+
+    /// PMTSum and its derivative w.r.t. a common x shift of the points
+    inline void PMTSumWithGradient(double px, double py, double pz, const PointArrays_t& pts,
+				   double& pe, double& dpe)
+    {
+      const double* x = pts.x.data();
+      const double* y = pts.y.data();
+      const double* z = pts.z.data();
+      const double* q = pts.q.data();
+      const size_t npt = pts.x.size();
+      double sum = 0., dsum = 0.;
+      #pragma omp simd reduction(+:sum,dsum)
+      for(size_t i = 0; i < npt; ++i) {
+	double dx = px - x[i];
+	double dy = py - y[i];
+	double dz = pz - z[i];
+	double r2 = dx * dx + dy * dy + dz * dz;
+	double inv_r3 = 1. / (r2 * std::sqrt(r2));
+	double adx = std::fabs(dx);
+	// d/dx of q |dx| / r^3 with dx = px - x: q (3 |dx| dx / r^2 - sign(dx)) / r^3
+	sum  += q[i] * adx * inv_r3;
+	dsum += q[i] * inv_r3 * (3. * adx * dx / r2 - std::copysign(1., dx));
+      }
+      pe  = sum;
+      dpe = dsum;
+    }
+  }
+
   ChargeAnalytical::ChargeAnalytical(const std::string name)
     : BaseFlashHypothesis(name)
+    , _num_threads(1)
+    , _min_parallel_points(1000)
   {}
 
   void ChargeAnalytical::_Configure_(const Config_t &pset)
@@ -23,37 +95,136 @@ namespace flashmatch {
 		       << " != number of opdet (" << DetectorSpecs::GetME().NOpDets() << ")!" << std::endl;
       throw OpT0FinderException();
     }
+    _num_threads         = pset.get<size_t>("NumThreads",1);
+    _min_parallel_points = pset.get<size_t>("MinParallelPoints",1000);
+
+    // PMT positions and scale factors as contiguous arrays for the kernels
+    size_t n_pmt = DetectorSpecs::GetME().NOpDets();
+    _pmt_x_v.resize(n_pmt);
+    _pmt_y_v.resize(n_pmt);
+    _pmt_z_v.resize(n_pmt);
+    _scale_v.resize(n_pmt);
+    for (size_t pmt_index = 0; pmt_index < n_pmt; ++pmt_index) {
+      auto const& pmt_pos = DetectorSpecs::GetME().PMTPosition(pmt_index);
+      _pmt_x_v[pmt_index] = pmt_pos[0];
+      _pmt_y_v[pmt_index] = pmt_pos[1];
+      _pmt_z_v[pmt_index] = pmt_pos[2];
+      _scale_v[pmt_index] = _global_qe / _qe_v[pmt_index];
+    }
+  }
+
+  int ChargeAnalytical::NumThreads(size_t npt) const
+  {
+    // Fork/join costs more than the work for small clusters, and nested regions would oversubscribe
+    if(npt < _min_parallel_points || omp_in_parallel()) return 1;
+    return (_num_threads ? (int)(_num_threads) : omp_get_max_threads());
   }
 
   void ChargeAnalytical::FillEstimate(const QCluster_t &track,
 				      Flash_t &flash) const
   {
-    
-    size_t n_pmt = DetectorSpecs::GetME().NOpDets();
-    
-    for (size_t i = 0; i < n_pmt; ++i) {
-      flash.pe_v[i] = 0;
-    }
+    FillShiftedEstimate(track, 0., flash, 0);
+  }
+
+  void ChargeAnalytical::FillShiftedEstimate(const QCluster_t &track,
+					     const double xoffset,
+					     Flash_t &flash,
+					     size_t level) const
+  {
+    if(level >= NumLevels())
+      throw OpT0FinderException("Hypothesis level " + std::to_string(level) + " is not available in " + AlgorithmName());
+
+    size_t n_pmt = _pmt_x_v.size();
+    flash.pe_v.resize(n_pmt);
+
+    // Coordinates copied once per call into per-thread arrays (no allocation in steady state)
+    thread_local PointArrays_t thread_pts;
+    auto& pts = thread_pts; // thread_local names resolve per-thread inside omp regions
+    FillPointArrays(track, pts, xoffset);
+
+    // Each thread owns a set of PMTs: the result does not depend on the number of threads
+    int num_threads = NumThreads(track.size());
+    #pragma omp parallel for num_threads(num_threads) schedule(static) if(num_threads > 1)
+    for (size_t pmt_index = 0; pmt_index < n_pmt; ++pmt_index)
+      flash.pe_v[pmt_index] = PMTSum(_pmt_x_v[pmt_index], _pmt_y_v[pmt_index], _pmt_z_v[pmt_index], pts)
+	* _scale_v[pmt_index];
+  }
+
+  void ChargeAnalytical::FillEstimateWithGradient(const QCluster_t &track,
+						  const double xoffset,
+						  Flash_t &flash,
+						  Flash_t &grad) const
+  {
+    size_t n_pmt = _pmt_x_v.size();
+    flash.pe_v.resize(n_pmt);
+    grad.pe_v.resize(n_pmt);
+
+    thread_local PointArrays_t thread_pts;
+    auto& pts = thread_pts;
+    FillPointArrays(track, pts, xoffset);
 
+    int num_threads = NumThreads(track.size());
+    #pragma omp parallel for num_threads(num_threads) schedule(static) if(num_threads > 1)
     for (size_t pmt_index = 0; pmt_index < n_pmt; ++pmt_index) {
-      
-      for (size_t pt_index = 0; pt_index < track.size(); ++pt_index) {
-	
-	auto const &pt = track[pt_index];
-
-	auto const& pmt_pos = DetectorSpecs::GetME().PMTPosition(pmt_index);
-	double dx = pmt_pos[0] - pt.x;
-	double dy = pmt_pos[1] - pt.y;
-	double dz = pmt_pos[2] - pt.z;
-	
-	double r2 = (pow(dx, 2) + pow(dy, 2) + pow(dz, 2));
-	
-	double angle = dx / sqrt(r2);
-	
-	if (angle < 0) angle *= -1;
-	
-	flash.pe_v[pmt_index] += pt.q * angle / r2 * _global_qe / _qe_v[pmt_index];
-	
+      double pe = 0., dpe = 0.;
+      PMTSumWithGradient(_pmt_x_v[pmt_index], _pmt_y_v[pmt_index], _pmt_z_v[pmt_index], pts, pe, dpe);
+      flash.pe_v[pmt_index] = pe * _scale_v[pmt_index];
+      grad.pe_v[pmt_index]  = dpe * _scale_v[pmt_index];
+    }
+  }
+
+  void ChargeAnalytical::FillEstimateBatch(const QCluster_t &track,
+					   const std::vector<double> &xoffset_v,
+					   std::vector<Flash_t> &flash_v) const
+  {
+    size_t n_pmt = _pmt_x_v.size();
+
+    flash_v.resize(xoffset_v.size());
+    for (auto& flash : flash_v)
+      flash.pe_v.assign(n_pmt, 0.);
+
+    thread_local PointArrays_t thread_pts;
+    auto& pts = thread_pts;
+    FillPointArrays(track, pts);
+    const double* x = pts.x.data();
+    const double* q = pts.q.data();
+    const size_t npt = track.size();
+
+    int num_threads = NumThreads(npt * xoffset_v.size());
+    #pragma omp parallel num_threads(num_threads) if(num_threads > 1)
+    {
+      // y/z part of the distance is the same for all offsets (per-thread buffer, kept across calls)
+      thread_local std::vector<double> thread_dyz2_v;
+      auto& dyz2_v = thread_dyz2_v;
+      dyz2_v.resize(npt);
+      double* dyz2 = dyz2_v.data();
+
+      #pragma omp for schedule(static)
+      for (size_t pmt_index = 0; pmt_index < n_pmt; ++pmt_index) {
+
+	const double py = _pmt_y_v[pmt_index];
+	const double pz = _pmt_z_v[pmt_index];
+	const double* y = pts.y.data();
+	const double* z = pts.z.data();
+	#pragma omp simd
+	for (size_t pt_index = 0; pt_index < npt; ++pt_index) {
+	  double dy = py - y[pt_index];
+	  double dz = pz - z[pt_index];
+	  dyz2[pt_index] = dy * dy + dz * dz;
+	}
+
+	const double px = _pmt_x_v[pmt_index];
+	for (size_t ioff = 0; ioff < xoffset_v.size(); ++ioff) {
+	  const double xoffset = xoffset_v[ioff];
+	  double pe = 0.;
+	  #pragma omp simd reduction(+:pe)
+	  for (size_t pt_index = 0; pt_index < npt; ++pt_index) {
+	    double dx = px - (x[pt_index] + xoffset);
+	    double r2 = dx * dx + dyz2[pt_index];
+	    pe += q[pt_index] * std::fabs(dx) / (r2 * std::sqrt(r2));
+	  }
+	  flash_v[ioff].pe_v[pmt_index] = pe * _scale_v[pmt_index];
+	}
       }
     }
   }
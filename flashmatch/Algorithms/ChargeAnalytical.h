@@ -38,12 +38,36 @@ namespace flashmatch {
     
     void FillEstimate(const QCluster_t&, Flash_t&) const;
 
+    /// Estimate for the cluster shifted along x: the shift is applied while copying the coordinates
+    void FillShiftedEstimate(const QCluster_t&, const double xoffset, Flash_t&, size_t level=0) const;
+
+    /// Hypotheses for many x-offsets, computing the y/z distance terms only once
+    void FillEstimateBatch(const QCluster_t&, const std::vector<double>&, std::vector<Flash_t>&) const;
+
+    /// Closed-form x derivative
+    bool HasGradient() const { return true; }
+    bool HasExactGradient() const { return true; }
+
+    /// Estimate and its closed-form x derivative in one pass over the points
+    void FillEstimateWithGradient(const QCluster_t&, const double xoffset, Flash_t&, Flash_t&) const;
+
   protected:
 
     void _Configure_(const Config_t &pset);
 
+    /// Number of threads for a cluster of npt points (1 if small or already in a parallel region)
+    int NumThreads(size_t npt) const;
+
     double _global_qe;         ///< Global QE
     std::vector<double> _qe_v; ///< PMT-wise relative QE
+
+    std::vector<double> _pmt_x_v; ///< PMT x positions (contiguous copy of DetectorSpecs)
+    std::vector<double> _pmt_y_v; ///< PMT y positions
+    std::vector<double> _pmt_z_v; ///< PMT z positions
+    std::vector<double> _scale_v; ///< PMT-wise global QE / relative QE
+
+    size_t _num_threads;          ///< Threads per call, split by PMT (0 = OpenMP default)
+    size_t _min_parallel_points;  ///< Clusters with fewer points are processed serially
     
   };
 
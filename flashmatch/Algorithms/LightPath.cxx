@@ -3,6 +3,7 @@
 
 #include "LightPath.h"
 #include "flashmatch/GeoAlgo/GeoTrajectory.h"
+#include <cmath>
 
 namespace flashmatch {
 
@@ -22,56 +23,113 @@ namespace flashmatch {
     _dEdxMIP      = pset.get< double > ( "MIPdEdx"     );
   }
 
-  void LightPath::MakeQCluster(const ::geoalgo::Vector& pt_1,
-			       const ::geoalgo::Vector& pt_2,
-			       QCluster_t& Q_cluster,
-			       double dedx) const {
+  size_t LightPath::SampleSegment(const ::geoalgo::Vector& pt_1,
+				  const ::geoalgo::Vector& pt_2,
+				  double dedx,
+				  const ::geoalgo::AABox* box,
+				  QCluster_t* Q_cluster) const {
+
+    // Same arithmetic as geoalgo::Vector::Dist, Dir and operators, without the temporaries
+    double diff[3];
+    double dist = 0.;
+    for (size_t i = 0; i < 3; ++i) {
+      diff[i] = pt_1[i] - pt_2[i];
+      dist += diff[i] * diff[i];
+    }
+    dist = std::sqrt(dist);
 
-    if(dedx < 0) dedx = _dEdxMIP;
+    if (Q_cluster) {
+      FLASH_INFO() << "Filling points between (" << pt_1[0] << "," << pt_1[1] << "," << pt_1[2] << ")"
+		   << " => (" << pt_2[0] << "," << pt_2[1] << "," << pt_2[2] << ") ... dist="<<dist<<std::endl;
+    }
+
+    // Box test on the sampled point itself (inclusive bounds)
+    auto inside = [box](const QPoint_t& q_pt) {
+      return (!box ||
+	      (q_pt.x >= box->Min()[0] && q_pt.x <= box->Max()[0] &&
+	       q_pt.y >= box->Min()[1] && q_pt.y <= box->Max()[1] &&
+	       q_pt.z >= box->Min()[2] && q_pt.z <= box->Max()[2]));
+    };
 
-    double dist = pt_1.Dist(pt_2);
-    QPoint_t q_pt;
-    FLASH_INFO() << "Filling points between (" << pt_1[0] << "," << pt_1[1] << "," << pt_1[2] << ")"
-		 << " => (" << pt_2[0] << "," << pt_2[1] << "," << pt_2[2] << ") ... dist="<<dist<<std::endl;
     if (dist <= _gap) {
-      ::geoalgo::Vector mid_pt((pt_1 + pt_2) / 2.);
-      q_pt.x = mid_pt[0];
-      q_pt.y = mid_pt[1];
-      q_pt.z = mid_pt[2];
-      q_pt.q = _light_yield * _dEdxMIP * dist;
+      QPoint_t q_pt((pt_1[0] + pt_2[0]) / 2.,
+		    (pt_1[1] + pt_2[1]) / 2.,
+		    (pt_1[2] + pt_2[2]) / 2.,
+		    _light_yield * dedx * dist);
+      if (!inside(q_pt)) return 0;
+      if (!Q_cluster) return 1;
       FLASH_DEBUG() << "Smaller than gap threshold (" << _gap << ")" << std::endl
-		   << "Traj pt (" << q_pt.x << "," << q_pt.y << "," << q_pt.z << ") q=" << q_pt.q << std::endl;
-      Q_cluster.emplace_back(q_pt);
-      return;
+		    << "Traj pt (" << q_pt.x << "," << q_pt.y << "," << q_pt.z << ") q=" << q_pt.q << std::endl;
+      Q_cluster->push_back(q_pt);
+      return 1;
     }
 
     int num_div = int(dist / _gap);
+    double direct[3] = { diff[0] / dist, diff[1] / dist, diff[2] / dist };
+
+    // Sample points are at s = (k + 1/2) x gap from pt_2 (the last one covers the remainder).
+    // Clip [0,dist] with the box slabs, then keep the index range that can fall inside, with
+    // one index of margin: each point is still tested, so the kept points do not depend on
+    // the rounding of the clipping.
+    int begin = 0;
+    int end = num_div + 1;
+    if (box) {
+      double smin = 0.;
+      double smax = dist;
+      for (size_t i = 0; i < 3; ++i) {
+	double lo = box->Min()[i];
+	double hi = box->Max()[i];
+	if (direct[i] == 0.) {
+	  if (pt_2[i] < lo || pt_2[i] > hi) return 0;
+	  continue;
+	}
+	double s_lo = (lo - pt_2[i]) / direct[i];
+	double s_hi = (hi - pt_2[i]) / direct[i];
+	smin = std::max(smin, std::min(s_lo, s_hi));
+	smax = std::min(smax, std::max(s_lo, s_hi));
+      }
+      if (smin - smax > _gap) return 0;
+      begin = std::max(begin, int(std::floor(smin / _gap - 0.5)) - 1);
+      end   = std::min(end,   int(std::ceil (smax / _gap - 0.5)) + 2);
+      if (begin >= end) return 0;
+    }
 
-    ::geoalgo::Vector direct = (pt_1 - pt_2).Dir();
-
-    Q_cluster.reserve(Q_cluster.size() + num_div);
+    if (!Q_cluster) return (size_t)(end - begin);
 
-    for (int div_index = 0; div_index < num_div + 1; div_index++) {
+    size_t num_added = 0;
+    QPoint_t q_pt;
+    for (int div_index = begin; div_index < end; ++div_index) {
+      double s, weight;
       if (div_index < num_div) {
-        auto const mid_pt = pt_2 + direct * (_gap * div_index + _gap / 2.);
-        q_pt.x = mid_pt[0] ;
-        q_pt.y = mid_pt[1];
-        q_pt.z = mid_pt[2];
-        q_pt.q = _light_yield * _dEdxMIP * _gap;
-	FLASH_DEBUG() << "Traj pt (" << q_pt.x << "," << q_pt.y << "," << q_pt.z << ") q=" << q_pt.q << std::endl;
-        Q_cluster.emplace_back(q_pt);
+	weight = _gap;
+	s = _gap * div_index + _gap / 2.;
       }
       else {
-        double weight = (dist - int(dist / _gap) * _gap);
-        auto const mid_pt = pt_2 + direct * (_gap * div_index + weight / 2.);
-        q_pt.x = mid_pt[0] ;
-        q_pt.y = mid_pt[1];
-        q_pt.z = mid_pt[2];
-        q_pt.q = _light_yield * _dEdxMIP * weight;
-	FLASH_DEBUG() << "Traj pt (" << q_pt.x << "," << q_pt.y << "," << q_pt.z << ") q=" << q_pt.q << std::endl;
-        Q_cluster.emplace_back(q_pt);
-      }//Last segment less than gap
+	//Last segment less than gap
+	weight = (dist - int(dist / _gap) * _gap);
+	s = _gap * div_index + weight / 2.;
+      }
+      q_pt.x = pt_2[0] + direct[0] * s;
+      q_pt.y = pt_2[1] + direct[1] * s;
+      q_pt.z = pt_2[2] + direct[2] * s;
+      q_pt.q = _light_yield * dedx * weight;
+      if (!inside(q_pt)) continue;
+      FLASH_DEBUG() << "Traj pt (" << q_pt.x << "," << q_pt.y << "," << q_pt.z << ") q=" << q_pt.q << std::endl;
+      Q_cluster->push_back(q_pt);
+      ++num_added;
     }
+    return num_added;
+  }
+
+  void LightPath::MakeQCluster(const ::geoalgo::Vector& pt_1,
+			       const ::geoalgo::Vector& pt_2,
+			       QCluster_t& Q_cluster,
+			       double dedx) const {
+
+    if(dedx < 0) dedx = _dEdxMIP;
+
+    Q_cluster.reserve(Q_cluster.size() + SampleSegment(pt_1, pt_2, dedx, nullptr, nullptr));
+    SampleSegment(pt_1, pt_2, dedx, nullptr, &Q_cluster);
   }
 
   QCluster_t LightPath::MakeQCluster(const ::geoalgo::Trajectory& trj) const {
@@ -79,33 +137,22 @@ namespace flashmatch {
     QCluster_t result;
     result.clear();
 
-    for (size_t i = 0; i < trj.size() - 1; i++) {
+    // Only the part of the trajectory inside the active volume is sampled: a first pass
+    // counts the candidate points so that the output is allocated once
+    auto const& bbox = DetectorSpecs::GetME().ActiveVolume();
+    size_t num_points = 0;
+    for (size_t i = 0; i + 1 < trj.size(); i++)
+      num_points += SampleSegment(trj[i], trj[i + 1], _dEdxMIP, &bbox, nullptr);
+    result.reserve(num_points);
+
+    for (size_t i = 0; i + 1 < trj.size(); i++) {
       auto const& this_loc(trj[i]);
       auto const& last_loc(trj[i + 1]);
-      LightPath::MakeQCluster(this_loc, last_loc, result);
+      SampleSegment(this_loc, last_loc, _dEdxMIP, &bbox, &result);
     }
-
-    // Trimming Q_cluster
-    auto const& bbox = DetectorSpecs::GetME().ActiveVolume();
-    double _vol_xmax = bbox.Max()[0];
-    double _vol_ymax = bbox.Max()[1];
-    double _vol_zmax = bbox.Max()[2];
-
-    double _vol_xmin = bbox.Min()[0];
-    double _vol_ymin = bbox.Min()[1];
-    double _vol_zmin = bbox.Min()[2];
     FLASH_INFO() << result << std::endl;
-    QCluster_t final_result;
-    final_result.clear();
-    for (size_t idx = 0; idx < result.size(); ++idx) {
-        auto pt = result[idx];
-        if (pt.x >= _vol_xmin && pt.x <= _vol_xmax && pt.y >= _vol_ymin && pt.y <= _vol_ymax && pt.z >= _vol_zmin && pt.z <= _vol_zmax) {
-            final_result.push_back(pt);
-        }
-    }
-    FLASH_INFO() << final_result << std::endl;
 
-    return final_result;
+    return result;
   }
 
 }
@@ -20,6 +20,7 @@
 #include <algorithm>
 
 #include "flashmatch/GeoAlgo/GeoTrajectory.h"
+#include "flashmatch/GeoAlgo/GeoAABox.h"
 #include "flashmatch/Base/BaseAlgorithm.h"
 #include "flashmatch/Base/CustomAlgoFactory.h"
 
@@ -58,6 +59,18 @@ namespace flashmatch{
 
     void _Configure_(const Config_t &pset);
 
+    /**
+       Samples the segment pt_2 => pt_1 at the segment size into Q_cluster and returns the \n
+       number of points added. With a box, the segment is first clipped analytically and only \n
+       the sample points of the part inside the box are computed and kept. Without Q_cluster, \n
+       returns the number of candidate points instead (upper bound for a reserve).
+    */
+    size_t SampleSegment(const ::geoalgo::Vector& pt_1,
+			 const ::geoalgo::Vector& pt_2,
+			 double dedx,
+			 const ::geoalgo::AABox* box,
+			 flashmatch::QCluster_t* Q_cluster) const;
+
     double _gap;
     double _light_yield;
     double _dEdxMIP;
@@ -12,15 +12,20 @@
 //#pragma link C++ class flashmatch::QWeightPoint+;
 //#pragma link C++ class flashmatch::CommonAmps+;
 #pragma link C++ class flashmatch::TimeCompatMatch+;
+#pragma link C++ class flashmatch::PEBoundCompatMatch+;
 #pragma link C++ class flashmatch::MaxNPEWindow+;
 #pragma link C++ class flashmatch::TimeRange+;
 #pragma link C++ class flashmatch::TimeRangeSet+;
 //#pragma link C++ class flashmatch::FilterArray+;
 //#pragma link C++ class flashmatch::NPtFilter+;
+#pragma link C++ class flashmatch::QLLFlashContext+;
+#pragma link C++ class flashmatch::QLLMatchContext+;
 #pragma link C++ class flashmatch::QLLMatch+;
 
 #pragma link C++ class flashmatch::PhotonLibHypothesis+;
+#pragma link C++ class flashmatch::LowRankHypothesis+;
 //#pragma link C++ class flashmatch::ChargeAnalytical+;
 #pragma link C++ class flashmatch::LightPath+;
+#pragma link C++ class flashmatch::VoxelPath+;
 //ADD_NEW_CLASS ... do not change this line
 #endif
@@ -0,0 +1,136 @@
+#ifndef LOWRANKHYPOTHESIS_CXX
+#define LOWRANKHYPOTHESIS_CXX
+
+#include "LowRankHypothesis.h"
+#include "flashmatch/Base/OpT0FinderException.h"
+#include "flashmatch/Base/FMWKInterface.h"
+#include <fstream>
+#include <cstring>
+#include <cstdlib>
+
+namespace flashmatch {
+
+  static LowRankHypothesisFactory __global_LowRankHypothesisFactory__;
+
+  LowRankHypothesis::LowRankHypothesis(const std::string name)
+    : BaseFlashHypothesis(name)
+    , _global_qe(1.)
+    , _rank(0)
+    , _u_stride(0)
+  {}
+
+  void LowRankHypothesis::_Configure_(const Config_t &pset)
+  {
+    _global_qe = pset.get<double>("GlobalQE");
+
+    _qe_v.clear();
+    _qe_v = pset.get<std::vector<double> >("CCVCorrection",_qe_v);
+    if(_qe_v.empty()) _qe_v.resize(DetectorSpecs::GetME().NOpDets(),1.0);
+    if(_qe_v.size() != DetectorSpecs::GetME().NOpDets()) {
+      FLASH_CRITICAL() << "CCVCorrection factor array has size " << _qe_v.size()
+		       << " != number of opdet (" << DetectorSpecs::GetME().NOpDets() << ")!" << std::endl;
+      throw OpT0FinderException();
+    }
+
+    auto fname = pset.get<std::string>("FactorizationFile");
+    if(fname.find("/") != 0 && getenv("FMATCH_DATADIR"))
+      fname = std::string(getenv("FMATCH_DATADIR")) + "/" + fname;
+    LoadFactorization(fname, pset.get<size_t>("Rank",0));
+  }
+
+  void LowRankHypothesis::LoadFactorization(const std::string& fname, size_t max_rank)
+  {
+    std::ifstream fin(fname.c_str(), std::ios::binary);
+    if(!fin) {
+      FLASH_CRITICAL() << "Failed to open a low-rank library file: " << fname << std::endl
+		       << "Create it with bin/build_low_rank_library.py" << std::endl;
+      throw OpT0FinderException();
+    }
+
+    LowRankLibraryHeader_t header;
+    fin.read((char*)(&header), sizeof(header));
+    if(!fin || memcmp(header.Magic, "FMLRANK1", sizeof(header.Magic)) != 0 ||
+       header.Version != 1 || header.HeaderSize != sizeof(header)) {
+      FLASH_CRITICAL() << "Not a (supported) low-rank library file: " << fname << std::endl;
+      throw OpT0FinderException();
+    }
+
+    auto const& vox_def = DetectorSpecs::GetME().GetVoxelDef();
+    sim::PhotonVoxelDef file_def(header.LowerCorner[0], header.UpperCorner[0], header.Steps[0],
+				 header.LowerCorner[1], header.UpperCorner[1], header.Steps[1],
+				 header.LowerCorner[2], header.UpperCorner[2], header.Steps[2]);
+    if(file_def != vox_def || (int)(header.NVoxels) != vox_def.GetNVoxels()) {
+      FLASH_CRITICAL() << "Voxel definition of " << fname << " does not match the detector!" << std::endl;
+      throw OpT0FinderException();
+    }
+    if(header.NOpChannels != DetectorSpecs::GetME().NOpDets()) {
+      FLASH_CRITICAL() << "Low-rank library has " << header.NOpChannels
+		       << " channels != number of opdet (" << DetectorSpecs::GetME().NOpDets() << ")!" << std::endl;
+      throw OpT0FinderException();
+    }
+    if(!header.Rank) {
+      FLASH_CRITICAL() << "Low-rank library " << fname << " has no component!" << std::endl;
+      throw OpT0FinderException();
+    }
+
+    _u_stride = header.Rank;
+    _rank = (max_rank && max_rank < header.Rank ? max_rank : header.Rank);
+
+    _u_v.resize(header.NVoxels * header.Rank);
+    fin.read((char*)(_u_v.data()), _u_v.size() * sizeof(float));
+    std::vector<float> w_v(header.Rank * header.NOpChannels);
+    fin.read((char*)(w_v.data()), w_v.size() * sizeof(float));
+    if(!fin) {
+      FLASH_CRITICAL() << "Low-rank library file is truncated: " << fname << std::endl;
+      throw OpT0FinderException();
+    }
+    // Only the components in use are kept for the projection back to PMTs
+    _w_v.assign(w_v.begin(), w_v.begin() + _rank * header.NOpChannels);
+
+    FLASH_INFO() << "Loaded rank " << _rank << " (of " << header.Rank << ") photon library from "
+		 << fname << std::endl;
+  }
+
+  void LowRankHypothesis::FillEstimate(const QCluster_t& trk, Flash_t &flash) const
+  {
+    size_t n_pmt = DetectorSpecs::GetME().NOpDets();
+    flash.pe_v.assign(n_pmt,0.);
+    flash.pe_err_v.assign(n_pmt,0.);
+
+    auto const& vox_def = DetectorSpecs::GetME().GetVoxelDef();
+
+    // Project the charge on the components, one voxel row per run of points in the same voxel
+    thread_local std::vector<double> z_v;
+    z_v.assign(_rank,0.);
+    int    last_vox = -1;
+    double last_q   = 0.;
+    for(size_t ipt = 0; ipt <= trk.size(); ++ipt) {
+      int vox_id = -1;
+      if(ipt < trk.size()) {
+	auto const& pt = trk[ipt];
+	vox_id = vox_def.GetVoxelID(pt.x,pt.y,pt.z);
+	if(vox_id < 0) continue;
+	if(vox_id == last_vox) { last_q += pt.q; continue; }
+      }
+      if(last_vox >= 0) {
+	const float* u = &(_u_v[last_vox * _u_stride]);
+	for(size_t k = 0; k < _rank; ++k)
+	  z_v[k] += last_q * u[k];
+      }
+      last_vox = vox_id;
+      if(ipt < trk.size()) last_q = trk[ipt].q;
+    }
+
+    // Back to PMTs (a truncated factorization can give small negative values)
+    for(size_t k = 0; k < _rank; ++k) {
+      const double* w = &(_w_v[k * n_pmt]);
+      for(size_t ipmt = 0; ipmt < n_pmt; ++ipmt)
+	flash.pe_v[ipmt] += z_v[k] * w[ipmt];
+    }
+    for(size_t ipmt = 0; ipmt < n_pmt; ++ipmt) {
+      if(flash.pe_v[ipmt] < 0.) flash.pe_v[ipmt] = 0.;
+      flash.pe_v[ipmt] *= _global_qe / _qe_v[ipmt];
+    }
+  }
+}
+#endif
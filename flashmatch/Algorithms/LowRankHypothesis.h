@@ -0,0 +1,100 @@
+/**
+ * \file LowRankHypothesis.h
+ *
+ * \ingroup Algorithms
+ *
+ * \brief Class def header for a class LowRankHypothesis
+ *
+ * @author kazuhiro
+ */
+
+/** \addtogroup Algorithms
+
+    @{*/
+
+#ifndef LOWRANKHYPOTHESIS_H
+#define LOWRANKHYPOTHESIS_H
+
+#include <iostream>
+#include <cstdint>
+#include "flashmatch/Base/BaseFlashHypothesis.h"
+#include "flashmatch/Base/FlashHypothesisFactory.h"
+
+namespace flashmatch {
+
+  /**
+     Header of a low-rank photon library file (native byte order), followed by \n
+     U (NVoxels x Rank floats, voxel-major) and W (Rank x NOpChannels floats). \n
+     Components are ordered by decreasing singular value. Written by bin/build_low_rank_library.py.
+  */
+  struct LowRankLibraryHeader_t {
+    char     Magic[8];   ///< "FMLRANK1"
+    uint32_t Version;
+    uint32_t HeaderSize;
+    uint64_t NVoxels;
+    uint64_t NOpChannels;
+    uint64_t Rank;
+    double   LowerCorner[3];
+    double   UpperCorner[3];
+    int32_t  Steps[3];
+    int32_t  Reserved;
+  };
+
+  /**
+     \class LowRankHypothesis
+     Flash hypothesis from a rank-k factorization of the photon library, V ~ U.W : \n
+     the cluster charge is projected on the k components of its voxels (z = sum q.U[voxel]) \n
+     and the hypothesis is z.W. This takes k multiply-adds per voxel instead of one per PMT, \n
+     and the stored library shrinks by NOpChannels/k.
+  */
+  class LowRankHypothesis : public BaseFlashHypothesis {
+
+  public:
+
+    /// Default constructor
+    LowRankHypothesis(const std::string name="LowRankHypothesis");
+
+    /// Default destructor
+    virtual ~LowRankHypothesis(){}
+
+    void FillEstimate(const QCluster_t&, Flash_t&) const;
+
+    /// The estimate only depends on the voxel of each point (see LibraryVoxelKey)
+    bool ShiftKey(const QCluster_t& trk, const double xoffset, long& key) const
+    { key = LibraryVoxelKey(trk, xoffset); return true; }
+
+    /// Number of components in use
+    size_t Rank() const { return _rank; }
+
+  protected:
+
+    void _Configure_(const Config_t &pset);
+
+    /// Read a factorization file and keep its first max_rank components (0 = all)
+    void LoadFactorization(const std::string& fname, size_t max_rank);
+
+    double _global_qe;             ///< Global QE
+    std::vector<double> _qe_v;     ///< PMT-wise relative QE
+
+    size_t _rank;                  ///< Number of components in use
+    size_t _u_stride;              ///< Floats per voxel in _u_v (rank stored in the file)
+    std::vector<float>  _u_v;      ///< Voxel loadings (NVoxels x stored rank)
+    std::vector<double> _w_v;      ///< Components (rank x NOpChannels)
+  };
+
+  /**
+     \class flashmatch::LowRankHypothesisFactory
+  */
+  class LowRankHypothesisFactory : public FlashHypothesisFactoryBase {
+  public:
+    /// ctor
+    LowRankHypothesisFactory() { FlashHypothesisFactory::get().add_factory("LowRankHypothesis",this); }
+    /// dtor
+    ~LowRankHypothesisFactory() {}
+    /// creation method
+    BaseFlashHypothesis* create(const std::string instance_name) { return new LowRankHypothesis(instance_name); }
+  };
+}
+#endif
+
+/** @} */ // end of doxygen group
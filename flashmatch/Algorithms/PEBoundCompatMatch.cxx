@@ -0,0 +1,154 @@
+#ifndef OPT0FINDER_PEBOUNDCOMPATMATCH_CXX
+#define OPT0FINDER_PEBOUNDCOMPATMATCH_CXX
+
+#include "PEBoundCompatMatch.h"
+#include "flashmatch/Base/FMWKInterface.h"
+#include "flashmatch/Base/OpT0FinderException.h"
+#include <cmath>
+#include <algorithm>
+
+namespace flashmatch {
+
+  static PEBoundCompatMatchFactory __global_PEBoundCompatMatchFactory__;
+
+  PEBoundCompatMatch::PEBoundCompatMatch(const std::string name)
+    : BaseProhibitAlgo(name)
+    , _x_step(5.)
+    , _pe_max_ratio(2.)
+    , _pe_min_ratio(0.5)
+    , _centroid_tolerance(-1.)
+    , _num_inspected(0)
+    , _num_pruned_pe(0)
+    , _num_pruned_centroid(0)
+  {}
+
+  void PEBoundCompatMatch::_Configure_(const Config_t &pset)
+  {
+    _x_step             = pset.get<double>("XStepSize", -1.);
+    _pe_max_ratio       = pset.get<double>("PEMaxRatio", 2.);
+    _pe_min_ratio       = pset.get<double>("PEMinRatio", 0.5);
+    _centroid_tolerance = pset.get<double>("CentroidTolerance", -1.);
+    if(_x_step <= 0.)
+      _x_step = DetectorSpecs::GetME().GetVoxelDef().GetVoxelSize()[0];
+
+    auto const& bbox = DetectorSpecs::GetME().ActiveVolume();
+    _vol_xmax = bbox.Max()[0];
+    _vol_xmin = bbox.Min()[0];
+  }
+
+  void PEBoundCompatMatch::ComputeCentroid(const std::vector<double>& pe_v,
+					   double& pe, double& y, double& z) const
+  {
+    pe = y = z = 0.;
+    for(size_t pmt=0; pmt<pe_v.size(); ++pmt) {
+      if(pe_v[pmt] <= 0.) continue;
+      auto const& pmt_pos = DetectorSpecs::GetME().PMTPosition(pmt);
+      pe += pe_v[pmt];
+      y  += pmt_pos[1] * pe_v[pmt];
+      z  += pmt_pos[2] * pe_v[pmt];
+    }
+    if(pe > 0.) { y /= pe; z /= pe; }
+  }
+
+  void PEBoundCompatMatch::ComputeBound(const QCluster_t& clus, Bound_t& bound)
+  {
+    auto hypothesis = GetFlashHypothesis();
+    if(!hypothesis)
+      throw OpT0FinderException("PEBoundCompatMatch requires a flash hypothesis algorithm!");
+
+    bound.npts = clus.size();
+
+    // Same parametrization as QLLMatch: position of the minimum-x point within the volume
+    double clus_xmin =  1.e20;
+    double clus_xmax = -1.e20;
+    for(auto const& pt : clus) {
+      clus_xmin = std::min(clus_xmin, pt.x);
+      clus_xmax = std::max(clus_xmax, pt.x);
+    }
+    double xmin = _vol_xmin - clus_xmin;
+    double xmax = _vol_xmax - clus_xmax;
+
+    _xoffset_v.clear();
+    size_t nstep = (xmax > xmin ? (size_t)(std::ceil((xmax - xmin) / _x_step)) : 0);
+    for(size_t i=0; i<nstep; ++i) _xoffset_v.push_back(xmin + i * _x_step);
+    _xoffset_v.push_back(std::max(xmin, xmax));
+
+    hypothesis->FillEstimateBatch(clus, _xoffset_v, _hypothesis_v);
+
+    bound.pe_min = bound.y_min = bound.z_min =  1.e20;
+    bound.pe_max = bound.y_max = bound.z_max = -1.e20;
+    for(auto const& flash : _hypothesis_v) {
+      double pe, y, z;
+      ComputeCentroid(flash.pe_v, pe, y, z);
+      bound.pe_min = std::min(bound.pe_min, pe);
+      bound.pe_max = std::max(bound.pe_max, pe);
+      if(pe <= 0.) continue;
+      bound.y_min = std::min(bound.y_min, y);
+      bound.y_max = std::max(bound.y_max, y);
+      bound.z_min = std::min(bound.z_min, z);
+      bound.z_max = std::max(bound.z_max, z);
+    }
+    FLASH_DEBUG() << "TPC object with " << clus.size() << " points: PE range "
+		  << bound.pe_min << " => " << bound.pe_max
+		  << " ... Y range " << bound.y_min << " => " << bound.y_max
+		  << " ... Z range " << bound.z_min << " => " << bound.z_max << std::endl;
+  }
+
+  void PEBoundCompatMatch::PrepareMatch(const QClusterArray_t& clus_v, const FlashArray_t& flash_v)
+  {
+    _bound_m.clear();
+    _flash_m.clear();
+    for(auto const& clus : clus_v) {
+      if(clus.empty()) continue;
+      ComputeBound(clus, _bound_m[&clus]);
+    }
+    for(auto const& flash : flash_v) {
+      auto& centroid = _flash_m[&flash];
+      ComputeCentroid(flash.pe_v, centroid.pe, centroid.y, centroid.z);
+    }
+  }
+
+  bool PEBoundCompatMatch::MatchCompatible(const QCluster_t& clus, const Flash_t& flash)
+  {
+    if(clus.empty()) return false;
+
+    ++_num_inspected;
+
+    // Use prepared values if available, else compute them now
+    auto bound_iter = _bound_m.find(&clus);
+    if(bound_iter == _bound_m.end() || (*bound_iter).second.npts != clus.size()) {
+      ComputeBound(clus, _bound_m[&clus]);
+      bound_iter = _bound_m.find(&clus);
+    }
+    auto const& bound = (*bound_iter).second;
+
+    Centroid_t centroid;
+    auto flash_iter = _flash_m.find(&flash);
+    if(flash_iter != _flash_m.end()) centroid = (*flash_iter).second;
+    else ComputeCentroid(flash.pe_v, centroid.pe, centroid.y, centroid.z);
+
+    if(centroid.pe > bound.pe_max * _pe_max_ratio ||
+       centroid.pe < bound.pe_min * _pe_min_ratio) {
+      ++_num_pruned_pe;
+      FLASH_DEBUG() << "Pruned: flash PE " << centroid.pe << " outside ["
+		    << bound.pe_min << "," << bound.pe_max << "]" << std::endl;
+      return false;
+    }
+
+    if(_centroid_tolerance >= 0. && centroid.pe > 0. && bound.pe_max > 0.) {
+      if(centroid.y < bound.y_min - _centroid_tolerance ||
+	 centroid.y > bound.y_max + _centroid_tolerance ||
+	 centroid.z < bound.z_min - _centroid_tolerance ||
+	 centroid.z > bound.z_max + _centroid_tolerance) {
+	++_num_pruned_centroid;
+	FLASH_DEBUG() << "Pruned: flash centroid (" << centroid.y << "," << centroid.z << ") outside Y ["
+		      << bound.y_min << "," << bound.y_max << "] Z ["
+		      << bound.z_min << "," << bound.z_max << "]" << std::endl;
+	return false;
+      }
+    }
+    return true;
+  }
+
+}
+#endif
@@ -0,0 +1,110 @@
+/**
+ * \file PEBoundCompatMatch.h
+ *
+ * \ingroup Algorithms
+ * 
+ * \brief Class def header for a class PEBoundCompatMatch
+ *
+ * @author kazuhiro
+ */
+
+/** \addtogroup Algorithms
+
+    @{*/
+#ifndef OPT0FINDER_PEBOUNDCOMPATMATCH_H
+#define OPT0FINDER_PEBOUNDCOMPATMATCH_H
+
+#include "flashmatch/Base/BaseProhibitAlgo.h"
+#include "flashmatch/Base/FlashProhibitFactory.h"
+#include <map>
+
+namespace flashmatch {
+  
+  /**
+     \class PEBoundCompatMatch
+     Cheap prefilter run before the match algorithm. For each TPC object, the flash hypothesis \n
+     is computed on a grid of x-offsets covering the allowed range (one FillEstimateBatch call), \n
+     giving the achievable total PE range and the range of the PE-weighted (y,z) centroid. \n
+     A flash whose total PE or centroid falls outside these ranges (with tolerances) cannot be \n
+     matched by any x-offset and the pair is rejected without running the minimizer.
+  */
+  class PEBoundCompatMatch : public BaseProhibitAlgo {
+    
+  public:
+    
+    /// Default constructor
+    PEBoundCompatMatch(const std::string name="PEBoundCompatMatch");
+    
+    /// Default destructor
+    ~PEBoundCompatMatch(){}
+
+    bool MatchCompatible(const QCluster_t& clus, const Flash_t& flash);
+
+    /// Computes the bounds of all TPC objects and the centroid of all flashes of an event
+    void PrepareMatch(const QClusterArray_t& clus_v, const FlashArray_t& flash_v);
+
+    /// Number of pairs inspected since the last reset
+    size_t NumInspected() const { return _num_inspected; }
+    /// Number of pairs rejected by the total PE range
+    size_t NumPrunedPE() const { return _num_pruned_pe; }
+    /// Number of pairs rejected by the centroid range
+    size_t NumPrunedCentroid() const { return _num_pruned_centroid; }
+    /// Reset the counters
+    void ResetCounters() { _num_inspected = _num_pruned_pe = _num_pruned_centroid = 0; }
+
+  protected:
+
+    void _Configure_(const Config_t &pset);
+
+  private:
+
+    /// Achievable hypothesis range of one TPC object
+    struct Bound_t {
+      size_t npts;
+      double pe_min, pe_max;
+      double y_min, y_max;
+      double z_min, z_max;
+    };
+
+    /// Total PE and PE-weighted centroid of a flash
+    struct Centroid_t {
+      double pe, y, z;
+    };
+
+    void ComputeBound(const QCluster_t& clus, Bound_t& bound);
+
+    void ComputeCentroid(const std::vector<double>& pe_v, double& pe, double& y, double& z) const;
+
+    double _x_step;             ///< x-offset grid step [cm]
+    double _pe_max_ratio;       ///< Reject if flash PE > pe_max * ratio
+    double _pe_min_ratio;       ///< Reject if flash PE < pe_min * ratio
+    double _centroid_tolerance; ///< Allowed centroid distance outside the range [cm] (<0 disables)
+    double _vol_xmin, _vol_xmax;
+
+    std::map<const QCluster_t*, Bound_t> _bound_m;  //!< Per-event TPC object bounds
+    std::map<const Flash_t*, Centroid_t> _flash_m;  //!< Per-event flash centroids
+    std::vector<double> _xoffset_v;   //!< Scratch: x-offset grid
+    std::vector<Flash_t> _hypothesis_v; //!< Scratch: hypotheses on the grid
+
+    size_t _num_inspected;
+    size_t _num_pruned_pe;
+    size_t _num_pruned_centroid;
+  };
+
+  /**
+     \class flashmatch::PEBoundCompatMatchFactory
+  */
+  class PEBoundCompatMatchFactory : public FlashProhibitFactoryBase {
+  public:
+    /// ctor
+    PEBoundCompatMatchFactory() { FlashProhibitFactory::get().add_factory("PEBoundCompatMatch",this); }
+    /// dtor
+    ~PEBoundCompatMatchFactory() {}
+    /// creation method
+    BaseProhibitAlgo* create(const std::string instance_name) { return new PEBoundCompatMatch(instance_name); }
+  };
+  
+}
+#endif
+/** @} */ // end of doxygen group 
+
@@ -5,9 +5,9 @@
 #include "flashmatch/Base/OpT0FinderException.h"
 #include "flashmatch/Base/FMWKInterface.h"
 #include <chrono>
+#include <algorithm>
 
 #include <omp.h>
-#define NUM_THREADS 4
 
 using namespace std::chrono;
 namespace flashmatch {
@@ -16,13 +16,27 @@ namespace flashmatch {
 
   PhotonLibHypothesis::PhotonLibHypothesis(const std::string name)
     : BaseFlashHypothesis(name)
+    , _num_threads(4)
+    , _min_parallel_voxels(64)
+    , _parallel_mode(kParallelPoint)
   {}
 
   void PhotonLibHypothesis::_Configure_(const Config_t &pset)
   {
-    omp_set_num_threads(NUM_THREADS);
     _global_qe = pset.get<double>("GlobalQE");
 
+    _num_threads         = pset.get<size_t>("NumThreads",4);
+    // MinParallelPoints: former name of the key (it counts binned voxels)
+    _min_parallel_voxels = pset.get<size_t>("MinParallelVoxels",
+					    pset.get<size_t>("MinParallelPoints",64));
+    auto const mode      = pset.get<std::string>("ParallelMode","Point");
+    if(mode == "Point") _parallel_mode = kParallelPoint;
+    else if(mode == "PMT") _parallel_mode = kParallelPMT;
+    else {
+      FLASH_CRITICAL() << "Unknown ParallelMode: " << mode << " (supported: Point, PMT)" << std::endl;
+      throw OpT0FinderException();
+    }
+
     _qe_v.clear();
     _qe_v = pset.get<std::vector<double> >("CCVCorrection",_qe_v);
     if(_qe_v.empty()) _qe_v.resize(DetectorSpecs::GetME().NOpDets(),1.0);
@@ -33,8 +47,53 @@ namespace flashmatch {
     }
   }
 
+  void PhotonLibHypothesis::CheckLibrary(const phot::PhotonLibraryView& lib_data, size_t n_pmt) const
+  {
+    if(lib_data.NOpChannels() != n_pmt) {
+      FLASH_CRITICAL() << "Photon library has " << lib_data.NOpChannels()
+		       << " channels != number of opdet (" << n_pmt << ")!" << std::endl;
+      throw OpT0FinderException();
+    }
+  }
+
+  size_t PhotonLibHypothesis::NumLevels() const
+  { return DetectorSpecs::GetME().NumLibraryLevels(); }
+
+  void PhotonLibHypothesis::BinCharge(const QCluster_t& trk,
+				      std::vector<std::pair<int,double> >& vox_q_v,
+				      size_t level,
+				      double xoffset) const
+  {
+    auto const& vox_def = DetectorSpecs::GetME().GetVoxelDef(level);
+    vox_q_v.clear();
+    // Points along a track are ordered, so points sharing a voxel come in a row
+    // (e.g. ~10 points per 5 cm voxel for 0.5 cm segments): merge each run into one entry.
+    for(auto const& pt : trk) {
+      int vox_id = vox_def.GetVoxelID(pt.x + xoffset,pt.y,pt.z);
+      if (vox_id < 0) continue;
+      if(!vox_q_v.empty() && vox_q_v.back().first == vox_id)
+	vox_q_v.back().second += pt.q;
+      else
+	vox_q_v.emplace_back(vox_id,pt.q);
+    }
+  }
+
   void PhotonLibHypothesis::FillEstimate(const QCluster_t& trk, Flash_t &flash) const
   {
+    FillShiftedEstimate(trk, 0., flash, 0);
+  }
+
+  void PhotonLibHypothesis::FillEstimateAtLevel(const QCluster_t& trk, Flash_t &flash, size_t level) const
+  {
+    FillShiftedEstimate(trk, 0., flash, level);
+  }
+
+  void PhotonLibHypothesis::FillShiftedEstimate(const QCluster_t& trk, const double xoffset,
+						Flash_t &flash, size_t level) const
+  {
+    if(level >= NumLevels())
+      throw OpT0FinderException("Photon library level " + std::to_string(level) + " is not configured!");
+
     size_t n_pmt = DetectorSpecs::GetME().NOpDets();//n_pmt returns 0 now, needs to be fixed
     if(flash.pe_v.empty()) flash.pe_v.resize(n_pmt);
     if(flash.pe_err_v.empty()) flash.pe_err_v.resize(n_pmt);
@@ -45,44 +104,177 @@ namespace flashmatch {
     for (auto& v : flash.pe_v     ) v = 0;
     for (auto& v : flash.pe_err_v ) v = 0;
 
-    auto det = DetectorSpecs::GetME();
-
-    auto const& lib_data = DetectorSpecs::GetME().GetPhotonLibraryData();
-
-    //start = high_resolution_clock::now();
-    #pragma omp parallel
-    {
-      size_t thread_id = omp_get_thread_num();
-      size_t num_threads = omp_get_num_threads();
-      size_t num_pts = trk.size() / num_threads;
-      size_t start_pt = num_pts * thread_id;
-      if(thread_id+1 == num_threads) num_pts += (trk.size() % num_threads);
-
-      auto const& vox_def = DetectorSpecs::GetME().GetVoxelDef();
-      // auto s = vox_def.GetVoxelSize();
-      // auto s1 = vox_def.GetRegionLowerCorner();
-      // auto s2 = vox_def.GetRegionUpperCorner();
-      // std::cout << s[0] << " " << s[1] << " " << s[2] << std::endl;
-      // std::cout << s1[0] << " " << s2[1] << " " << s1[2] << std::endl;
-      // std::cout << s2[0] << " " << s2[1] << " " << s2[2] << std::endl;
-      std::vector<double> local_pe_v(n_pmt,0);
-      int vox_id;
-      for( size_t ipt = start_pt; ipt < start_pt + num_pts; ++ipt) {
-	auto const& pt = trk[ipt];
-	vox_id = vox_def.GetVoxelID(pt.x,pt.y,pt.z);
-  if (vox_id < 0) continue;
-	auto const& vis_pmt = lib_data[vox_id];
-	for ( size_t ipmt = 0; ipmt < n_pmt; ++ipmt) {
-	  local_pe_v[ipmt] += pt.q * vis_pmt[ipmt];
-	}
+    auto const lib_data = DetectorSpecs::GetME().GetPhotonLibraryData(level);
+    CheckLibrary(lib_data, n_pmt);
+
+    // Charge binned per voxel: each library row is read and applied once.
+    // The buffer is kept per thread so that repeated calls do not allocate.
+    thread_local std::vector<std::pair<int,double> > thread_vox_q_v;
+    auto& vox_q_v = thread_vox_q_v; // thread_local names resolve per-thread inside omp regions
+    BinCharge(trk,vox_q_v,level,xoffset);
+
+    // Fork/join costs more than the work for small clusters, and nested regions (e.g. the
+    // manager evaluating pairs in parallel) would oversubscribe: use the serial path then.
+    int num_threads = (_num_threads ? (int)(_num_threads) : omp_get_max_threads());
+    if(num_threads <= 1 || vox_q_v.size() < _min_parallel_voxels || omp_in_parallel()) {
+      for(auto const& vox_q : vox_q_v)
+	lib_data[vox_q.first].MultiplyAccumulate(vox_q.second, flash.pe_v.data());
+    }
+    else if(_parallel_mode == kParallelPoint) {
+      // Each thread accumulates into its own row, rows are summed afterwards (no lock)
+      thread_local std::vector<double> thread_pe_v;
+      auto& local_pe_v = thread_pe_v;
+      local_pe_v.assign(num_threads * n_pmt, 0.);
+      #pragma omp parallel num_threads(num_threads)
+      {
+	double* thread_pe = &(local_pe_v[omp_get_thread_num() * n_pmt]);
+	#pragma omp for schedule(static)
+	for(size_t ivox = 0; ivox < vox_q_v.size(); ++ivox)
+	  lib_data[vox_q_v[ivox].first].MultiplyAccumulate(vox_q_v[ivox].second, thread_pe);
       }
-      #pragma omp critical
+      for(int thread_id = 0; thread_id < num_threads; ++thread_id)
+	for(size_t ipmt = 0; ipmt < n_pmt; ++ipmt)
+	  flash.pe_v[ipmt] += local_pe_v[thread_id * n_pmt + ipmt];
+    }
+    else {
+      // Each thread owns a set of PMTs (no reduction)
+      #pragma omp parallel for num_threads(num_threads) schedule(static)
       for(size_t ipmt = 0; ipmt < n_pmt; ++ipmt) {
-	flash.pe_v[ipmt] += local_pe_v[ipmt] * _global_qe / _qe_v[ipmt];
+	double pe = 0.;
+	for(auto const& vox_q : vox_q_v)
+	  pe += vox_q.second * lib_data[vox_q.first][ipmt];
+	flash.pe_v[ipmt] = pe;
       }
-
     }
+
+    for(size_t ipmt = 0; ipmt < n_pmt; ++ipmt)
+      flash.pe_v[ipmt] *= _global_qe / _qe_v[ipmt];
+
     return;
   }
+
+  void PhotonLibHypothesis::FillEstimateWithGradient(const QCluster_t& trk, const double xoffset,
+						     Flash_t& flash, Flash_t& grad) const
+  {
+    size_t n_pmt = DetectorSpecs::GetME().NOpDets();
+    flash.pe_v.assign(n_pmt,0.);
+    flash.pe_err_v.assign(n_pmt,0.);
+    grad.pe_v.assign(n_pmt,0.);
+
+    auto const  lib_data = DetectorSpecs::GetME().GetPhotonLibraryData();
+    auto const& vox_def  = DetectorSpecs::GetME().GetVoxelDef();
+    CheckLibrary(lib_data, n_pmt);
+    const int    nx = vox_def.GetSteps()[0];
+    const double dx = vox_def.GetVoxelSize()[0];
+
+    thread_local std::vector<std::pair<int,double> > thread_vox_q_v;
+    auto& vox_q_v = thread_vox_q_v;
+    BinCharge(trk,vox_q_v,0,xoffset);
+
+    // (voxel, charge weight, gradient weight): dV/dx at voxel i ~ (V[i+1] - V[i-1]) / 2dx
+    struct VoxelWeight_t { int vox; double q; double g; };
+    thread_local std::vector<VoxelWeight_t> thread_weight_v;
+    auto& weight_v = thread_weight_v;
+    weight_v.clear();
+    for(auto const& vox_q : vox_q_v) {
+      int vox = vox_q.first;
+      double q = vox_q.second;
+      weight_v.push_back(VoxelWeight_t{vox, q, 0.});
+      if(nx < 2) continue;
+      int ix = vox % nx;
+      int up = (ix + 1 < nx ? vox + 1 : vox);
+      int dn = (ix > 0 ? vox - 1 : vox);
+      double g = q / ((up - dn) * dx);
+      weight_v.push_back(VoxelWeight_t{up, 0., g});
+      weight_v.push_back(VoxelWeight_t{dn, 0., -g});
+    }
+    std::sort(weight_v.begin(), weight_v.end(),
+	      [](const VoxelWeight_t& a, const VoxelWeight_t& b) { return a.vox < b.vox; });
+
+    for(size_t i = 0; i < weight_v.size(); ) {
+      int vox = weight_v[i].vox;
+      double q = 0., g = 0.;
+      for(; i < weight_v.size() && weight_v[i].vox == vox; ++i) {
+	q += weight_v[i].q;
+	g += weight_v[i].g;
+      }
+      auto const row = lib_data[vox];
+      if(q != 0.) row.MultiplyAccumulate(q, flash.pe_v.data());
+      if(g != 0.) row.MultiplyAccumulate(g, grad.pe_v.data());
+    }
+
+    for(size_t ipmt = 0; ipmt < n_pmt; ++ipmt) {
+      flash.pe_v[ipmt] *= _global_qe / _qe_v[ipmt];
+      grad.pe_v[ipmt]  *= _global_qe / _qe_v[ipmt];
+    }
+  }
+
+  void PhotonLibHypothesis::FillEstimateBatch(const QCluster_t& trk,
+					      const std::vector<double>& xoffset_v,
+					      std::vector<Flash_t>& flash_v) const
+  {
+    size_t n_pmt = DetectorSpecs::GetME().NOpDets();
+    flash_v.resize(xoffset_v.size());
+
+    auto const  lib_data = DetectorSpecs::GetME().GetPhotonLibraryData();
+    auto const& vox_def  = DetectorSpecs::GetME().GetVoxelDef();
+    CheckLibrary(lib_data, n_pmt);
+    auto const  lower    = vox_def.GetRegionLowerCorner();
+    auto const  upper    = vox_def.GetRegionUpperCorner();
+    int nx = vox_def.GetSteps()[0];
+    int ny = vox_def.GetSteps()[1];
+    int nz = vox_def.GetSteps()[2];
+
+    // y/z voxel indices do not depend on the x-offset: compute them once per point.
+    // Points are then ordered by (y,z) cell and x so that, for any offset, points sharing
+    // a voxel are contiguous and their charge is summed before reading the library.
+    // The buffer is kept per thread (shared by the omp threads below through the reference).
+    struct CellPoint_t { int base; double x; double q; };
+    thread_local std::vector<CellPoint_t> thread_cell_pt_v;
+    auto& cell_pt_v = thread_cell_pt_v;
+    cell_pt_v.clear();
+    for(auto const& pt : trk) {
+      // same arithmetic as sim::PhotonVoxelDef::GetVoxelID
+      int ystep = int ((pt.y-lower[1]) / (upper[1]-lower[1]) * ny );
+      int zstep = int ((pt.z-lower[2]) / (upper[2]-lower[2]) * nz );
+      if(ystep < 0 || ystep >= ny || zstep < 0 || zstep >= nz) continue;
+      cell_pt_v.push_back(CellPoint_t{ystep * nx + zstep * (nx * ny), pt.x, pt.q});
+    }
+    std::sort(cell_pt_v.begin(), cell_pt_v.end(),
+	      [](const CellPoint_t& a, const CellPoint_t& b)
+	      { return (a.base < b.base || (a.base == b.base && a.x < b.x)); });
+
+    int num_threads = (_num_threads ? (int)(_num_threads) : omp_get_max_threads());
+    if(omp_in_parallel()) num_threads = 1;
+
+    #pragma omp parallel for num_threads(num_threads) schedule(static) if(num_threads > 1 && xoffset_v.size() > 1)
+    for(size_t ioff = 0; ioff < xoffset_v.size(); ++ioff) {
+      auto& flash = flash_v[ioff];
+      flash.pe_v.assign(n_pmt,0.);
+      flash.pe_err_v.assign(n_pmt,0.);
+      double xoffset = xoffset_v[ioff];
+
+      int    last_vox = -1;
+      double last_q   = 0.;
+      for(size_t ipt = 0; ipt <= cell_pt_v.size(); ++ipt) {
+	int vox_id = -1;
+	if(ipt < cell_pt_v.size()) {
+	  auto const& pt = cell_pt_v[ipt];
+	  int xstep = int ((pt.x + xoffset - lower[0]) / (upper[0]-lower[0]) * nx );
+	  if(xstep < 0 || xstep >= nx) continue;
+	  vox_id = pt.base + xstep;
+	  if(vox_id == last_vox) { last_q += pt.q; continue; }
+	}
+	// Flush the charge accumulated in the previous voxel
+	if(last_vox >= 0)
+	  lib_data[last_vox].MultiplyAccumulate(last_q, flash.pe_v.data());
+	last_vox = vox_id;
+	if(ipt < cell_pt_v.size()) last_q = cell_pt_v[ipt].q;
+      }
+
+      for(size_t ipmt = 0; ipmt < n_pmt; ++ipmt)
+	flash.pe_v[ipmt] *= _global_qe / _qe_v[ipmt];
+    }
+  }
 }
 #endif
@@ -16,6 +16,7 @@
 #define PHOTONLIBHYPOTHESIS_H
 
 #include <iostream>
+#include <utility>
 #include "flashmatch/Base/BaseFlashHypothesis.h"
 #include "flashmatch/Base/FlashHypothesisFactory.h"
 
@@ -34,15 +35,54 @@ namespace flashmatch {
     /// Default destructor
     virtual ~PhotonLibHypothesis(){}
 
+    enum ParallelMode_t { kParallelPoint, kParallelPMT };
+
     void FillEstimate(const QCluster_t&, Flash_t&) const;
 
+    /// One level per photon library resolution (see PhotonLibraryLevels in DetectorSpecs)
+    size_t NumLevels() const;
+
+    /// Estimate from the photon library of a given resolution level (0 = full resolution)
+    void FillEstimateAtLevel(const QCluster_t&, Flash_t&, size_t level) const;
+
+    /// Estimate for the cluster shifted along x: the shift is applied in the voxel look-up
+    void FillShiftedEstimate(const QCluster_t&, const double xoffset, Flash_t&, size_t level=0) const;
+
+    /// Charge summed per voxel (voxel id, q) of a library level for the cluster shifted by xoffset:
+    /// consecutive points in the same voxel are merged
+    void BinCharge(const QCluster_t&, std::vector<std::pair<int,double> >&, size_t level=0, double xoffset=0.) const;
+
+    /// Hypotheses for many x-offsets, sharing the y/z voxel look-up and charge binning
+    void FillEstimateBatch(const QCluster_t&, const std::vector<double>&, std::vector<Flash_t>&) const;
+
+    /// The estimate only depends on the voxel of each point (see LibraryVoxelKey)
+    bool ShiftKey(const QCluster_t& trk, const double xoffset, long& key) const
+    { key = LibraryVoxelKey(trk, xoffset); return true; }
+
+    /// x derivative from the difference of the adjacent x-voxels
+    bool HasGradient() const { return true; }
+
+    /**
+       Estimate and its x derivative: each binned voxel also contributes its charge times the \n
+       central difference of its two x-neighbours (one-sided at the grid edges). The weights \n
+       are merged per voxel so that each library row is read once for both.
+    */
+    void FillEstimateWithGradient(const QCluster_t&, const double xoffset, Flash_t&, Flash_t&) const;
+
   protected:
 
     void _Configure_(const Config_t &pset);
 
+    /// Throws if the library rows do not have one entry per opdet
+    void CheckLibrary(const phot::PhotonLibraryView& lib_data, size_t n_pmt) const;
+
     double _global_qe;             ///< Global QE
     double _sigma_qe;              ///< Sigma for Gaussian centered on Global QE
     std::vector<double> _qe_v;     ///< PMT-wise relative QE
+
+    size_t _num_threads;           ///< Threads for FillEstimate (0 = OpenMP default)
+    size_t _min_parallel_voxels;   ///< Clusters binned into fewer voxels are processed serially
+    ParallelMode_t _parallel_mode; ///< Split the work by point or by PMT
   };
 
   /**
@@ -7,25 +7,61 @@
 #include <TMinuit.h>
 #include <cmath>
 #include <numeric>
-#include <TMath.h>
 #include <cassert>
 #include <chrono>
 #include <climits>
+#include <limits>
+#include <algorithm>
 using namespace std::chrono;
 namespace flashmatch {
 
   static QLLMatchFactory __global_QLLMatchFactory__;
 
-  QLLMatch *QLLMatch::_me = nullptr;
-
-  void MIN_vtx_qll(Int_t &, Double_t *, Double_t &, Double_t *, Int_t);
+  /**
+     TMinuit whose function evaluation is forwarded to QLLMatch::Evaluate with a given context. \n
+     This replaces the global FCN (which required a singleton) so each context has its own minimizer.
+  */
+  class QLLMinuit : public TMinuit {
+  public:
+    QLLMinuit(const QLLMatch* algo, QLLMatchContext* ctx)
+      : TMinuit(4), _algo(algo), _ctx(ctx)
+    {}
+    Int_t Eval(Int_t /*npar*/, Double_t *grad, Double_t &fval, Double_t *par, Int_t flag)
+    {
+      // flag 2: derivatives requested (only after SET GRAD, see QLLMatch::CallMinuit)
+      if(flag == 2 && grad)
+	fval = _algo->EvaluateWithGradient(*_ctx, par[0], grad[0]);
+      else
+	fval = _algo->Evaluate(*_ctx, par[0]);
+      return 0;
+    }
+  private:
+    const QLLMatch* _algo;
+    QLLMatchContext* _ctx;
+  };
+
+  QLLMatchContext::QLLMatchContext()
+    : _flash_ctx(nullptr)
+    , _store_cluster_id(kINVALID_ID)
+    , _level(0)
+    , _current_chi2(-1.0)
+    , _current_llhd(-1.0)
+    , _reco_x_offset(0.)
+    , _reco_x_offset_err(0.)
+    , _qll(0.)
+    , _converged(false)
+    , _num_steps(0)
+    , _minuit_ptr(nullptr)
+  {}
+
+  QLLMatchContext::~QLLMatchContext()
+  { if(_minuit_ptr) delete _minuit_ptr; }
 
   QLLMatch::QLLMatch(const std::string name)
-    : BaseFlashMatch(name), _mode(kChi2), _record(false), _normalize(false), _minuit_ptr(nullptr)
-  { _current_llhd = _current_chi2 = -1.0; }
-
-  QLLMatch::QLLMatch()
-  { throw OpT0FinderException("Use QLLMatch::GetME() to obtain singleton pointer!"); }
+    : BaseFlashMatch(name), _mode(kChi2), _minimizer(kMIGRAD), _record(false), _normalize(false)
+    , _use_gradient(false)
+    , _hypothesis_cache_size(0)
+  {}
 
   void QLLMatch::_Configure_(const Config_t &pset) {
     _record = pset.get<bool>("RecordHistory");
@@ -34,6 +70,32 @@ namespace flashmatch {
     _pe_observation_threshold = pset.get<double>("PEObservationThreshold", 0.0);
     _pe_hypothesis_threshold  = pset.get<double>("PEHypothesisThreshold", 0.0);
     _migrad_tolerance         = pset.get<double>("MIGRADTolerance", 0.1);
+    _use_gradient             = pset.get<bool>("UseGradient", false);
+
+    // Coarse-to-fine MIGRAD: one pass per level, each starting from the previous result
+    _level_schedule_v = pset.get<std::vector<size_t> >("LevelSchedule", std::vector<size_t>());
+    if(_level_schedule_v.empty()) _level_schedule_v.push_back(0);
+    if(_level_schedule_v.back() != 0) {
+      FLASH_CRITICAL() << "LevelSchedule must end with the full resolution level 0!" << std::endl;
+      throw OpT0FinderException();
+    }
+
+    auto const minimizer = pset.get<std::string>("Minimizer", "MIGRAD");
+    if(minimizer == "MIGRAD") _minimizer = kMIGRAD;
+    else if(minimizer == "GridScan") _minimizer = kGridScan;
+    else {
+      FLASH_CRITICAL() << "Unknown Minimizer: " << minimizer << " (supported: MIGRAD, GridScan)" << std::endl;
+      throw OpT0FinderException();
+    }
+    _grid_scan_step      = pset.get<double>("GridScanStep", -1.);
+    _grid_scan_tolerance = pset.get<double>("GridScanTolerance", 0.1);
+    if(_grid_scan_step <= 0.)
+      _grid_scan_step = DetectorSpecs::GetME().GetVoxelDef().GetVoxelSize()[0];
+    if(_grid_scan_tolerance <= 0.)
+      throw OpT0FinderException("GridScanTolerance must be positive!");
+
+    // Hypothesis cache: offsets with the same key of the hypothesis algorithm share an entry
+    _hypothesis_cache_size = pset.get<size_t>("HypothesisCacheSize", 0);
 
     _penalty_threshold_v = pset.get<std::vector<double> >("PEPenaltyThreshold");
     _penalty_value_v = pset.get<std::vector<double> >("PEPenaltyValue");
@@ -60,33 +122,105 @@ namespace flashmatch {
     _vol_xmin = bbox.Min()[0];
   }
 
+  size_t QLLMatch::NumContexts() const
+  {
+    std::lock_guard<std::mutex> lock(_context_mutex);
+    return _context_v.size();
+  }
+
+  QLLMatchContext* QLLMatch::AcquireContext()
+  {
+    std::lock_guard<std::mutex> lock(_context_mutex);
+    if(_idle_context_v.empty()) {
+      // Contexts (and their TMinuit) are created under the lock: TMinuit construction touches ROOT globals
+      _context_v.emplace_back(new QLLMatchContext);
+      _idle_context_v.push_back(_context_v.back().get());
+      FLASH_INFO() << "Created minimization context #" << _context_v.size() << std::endl;
+    }
+    auto ctx = _idle_context_v.back();
+    _idle_context_v.pop_back();
+    return ctx;
+  }
+
+  void QLLMatch::ReleaseContext(QLLMatchContext* ctx)
+  {
+    std::lock_guard<std::mutex> lock(_context_mutex);
+    if(_record) {
+      _minimizer_record_chi2_v = ctx->_minimizer_record_chi2_v;
+      _minimizer_record_llhd_v = ctx->_minimizer_record_llhd_v;
+      _minimizer_record_x_v    = ctx->_minimizer_record_x_v;
+    }
+    _idle_context_v.push_back(ctx);
+  }
+
   FlashMatch_t QLLMatch::Match(const QCluster_t &pt_v, const Flash_t &flash) {
 
+    auto ctx = AcquireContext();
+    FlashMatch_t res;
+    try {
+      res = Match(*ctx, pt_v, flash);
+    }
+    catch(...) {
+      ReleaseContext(ctx);
+      throw;
+    }
+    ReleaseContext(ctx);
+    return res;
+  }
+
+  FlashMatch_t QLLMatch::Match(QLLMatchContext& ctx, const QCluster_t &pt_v, const Flash_t &flash) const {
+
     //
     // Prepare TPC
     //
-    _raw_trk.resize(pt_v.size());
+    ctx._raw_trk.resize(pt_v.size());
     double min_x =  1e20;
     double max_x = -1e20;
     for (size_t i = 0; i < pt_v.size(); ++i) {
       auto const &pt = pt_v[i];
-      _raw_trk[i] = pt;
-      if (pt.x < min_x) { min_x = pt.x; _raw_xmin_pt = pt; }
-      if (pt.x > max_x) { max_x = pt.x; _raw_xmax_pt = pt; }
+      ctx._raw_trk[i] = pt;
+      if (pt.x < min_x) { min_x = pt.x; ctx._raw_xmin_pt = pt; }
+      if (pt.x > max_x) { max_x = pt.x; ctx._raw_xmax_pt = pt; }
     }
-    for (auto &pt : _raw_trk) pt.x -= min_x;
+    for (auto &pt : ctx._raw_trk) pt.x -= min_x;
+
+    // Hypotheses shared with other flashes through the manager's store (if this cluster is registered)
+    auto store = GetHypothesisStore();
+    ctx._store_cluster_id = (store ? store->ClusterID(pt_v) : kINVALID_ID);
 
-    auto res1 = PESpectrumMatch(pt_v,flash,true);
-    auto res2 = PESpectrumMatch(pt_v,flash,false);
-    FLASH_INFO() << "Using   mid-x-init ... maximized 1/param Score=" << res1.score << " @ X=" << res1.tpc_point.x << " [cm]" << std::endl;
-    FLASH_INFO() << "Without mid-x-init ... maximized 1/param Score=" << res2.score << " @ X=" << res2.tpc_point.x << " [cm]" << std::endl;
+    // New cluster: previously cached hypotheses are invalid
+    auto& cache = ctx._hypothesis_cache;
+    if(cache.Capacity() != _hypothesis_cache_size)
+      cache.Configure(_hypothesis_cache_size);
+    cache.Clear();
+    cache.ResetStats();
+
+    FlashMatch_t res;
+    if(_minimizer == kGridScan) {
+      // The scan covers the whole range: no need for a second starting point
+      res = PESpectrumMatch(ctx,pt_v,flash,true);
+      FLASH_INFO() << "Grid scan ... maximized 1/param Score=" << res.score << " @ X=" << res.tpc_point.x << " [cm]"
+		   << " (" << res.num_steps << " evaluations)" << std::endl;
+    }
+    else {
+      auto res1 = PESpectrumMatch(ctx,pt_v,flash,true);
+      auto res2 = PESpectrumMatch(ctx,pt_v,flash,false);
+      FLASH_INFO() << "Using   mid-x-init ... maximized 1/param Score=" << res1.score << " @ X=" << res1.tpc_point.x << " [cm]" << std::endl;
+      FLASH_INFO() << "Without mid-x-init ... maximized 1/param Score=" << res2.score << " @ X=" << res2.tpc_point.x << " [cm]" << std::endl;
+      res = (res1.score > res2.score ? res1 : res2);
+      // Report the function evaluations of both passes
+      res.num_steps = res1.num_steps + res2.num_steps;
+    }
+    if(cache.Enabled())
+      FLASH_INFO() << "Hypothesis cache: " << cache.NumHits() << " hits / "
+		   << cache.NumMisses() << " misses ("
+		   << cache.NumEvictions() << " evictions)" << std::endl;
 
-    auto res = (res1.score > res2.score ? res1 : res2);
     /*
     if(res.score < _onepmt_score_threshold) {
 
       FLASH_INFO() << "Resulting score below OnePMTScoreThreshold... calling OnePMTMatch" << std::endl;
-      auto res_onepmt = OnePMTMatch(flash);
+      auto res_onepmt = OnePMTMatch(ctx,flash);
 
       if(res_onepmt.score >= 0.)
 	return res_onepmt;
@@ -95,7 +229,7 @@ namespace flashmatch {
     return res;
   }
 
-  FlashMatch_t QLLMatch::OnePMTMatch(const Flash_t& flash) {
+  FlashMatch_t QLLMatch::OnePMTMatch(QLLMatchContext& ctx, const Flash_t& flash) const {
 
     FlashMatch_t res;
     res.score=-1;
@@ -121,57 +255,57 @@ namespace flashmatch {
     }
 
     // Now see if Flash T0 can be consistent with an assumption MinX @ X=0.
-    double xdiff = fabs(_raw_xmin_pt.x - flash.time * DetectorSpecs::GetME().DriftVelocity());
+    double xdiff = fabs(ctx._raw_xmin_pt.x - flash.time * DetectorSpecs::GetME().DriftVelocity());
     if( xdiff > _onepmt_xdiff_threshold ) {
       //std::cout << "XDiffThreshold not met (xdiff=" << xdiff << ")" << std::endl;
       return res;
     }
 
     // Reaching this point means it is an acceptable match
-    _reco_x_offset = 0.;
-    _reco_x_offset_err = std::fabs(_xpos_v.at(maxpmt));
+    ctx._reco_x_offset = 0.;
+    ctx._reco_x_offset_err = std::fabs(_xpos_v.at(maxpmt));
 
     // Compute hypothesis with MinX @ X=0 assumption.
-    _hypothesis = flash;
-    FillEstimate(_raw_trk,_hypothesis);
-    res.hypothesis = _hypothesis.pe_v;
+    ctx._hypothesis = flash;
+    FillEstimate(ctx._raw_trk,ctx._hypothesis);
+    res.hypothesis = ctx._hypothesis.pe_v;
 
     // Compute TPC point
     res.tpc_point.x = res.tpc_point.y = res.tpc_point.z = 0;
     double weight = 0;
     for (size_t pmt_index = 0; pmt_index < DetectorSpecs::GetME().NOpDets(); ++pmt_index) {
 
-      res.tpc_point.y += _ypos_v.at(pmt_index) * _hypothesis.pe_v[pmt_index];
-      res.tpc_point.z += _zpos_v.at(pmt_index) * _hypothesis.pe_v[pmt_index];
+      res.tpc_point.y += _ypos_v.at(pmt_index) * ctx._hypothesis.pe_v[pmt_index];
+      res.tpc_point.z += _zpos_v.at(pmt_index) * ctx._hypothesis.pe_v[pmt_index];
 
-      weight += _hypothesis.pe_v[pmt_index];
+      weight += ctx._hypothesis.pe_v[pmt_index];
     }
 
     res.tpc_point.y /= weight;
     res.tpc_point.z /= weight;
 
-    res.tpc_point.x = _reco_x_offset;
-    res.tpc_point_err.x = _reco_x_offset_err;
+    res.tpc_point.x = ctx._reco_x_offset;
+    res.tpc_point_err.x = ctx._reco_x_offset_err;
 
     // Use MinX point YZ distance to the max PMT and X0 diff as weight
     res.score = 1.;
     // FIXME For now we do not have time distribution, so ignore this weighting
     //res.score *= 1. / xdiff;
-    res.score *= 1. / (sqrt(pow(_raw_xmin_pt.y - _ypos_v.at(maxpmt),2) + pow(_raw_xmin_pt.z - _zpos_v.at(maxpmt),2)));
+    res.score *= 1. / (sqrt(pow(ctx._raw_xmin_pt.y - _ypos_v.at(maxpmt),2) + pow(ctx._raw_xmin_pt.z - _zpos_v.at(maxpmt),2)));
 
     return res;
 
   }
 
-  FlashMatch_t QLLMatch::PESpectrumMatch(const QCluster_t &pt_v, const Flash_t &flash, const bool init_x0) {
+  FlashMatch_t QLLMatch::PESpectrumMatch(QLLMatchContext& ctx, const QCluster_t &pt_v, const Flash_t &flash, const bool init_x0) const {
 
-    this->CallMinuit(pt_v, flash, init_x0);
+    this->CallMinuit(ctx, pt_v, flash, init_x0);
     // Shit happens line above in CallMinuit
 
     // Estimate position
     FlashMatch_t res;
-    res.num_steps = _num_steps;
-    if (std::isnan(_qll)) return res;
+    res.num_steps = ctx._num_steps;
+    if (std::isnan(ctx._qll)) return res;
 
     res.tpc_point.x = res.tpc_point.y = res.tpc_point.z = 0;
 
@@ -179,33 +313,33 @@ namespace flashmatch {
 
     for (size_t pmt_index = 0; pmt_index < DetectorSpecs::GetME().NOpDets(); ++pmt_index) {
 
-      res.tpc_point.y += _ypos_v.at(pmt_index) * _hypothesis.pe_v[pmt_index];
-      res.tpc_point.z += _zpos_v.at(pmt_index) * _hypothesis.pe_v[pmt_index];
+      res.tpc_point.y += _ypos_v.at(pmt_index) * ctx._hypothesis.pe_v[pmt_index];
+      res.tpc_point.z += _zpos_v.at(pmt_index) * ctx._hypothesis.pe_v[pmt_index];
 
-      weight += _hypothesis.pe_v[pmt_index];
+      weight += ctx._hypothesis.pe_v[pmt_index];
     }
 
     res.tpc_point.y /= weight;
     res.tpc_point.z /= weight;
 
-    res.tpc_point.x = _reco_x_offset;
-    res.tpc_point_err.x = _reco_x_offset_err;
+    res.tpc_point.x = ctx._reco_x_offset;
+    res.tpc_point_err.x = ctx._reco_x_offset_err;
 
-    res.hypothesis  = _hypothesis.pe_v;
+    res.hypothesis  = ctx._hypothesis.pe_v;
 
     //
     // Compute score
     //
     if(_mode == kSimpleLLHD)
-      res.score = _qll * -1.;
+      res.score = ctx._qll * -1.;
     else
-      res.score = 1. / _qll;
+      res.score = 1. / ctx._qll;
 
     // Compute X-weighting
     /*
-    double x0 = _raw_xmin_pt.x - flash.time * DetectorSpecs::GetME().DriftVelocity();
-    if( fabs(_reco_x_offset - x0) > _recox_penalty_threshold )
-      res.score *= 1. / (1. + fabs(_reco_x_offset - x0) - _recox_penalty_threshold);
+    double x0 = ctx._raw_xmin_pt.x - flash.time * DetectorSpecs::GetME().DriftVelocity();
+    if( fabs(ctx._reco_x_offset - x0) > _recox_penalty_threshold )
+      res.score *= 1. / (1. + fabs(ctx._reco_x_offset - x0) - _recox_penalty_threshold);
     // Compute Z-weighting
     double z0 = 0;
     weight = 0;
@@ -220,219 +354,311 @@ namespace flashmatch {
     return res;
   }
 
-  const Flash_t &QLLMatch::ChargeHypothesis(const double xoffset) {
-    //auto start = high_resolution_clock::now();
-    if (_hypothesis.pe_v.empty()) _hypothesis.pe_v.resize(DetectorSpecs::GetME().NOpDets(), 0.);
-    if (_hypothesis.pe_v.size() != DetectorSpecs::GetME().NOpDets()) {
+  const Flash_t &QLLMatch::ChargeHypothesis(QLLMatchContext& ctx, const double xoffset) const {
+    auto& hypothesis = ctx._hypothesis;
+    auto& cache = ctx._hypothesis_cache;
+    if (hypothesis.pe_v.empty()) hypothesis.pe_v.resize(DetectorSpecs::GetME().NOpDets(), 0.);
+    if (hypothesis.pe_v.size() != DetectorSpecs::GetME().NOpDets()) {
       throw OpT0FinderException("Hypothesis vector length != PMT count");
     }
 
-    for (auto &v : _hypothesis.pe_v) v = 0;
+    // Coarse-level hypotheses are computed on the fly: the cache and the store hold level 0 only
+    if (ctx._level) {
+      FillShiftedEstimate(ctx._raw_trk, xoffset, hypothesis, ctx._level);
+      if (_normalize) NormalizeHypothesis(hypothesis);
+      return hypothesis;
+    }
+
+    auto store = GetHypothesisStore();
+    bool use_store = (store && ctx._store_cluster_id != kINVALID_ID);
+    bool use_cache = cache.Enabled();
+    // Hypotheses are reused only for offsets with the same key, i.e. they are identical to the
+    // one computed at xoffset. Without a key (e.g. continuous in x) nothing is reused.
+    long key = 0;
+    if ((use_cache || use_store) && !HypothesisShiftKey(ctx._raw_trk, xoffset, key))
+      use_cache = use_store = false;
+    const std::vector<double>* cached = (use_cache ? cache.Find(key) : nullptr);
+
+    if (cached) {
+      for (size_t pmt = 0; pmt < hypothesis.pe_v.size(); ++pmt)
+	hypothesis.pe_v[pmt] = (*cached)[pmt];
+    }
+    else if (use_store && store->Find(ctx._store_cluster_id, key, hypothesis.pe_v)) {
+      if (use_cache) cache.Insert(key, hypothesis.pe_v);
+    }
+    else {
+      for (auto &v : hypothesis.pe_v) v = 0;
+
+      // The hypothesis algorithm applies the x-offset (no shifted copy of the cluster)
+      FillShiftedEstimate(ctx._raw_trk, xoffset, hypothesis);
+
+      if (use_cache) cache.Insert(key, hypothesis.pe_v);
+      if (use_store) store->Insert(ctx._store_cluster_id, key, hypothesis.pe_v);
+    }
+
+    if (_normalize) NormalizeHypothesis(hypothesis);
+
+    return hypothesis;
+  }
+
+  void QLLMatch::NormalizeHypothesis(Flash_t& hypothesis) const
+  {
+    double qsum = std::accumulate(std::begin(hypothesis.pe_v),
+				  std::end(hypothesis.pe_v),
+				  0.0);
+    for (auto &v : hypothesis.pe_v) v /= qsum;
+  }
+
+  void QLLMatch::PrepareMatch(const QClusterArray_t&, const FlashArray_t& flash_v)
+  {
+    _flash_ctx_m.clear();
+    _flash_ctx_v.resize(flash_v.size());
+    for(size_t i=0; i<flash_v.size(); ++i) {
+      BuildFlashContext(flash_v[i], _flash_ctx_v[i]);
+      _flash_ctx_m[&(flash_v[i])] = i;
+    }
+  }
+
+  void QLLMatch::BuildFlashContext(const Flash_t& flash, QLLFlashContext& flash_ctx) const
+  {
+    size_t n_pmt = DetectorSpecs::GetME().NOpDets();
+    if (flash.pe_v.size() != n_pmt) {
+      std::cout << n_pmt << " " << flash.pe_v.size() << std::endl;
+      throw OpT0FinderException("PMT dimension has changed!");
+    }
 
-    // Apply xoffset
-    _var_trk.resize(_raw_trk.size());
-    for (size_t pt_index = 0; pt_index < _raw_trk.size(); ++pt_index) {
-      //std::cout << "x point : " << _raw_trk[pt_index].x << "\t offset : " << xoffset << std::endl;
-      _var_trk[pt_index].x = _raw_trk[pt_index].x + xoffset;
-      _var_trk[pt_index].y = _raw_trk[pt_index].y;
-      _var_trk[pt_index].z = _raw_trk[pt_index].z;
-      _var_trk[pt_index].q = _raw_trk[pt_index].q;
+    if (!_penalty_threshold_v.empty() && _penalty_threshold_v.size() != n_pmt) {
+      throw OpT0FinderException("Penalty threshold array has a different size than PMT array size!");
     }
-    //auto end = high_resolution_clock::now();
-    //auto duration = duration_cast<microseconds>(end - start);
-    //std::cout << "Duration ChargeHypothesis 1 = " << duration.count() << "us" << std::endl;
 
+    if (!_penalty_value_v.empty() && _penalty_value_v.size() != n_pmt) {
+      throw OpT0FinderException("Penalty value array has a different size than PMT array size!");
+    }
 
-    //start = high_resolution_clock::now();
-    FillEstimate(_var_trk, _hypothesis);
-    //end = high_resolution_clock::now();
-    //duration = duration_cast<microseconds>(end - start);
-    //std::cout << "Duration ChargeHypothesis 2 = " << duration.count() << "us" << std::endl;
+    flash_ctx._raw_pe_v = flash.pe_v;
 
-    //start = high_resolution_clock::now();
+    double max_pe = 1.;
     if (_normalize) {
-      double qsum = std::accumulate(std::begin(_hypothesis.pe_v),
-				    std::end(_hypothesis.pe_v),
-				    0.0);
-      for (auto &v : _hypothesis.pe_v) v /= qsum;
+      max_pe = 0;
+      for (auto const &v : flash.pe_v) if (v > max_pe) max_pe = v;
+    }
+    flash_ctx._measurement.pe_v.resize(n_pmt);
+    for (size_t i = 0; i < n_pmt; ++i) flash_ctx._measurement.pe_v[i] = flash.pe_v[i] / max_pe;
+
+    flash_ctx._obs_v.resize(n_pmt);
+    flash_ctx._lgamma_v.resize(n_pmt);
+    flash_ctx._error_v.resize(n_pmt);
+    flash_ctx._h_penalty_v.resize(n_pmt);
+    flash_ctx._active_v.clear();
+    flash_ctx._zero_v.clear();
+    for (size_t pmt_index = 0; pmt_index < n_pmt; ++pmt_index) {
+      double O = flash_ctx._measurement.pe_v[pmt_index];
+      if (O < 0) {
+	if (!_penalty_value_v.empty()) O = _penalty_value_v[pmt_index];
+	else O = _pe_observation_threshold;
+      }
+      flash_ctx._obs_v[pmt_index]    = O;
+      flash_ctx._lgamma_v[pmt_index] = std::lgamma(O + 1.);
+      flash_ctx._error_v[pmt_index]  = (O < 1.0 ? 1.0 : O);
+      flash_ctx._h_penalty_v[pmt_index] = (_penalty_threshold_v.empty() ? _pe_hypothesis_threshold : _penalty_threshold_v[pmt_index]);
+      if (O > 0) flash_ctx._active_v.push_back(pmt_index);
+      else flash_ctx._zero_v.push_back(pmt_index);
     }
-    //end = high_resolution_clock::now();
-    //duration = duration_cast<microseconds>(end - start);
-    //std::cout << "Duration ChargeHypothesis 3 = " << duration.count() << "us" << std::endl;
+  }
 
-    return _hypothesis;
+  const QLLFlashContext& QLLMatch::GetFlashContext(QLLMatchContext& ctx, const Flash_t& flash) const
+  {
+    // Use the prepared context only if it still describes this flash
+    auto iter = _flash_ctx_m.find(&flash);
+    if (iter != _flash_ctx_m.end() && _flash_ctx_v[(*iter).second]._raw_pe_v == flash.pe_v)
+      return _flash_ctx_v[(*iter).second];
+
+    if (ctx._flash_ctx != &(ctx._local_flash_ctx) || ctx._local_flash_ctx._raw_pe_v != flash.pe_v)
+      BuildFlashContext(flash, ctx._local_flash_ctx);
+    return ctx._local_flash_ctx;
   }
 
-  const Flash_t &QLLMatch::Measurement() const { return _measurement; }
+  double QLLMatch::QLL(QLLMatchContext& ctx,
+		       const Flash_t &hypothesis,
+		       const QLLFlashContext &flash_ctx,
+		       const Flash_t *gradient,
+		       double *derivative) const {
 
-  double QLLMatch::QLL(const Flash_t &hypothesis,
-		       const Flash_t &measurement) {
+    // ln(x) range where exp(x) is a finite, non-zero double (i.e. a usable Poisson probability)
+    static const double kMinLogP = std::log(std::numeric_limits<double>::denorm_min());
+    static const double kMaxLogP = std::log(std::numeric_limits<double>::max());
+    static const double kLn10    = std::log(10.);
 
     double nvalid_pmt = 0;
 
-    double PEtot_Hyp = 0;
-    for (auto const &pe : hypothesis.pe_v)
-      PEtot_Hyp += pe;
-    double PEtot_Obs = 0;
-    for (auto const &pe : measurement.pe_v)
-      PEtot_Obs += pe;
-
-    _current_chi2 = _current_llhd = 0.;
+    ctx._current_chi2 = ctx._current_llhd = 0.;
 
-    if (measurement.pe_v.size() != hypothesis.pe_v.size())
+    if (flash_ctx._obs_v.size() != hypothesis.pe_v.size())
       throw OpT0FinderException("Cannot compute QLL for unmatched length!");
 
-    double O, H, Error;
+    auto const& obs_v = flash_ctx._obs_v;
+    auto const& pe_v  = hypothesis.pe_v;
 
-    for (size_t pmt_index = 0; pmt_index < hypothesis.pe_v.size(); ++pmt_index) {
+    if (gradient && gradient->pe_v.size() != pe_v.size())
+      throw OpT0FinderException("Hypothesis gradient length != hypothesis length!");
 
-      O = measurement.pe_v[pmt_index]; // observation
-      H = hypothesis.pe_v[pmt_index];  // hypothesis
+    // Derivative of the sum: each term contributes d(term)/dH * dH/dx. A hypothesis replaced
+    // by its penalty value does not depend on x.
+    double dsum = 0.;
+    auto dHdx = [&](size_t pmt_index) {
+      return ((gradient && pe_v[pmt_index] > _pe_hypothesis_threshold) ? gradient->pe_v[pmt_index] : 0.);
+    };
 
-      if( H < 0 ) throw OpT0FinderException("Cannot have hypothesis value < 0!");
+    double O, H;
 
-      if(O < 0) {
-        if (!_penalty_value_v.empty()) {
-          O = _penalty_value_v[pmt_index];
-        }
-        else {
-          O = _pe_observation_threshold;
-        }
-      }
-      if (H <= _pe_hypothesis_threshold) {
-        if(!_penalty_threshold_v.empty()) {
-          H = _penalty_threshold_v[pmt_index];
-        }
-        else {
-          H = _pe_hypothesis_threshold;
-        }
-      }
-
-      if(_mode == kLLHD) {
+    if(_mode == kLLHD) {
 
-	double arg = TMath::Poisson(O,H);
-	if(arg > 0. && !std::isnan(arg) && !std::isinf(arg)) {
-	  _current_llhd -= std::log10(arg);
+      // ln Poisson(O,H) = O*ln(H) - lgamma(O+1) - H, reduced to -H for O=0
+      for (auto const& pmt_index : flash_ctx._zero_v) {
+	H = pe_v[pmt_index];
+	if( H < 0 ) throw OpT0FinderException("Cannot have hypothesis value < 0!");
+	if (H <= _pe_hypothesis_threshold) H = flash_ctx._h_penalty_v[pmt_index];
+	double lnp = -H;
+	if(lnp >= kMinLogP && !std::isnan(lnp)) {
+	  ctx._current_llhd -= lnp / kLn10;
+	  dsum += dHdx(pmt_index) / kLn10;
 	  nvalid_pmt += 1;
-	  if(_converged) FLASH_INFO() <<"PMT "<<pmt_index<<" O/H " << O << " / " << H << " LHD "<<arg << " -LLHD " << -1 * std::log10(arg) << std::endl;
+	  if(ctx._converged) FLASH_INFO() <<"PMT "<<pmt_index<<" O/H " << obs_v[pmt_index] << " / " << H << " LHD "<<std::exp(lnp) << " -LLHD " << -lnp / kLn10 << std::endl;
 	}
-      }else if (_mode == kSimpleLLHD) {
+      }
+      for (auto const& pmt_index : flash_ctx._active_v) {
+	O = obs_v[pmt_index];
+	H = pe_v[pmt_index];
+	if( H < 0 ) throw OpT0FinderException("Cannot have hypothesis value < 0!");
+	if (H <= _pe_hypothesis_threshold) H = flash_ctx._h_penalty_v[pmt_index];
+	double lnp = O * std::log(H) - flash_ctx._lgamma_v[pmt_index] - H;
+	if(lnp >= kMinLogP && lnp <= kMaxLogP && !std::isnan(lnp)) {
+	  ctx._current_llhd -= lnp / kLn10;
+	  dsum -= (O / H - 1.) * dHdx(pmt_index) / kLn10;
+	  nvalid_pmt += 1;
+	  if(ctx._converged) FLASH_INFO() <<"PMT "<<pmt_index<<" O/H " << O << " / " << H << " LHD "<<std::exp(lnp) << " -LLHD " << -lnp / kLn10 << std::endl;
+	}
+      }
 
-	double arg = (H - O * std::log(H));
-	_current_llhd += arg;
-	if(_converged) FLASH_INFO() <<"PMT "<<pmt_index<<" O/H " << O << " / " << H << " ... -LLHD " << arg << std::endl;
+    }else if (_mode == kSimpleLLHD) {
+
+      for (size_t pmt_index = 0; pmt_index < pe_v.size(); ++pmt_index) {
+	O = obs_v[pmt_index];
+	H = pe_v[pmt_index];
+	if( H < 0 ) throw OpT0FinderException("Cannot have hypothesis value < 0!");
+	if (H <= _pe_hypothesis_threshold) H = flash_ctx._h_penalty_v[pmt_index];
+	double arg = (O > 0 ? H - O * std::log(H) : H);
+	ctx._current_llhd += arg;
+	dsum += (O > 0 ? 1. - O / H : 1.) * dHdx(pmt_index);
+	if(ctx._converged) FLASH_INFO() <<"PMT "<<pmt_index<<" O/H " << O << " / " << H << " ... -LLHD " << arg << std::endl;
 	//nvalid_pmt += 1;
+      }
 
-      } else if (_mode == kChi2) {
+    } else if (_mode == kChi2) {
 
-	Error = O;
-	if( Error < 1.0 ) Error = 1.0;
-	_current_chi2 += std::pow((O - H), 2) / (Error);
+      for (size_t pmt_index = 0; pmt_index < pe_v.size(); ++pmt_index) {
+	O = obs_v[pmt_index];
+	H = pe_v[pmt_index];
+	if( H < 0 ) throw OpT0FinderException("Cannot have hypothesis value < 0!");
+	if (H <= _pe_hypothesis_threshold) H = flash_ctx._h_penalty_v[pmt_index];
+	ctx._current_chi2 += (O - H) * (O - H) / flash_ctx._error_v[pmt_index];
+	dsum -= 2. * (O - H) / flash_ctx._error_v[pmt_index] * dHdx(pmt_index);
 	nvalid_pmt += 1;
-
-      } else {
-	FLASH_ERROR() << "Unexpected mode" << std::endl;
-	throw OpT0FinderException();
       }
 
+    } else {
+      FLASH_ERROR() << "Unexpected mode" << std::endl;
+      throw OpT0FinderException();
     }
-    //FLASH_DEBUG() <<"Mode " << (int)(_mode) << " Chi2 " << _current_chi2 << " LLHD " << _current_llhd << " nvalid " << nvalid_pmt << std::endl;
+    //FLASH_DEBUG() <<"Mode " << (int)(_mode) << " Chi2 " << ctx._current_chi2 << " LLHD " << ctx._current_llhd << " nvalid " << nvalid_pmt << std::endl;
 
-    _current_chi2 /= nvalid_pmt;
-    _current_llhd /= (nvalid_pmt +1);
-    if(_converged)
-      FLASH_INFO() << "Combined LLHD: " << _current_llhd << " (divided by nvalid_pmt+1 = " << nvalid_pmt+1<<")"<<std::endl;
+    ctx._current_chi2 /= nvalid_pmt;
+    ctx._current_llhd /= (nvalid_pmt +1);
+    if (derivative)
+      *derivative = dsum / (_mode == kChi2 ? nvalid_pmt : nvalid_pmt + 1);
+    if(ctx._converged)
+      FLASH_INFO() << "Combined LLHD: " << ctx._current_llhd << " (divided by nvalid_pmt+1 = " << nvalid_pmt+1<<")"<<std::endl;
 
-    return (_mode == kChi2 ? _current_chi2 : _current_llhd);
+    return (_mode == kChi2 ? ctx._current_chi2 : ctx._current_llhd);
   }
 
-  void MIN_vtx_qll(Int_t & /*Npar*/, // Number of parameters
-		   Double_t * /*Grad*/, // Partial derivatives (return values)
-		   Double_t &Fval, // Function value (return value)
-		   Double_t *Xval, // Parameter values
-		   Int_t) /*Flag*/{ // flag word
-    //std::cout << "minuit offset : " << Fval << std::endl;
-    //std::cout << "minuit Xval?? : " << *Xval << std::endl;
-
-    //auto start = high_resolution_clock::now();
-    auto const &hypothesis = QLLMatch::GetME()->ChargeHypothesis(*Xval);
-    //auto end = high_resolution_clock::now();
-    //auto duration = duration_cast<microseconds>(end - start);
-    //std::cout << "Duration ChargeHypothesis = " << duration.count() << "us" << std::endl;
-
-    //start = high_resolution_clock::now();
-    auto const &measurement = QLLMatch::GetME()->Measurement();
-    //end = high_resolution_clock::now();
-    //duration = duration_cast<microseconds>(end - start);
-    //std::cout << "Duration Measurement = " << duration.count() << "us" << std::endl;
-
-    //start = high_resolution_clock::now();
-    Fval = QLLMatch::GetME()->QLL(hypothesis, measurement);
-    //end = high_resolution_clock::now();
-    //duration = duration_cast<microseconds>(end - start);
-    //std::cout << "Duration QLL = " << duration.count() << "us" << std::endl;
-
-    QLLMatch::GetME()->Record(Xval[0]);
-    QLLMatch::GetME()->OneStep();
-
-    return;
+  void QLLMatch::Record(QLLMatchContext& ctx, const double x) const
+  {
+    if(_record) {
+      ctx._minimizer_record_chi2_v.push_back(ctx._current_chi2);
+      ctx._minimizer_record_llhd_v.push_back(ctx._current_llhd);
+      ctx._minimizer_record_x_v.push_back(x);
+    }
   }
 
-  double QLLMatch::CallMinuit(const QCluster_t &tpc, const Flash_t &pmt, const bool init_x0) {
-
-    if (_measurement.pe_v.empty()) {
-      _measurement.pe_v.resize(DetectorSpecs::GetME().NOpDets(), 0.);
-    }
-    if (_measurement.pe_v.size() != pmt.pe_v.size()) {
-      std::cout << _measurement.pe_v.size() << " " << pmt.pe_v.size() << std::endl;
-      throw OpT0FinderException("PMT dimension has changed!");
-    }
+  double QLLMatch::Evaluate(QLLMatchContext& ctx, const double x) const
+  {
+    auto const &hypothesis = ChargeHypothesis(ctx, x);
+    double fval = QLL(ctx, hypothesis, *(ctx._flash_ctx));
+    Record(ctx, x);
+    ctx._num_steps += 1;
+    return fval;
+  }
 
-    if (!_penalty_threshold_v.empty() && _penalty_threshold_v.size() != pmt.pe_v.size()) {
-      throw OpT0FinderException("Penalty threshold array has a different size than PMT array size!");
-    }
+  double QLLMatch::EvaluateWithGradient(QLLMatchContext& ctx, const double x, double& derivative) const
+  {
+    // Hypothesis and derivative in the same pass over the cluster (not through the cache)
+    auto& hypothesis = ctx._hypothesis;
+    auto& gradient = ctx._gradient;
+    FillEstimateWithGradient(ctx._raw_trk, x, hypothesis, gradient);
+    if (hypothesis.pe_v.size() != DetectorSpecs::GetME().NOpDets())
+      throw OpT0FinderException("Hypothesis vector length != PMT count");
 
-    if (!_penalty_value_v.empty() && _penalty_value_v.size() != pmt.pe_v.size()) {
-      throw OpT0FinderException("Penalty value array has a different size than PMT array size!");
+    if (_normalize) {
+      // d(H_i/S)/dx = (dH_i/dx - (H_i/S) dS/dx) / S
+      double qsum  = std::accumulate(hypothesis.pe_v.begin(), hypothesis.pe_v.end(), 0.0);
+      double dqsum = std::accumulate(gradient.pe_v.begin(), gradient.pe_v.end(), 0.0);
+      NormalizeHypothesis(hypothesis);
+      for (size_t pmt = 0; pmt < gradient.pe_v.size(); ++pmt)
+	gradient.pe_v[pmt] = (gradient.pe_v[pmt] - hypothesis.pe_v[pmt] * dqsum) / qsum;
     }
 
-    _converged = false;
-
-    //
-    // Prepare PMT
-    //
-    double max_pe = 1.;
-
-    // Debug: Print out expected PE spectrum
-    //for(size_t i=0; i<pmt.pe_v.size(); ++i) {
-    //std::cout << "PE meas: " << i << " " << pmt.pe_v[i] << std::endl;
-    //}
+    double fval = QLL(ctx, hypothesis, *(ctx._flash_ctx), &gradient, &derivative);
+    Record(ctx, x);
+    ctx._num_steps += 1;
+    return fval;
+  }
 
-    if (_normalize) {
-      max_pe = 0;
-      for (auto const &v : pmt.pe_v) if (v > max_pe) max_pe = v;
-    }
+  double QLLMatch::CallMinuit(QLLMatchContext& ctx, const QCluster_t &tpc, const Flash_t &pmt, const bool init_x0) const {
 
-    for (size_t i = 0; i < pmt.pe_v.size(); ++i)  _measurement.pe_v[i] = pmt.pe_v[i] / max_pe;
+    // Flash-dependent likelihood terms (normalized measurement, substituted observations...)
+    ctx._flash_ctx = &(GetFlashContext(ctx, pmt));
 
-    _minimizer_record_chi2_v.clear();
-    _minimizer_record_llhd_v.clear();
-    _minimizer_record_x_v.clear();
-    _num_steps = 0;
+    ctx._converged = false;
 
-    if (!_minuit_ptr) _minuit_ptr = new TMinuit(4);
+    ctx._minimizer_record_chi2_v.clear();
+    ctx._minimizer_record_llhd_v.clear();
+    ctx._minimizer_record_x_v.clear();
+    ctx._num_steps = 0;
+    ctx._level = 0;
 
+    auto const& raw_xmin_pt = ctx._raw_xmin_pt;
+    auto const& raw_xmax_pt = ctx._raw_xmax_pt;
     double reco_x = _vol_xmin + 10;
     if (!init_x0) {
-      //reco_x = ((_vol_xmax - _vol_xmin) - (_raw_xmax_pt.x - _raw_xmin_pt.x)) / 2. + _vol_xmin;
+      //reco_x = ((_vol_xmax - _vol_xmin) - (raw_xmax_pt.x - raw_xmin_pt.x)) / 2. + _vol_xmin;
       // Assume this is the right flash... then
-      reco_x = _raw_xmin_pt.x - pmt.time * DetectorSpecs::GetME().DriftVelocity();
-      if(reco_x < _vol_xmin || (reco_x + _raw_xmax_pt.x - _raw_xmin_pt.x) > _vol_xmax)
+      reco_x = raw_xmin_pt.x - pmt.time * DetectorSpecs::GetME().DriftVelocity();
+      if(reco_x < _vol_xmin || (reco_x + raw_xmax_pt.x - raw_xmin_pt.x) > _vol_xmax)
 	return kINVALID_DOUBLE;
     }
-    double reco_x_err = ((_vol_xmax - _vol_xmin) - (_raw_xmax_pt.x - _raw_xmin_pt.x)) / 2.;
+    double reco_x_err = ((_vol_xmax - _vol_xmin) - (raw_xmax_pt.x - raw_xmin_pt.x)) / 2.;
     double xmin = _vol_xmin;
-    double xmax = (_vol_xmax - _vol_xmin) - (_raw_xmax_pt.x - _raw_xmin_pt.x) + _vol_xmin;
+    double xmax = (_vol_xmax - _vol_xmin) - (raw_xmax_pt.x - raw_xmin_pt.x) + _vol_xmin;
+
+    if (_minimizer == kGridScan) {
+      GridScan(ctx, xmin, xmax);
+      return ctx._qll;
+    }
+
+    // The minimizer is created once per context and reused for all following calls
+    if (!ctx._minuit_ptr) ctx._minuit_ptr = new QLLMinuit(this, &ctx);
+    auto minuit_ptr = ctx._minuit_ptr;
 
     FLASH_INFO() << "Running Minuit x: " << xmin << " => " << xmax
 		 << " ... initial state x=" <<reco_x <<" x_err=" << reco_x_err << std::endl;
@@ -441,33 +667,55 @@ namespace flashmatch {
     double arglist[4], Fmin, Fedm, Errdef;
     ierrflag = npari = nparx = istat = 0;
 
-    assert(this == QLLMatch::GetME());
-
-    _minuit_ptr->SetPrintLevel(-1);
+    minuit_ptr->SetPrintLevel(-1);
     arglist[0] = 2.0;  // set strategy level
-    _minuit_ptr->mnexcm("SET STR", arglist, 1, ierrflag);
-
-    _minuit_ptr->SetFCN(MIN_vtx_qll);
-
-    _minuit_ptr->DefineParameter(0, "X", reco_x, reco_x_err, xmin, xmax);
-
-    _minuit_ptr->Command("SET NOW");
-
-    // use Migrad minimizer
+    minuit_ptr->mnexcm("SET STR", arglist, 1, ierrflag);
+
+    minuit_ptr->Command("SET NOW");
+
+    // Analytic derivatives (full resolution only): Minuit then asks for them instead of
+    // estimating them with extra function calls. "SET GRAD 1" skips its numerical check: only
+    // for an exact derivative. Others (e.g. a voxel difference of a piecewise constant
+    // hypothesis) are checked, and Minuit falls back to numerical ones if they disagree.
+    bool use_gradient = (_use_gradient && HypothesisHasGradient());
+    bool exact_gradient = HypothesisHasExactGradient();
+
+    // use Migrad minimizer, from the coarsest to the full resolution hypothesis
+    for (size_t pass = 0; pass < _level_schedule_v.size(); ++pass) {
+      ctx._level = _level_schedule_v[pass];
+      if (ctx._level >= NumHypothesisLevels()) {
+	ctx._level = 0;
+	throw OpT0FinderException("LevelSchedule uses level " + std::to_string(_level_schedule_v[pass])
+				  + " but the hypothesis has " + std::to_string(NumHypothesisLevels()) + " level(s)");
+      }
+      if (use_gradient && !ctx._level) {
+	arglist[0] = 1;
+	minuit_ptr->mnexcm("SET GRAD", arglist, (exact_gradient ? 1 : 0), ierrflag);
+      }
+      else
+	minuit_ptr->mnexcm("SET NOGRAD", arglist, 0, ierrflag);
+      if (pass) {
+	// Refine around the previous result: its uncertainty is about one coarse voxel
+	minuit_ptr->GetParameter(0, reco_x, reco_x_err);
+	reco_x_err = DetectorSpecs::GetME().GetVoxelDef(_level_schedule_v[pass-1]).GetVoxelSize()[0];
+      }
+      minuit_ptr->DefineParameter(0, "X", reco_x, reco_x_err, xmin, xmax);
 
-    arglist[0] = 5000;  // maxcalls
-    arglist[1] = _migrad_tolerance; // tolerance*1e-3 = convergence condition
-    _minuit_ptr->mnexcm("MIGRAD", arglist, 2, ierrflag);
+      arglist[0] = 5000;  // maxcalls
+      arglist[1] = _migrad_tolerance; // tolerance*1e-3 = convergence condition
+      minuit_ptr->mnexcm("MIGRAD", arglist, 2, ierrflag);
+    }
+    ctx._level = 0;
 
-    _converged = true;
+    ctx._converged = true;
 
     //arglist[0]   = 5.0e+2;
     //arglist[1]   = 1.0e-6;
-    //_minuit_ptr->mnexcm ("simplex",arglist,2,ierrflag);
+    //minuit_ptr->mnexcm ("simplex",arglist,2,ierrflag);
 
-    _minuit_ptr->GetParameter(0, reco_x, reco_x_err);
+    minuit_ptr->GetParameter(0, reco_x, reco_x_err);
 
-    _minuit_ptr->mnstat(Fmin, Fedm, Errdef, npari, nparx, istat);
+    minuit_ptr->mnstat(Fmin, Fedm, Errdef, npari, nparx, istat);
 
     // use this for debugging, maybe uncomment the actual minimzing function (MIGRAD / simplex calls)
     // scanning the parameter set
@@ -475,36 +723,93 @@ namespace flashmatch {
     //arglist[1] = 500;    // Number of points
     //arglist[2] = 0;       // Start point of scan
     //arglist[3] = 256;     // End point of scan
-    //_minuit_ptr->mnexcm("scan", arglist,4, ierrflag);
+    //minuit_ptr->mnexcm("scan", arglist,4, ierrflag);
 
     MinFval = Fmin;
-    double *grad = 0;
-    int nPar = 1;
-    double fValue[1];
-    fValue[0] = reco_x;
     // Transfer the minimization variables:
-    MIN_vtx_qll(nPar, grad, Fmin, fValue, ierrflag);
-
-    //static bool show = true;
-    /*
-      if(show){
-      if(Fmin!=MinFval)std::cout<<"Fmin "<<Fmin<<" not equall to "<<MinFval<<std::endl;
-      show=false;
-      }
-    */
+    Evaluate(ctx, reco_x);
 
     // Transfer the minimization variables:
-    _reco_x_offset = reco_x;
-    _reco_x_offset_err = reco_x_err;
-    _qll = MinFval;
+    ctx._reco_x_offset = reco_x;
+    ctx._reco_x_offset_err = reco_x_err;
+    ctx._qll = MinFval;
 
     // Clear:
-    _minuit_ptr->mnexcm("clear", arglist, 0, ierrflag);
+    minuit_ptr->mnexcm("clear", arglist, 0, ierrflag);
 
-    if (_minuit_ptr) delete _minuit_ptr;
-    _minuit_ptr = 0;
+    return ctx._qll;
+  }
 
-    return _qll;
+  void QLLMatch::GridScan(QLLMatchContext& ctx, const double xmin, const double xmax) const {
+
+    FLASH_INFO() << "Running grid scan x: " << xmin << " => " << xmax
+		 << " ... step=" << _grid_scan_step << std::endl;
+
+    // Coarse scan: all grid hypotheses are computed in one batch call
+    auto& scan_x_v = ctx._scan_x_v;
+    scan_x_v.clear();
+    size_t nstep = (xmax > xmin ? (size_t)(std::ceil((xmax - xmin) / _grid_scan_step)) : 0);
+    for (size_t i = 0; i < nstep; ++i) scan_x_v.push_back(xmin + i * _grid_scan_step);
+    scan_x_v.push_back(std::max(xmin, xmax));
+
+    FillEstimateBatch(ctx._raw_trk, scan_x_v, ctx._scan_hypothesis_v);
+
+    size_t best_index = 0;
+    double best_f = std::numeric_limits<double>::max();
+    for (size_t i = 0; i < scan_x_v.size(); ++i) {
+      auto& hypothesis = ctx._scan_hypothesis_v[i];
+      if (_normalize) NormalizeHypothesis(hypothesis);
+      double f = QLL(ctx, hypothesis, *(ctx._flash_ctx));
+      Record(ctx, scan_x_v[i]);
+      ctx._num_steps += 1;
+      if (f < best_f) { best_f = f; best_index = i; }
+    }
+    double best_x = scan_x_v[best_index];
+
+    // Refinement: golden-section search within one grid step around the best grid point
+    double a = std::max(xmin, best_x - _grid_scan_step);
+    double b = std::min(xmax, best_x + _grid_scan_step);
+    double reco_x = best_x;
+    double reco_f = best_f;
+    bool refined = false;
+    if (b - a > _grid_scan_tolerance) {
+      const double invphi = (std::sqrt(5.) - 1.) / 2.;
+      double c = b - invphi * (b - a);
+      double d = a + invphi * (b - a);
+      double fc = Evaluate(ctx, c);
+      double fd = Evaluate(ctx, d);
+      while (b - a > _grid_scan_tolerance) {
+	if (fc < fd) {
+	  b = d; d = c; fd = fc;
+	  c = b - invphi * (b - a);
+	  fc = Evaluate(ctx, c);
+	}
+	else {
+	  a = c; c = d; fc = fd;
+	  d = a + invphi * (b - a);
+	  fd = Evaluate(ctx, d);
+	}
+      }
+      if (std::min(fc, fd) < best_f) {
+	reco_x = (fc < fd ? c : d);
+	reco_f = std::min(fc, fd);
+	refined = true;
+      }
+    }
+
+    ctx._converged = true;
+
+    // Transfer the minimization variables: the reported QLL is the value that selected reco_x
+    if (!refined) {
+      ctx._hypothesis = ctx._scan_hypothesis_v[best_index];
+      ctx._reco_x_offset_err = std::max(_grid_scan_step / 2., _grid_scan_tolerance / 2.);
+    }
+    else {
+      Evaluate(ctx, reco_x);
+      ctx._reco_x_offset_err = std::max((b - a) / 2., _grid_scan_tolerance / 2.);
+    }
+    ctx._qll = reco_f;
+    ctx._reco_x_offset = reco_x;
   }
 
 }
@@ -15,88 +15,207 @@
 #define QLLMATCH_H
 
 #include <iostream>
+#include <memory>
+#include <mutex>
+#include <map>
 #include "flashmatch/Base/FlashMatchFactory.h"
 #include "flashmatch/Base/BaseFlashMatch.h"
+#include "flashmatch/Base/HypothesisCache.h"
 #include <TMinuit.h>
 namespace flashmatch {
+
+  class QLLMatch;
+
   /**
-     \class QLLMatch
-     User defined class QLLMatch ... these comments are used to generate
-     doxygen documentation!
+     \class QLLFlashContext
+     Flash-dependent part of the QLLMatch likelihood, computed once per flash and shared by \n
+     all TPC clusters matched to it: normalized measurement, observation after threshold and \n
+     penalty substitution, lgamma(O+1) terms, chi2 errors, and the channel lists with O>0 \n
+     (full Poisson term) and O=0 (only the -H term).
   */
-  class QLLMatch : public BaseFlashMatch {
+  class QLLFlashContext {
+    friend class QLLMatch;
 
   public:
 
-    enum QLLMode_t { kChi2, kLLHD, kSimpleLLHD };
+    /// Default constructor
+    QLLFlashContext() {}
+
+    /// Default destructor
+    ~QLLFlashContext() {}
+
+    /// (Normalized) flash PE distribution over PMTs
+    const Flash_t& Measurement() const { return _measurement; }
+    /// Channels with a positive observation
+    const std::vector<size_t>& ActiveChannels() const { return _active_v; }
+
+  private:
+
+    std::vector<double> _raw_pe_v;    ///< Input flash PE (to validate a look-up by address)
+    flashmatch::Flash_t _measurement; ///< Normalized flash PE distribution over PMTs
+    std::vector<double> _obs_v;       ///< Observation after substitution of negative values
+    std::vector<double> _lgamma_v;    ///< lgamma(O+1)
+    std::vector<double> _error_v;     ///< Chi2 error (max(O,1))
+    std::vector<double> _h_penalty_v; ///< Value replacing a hypothesis below threshold
+    std::vector<size_t> _active_v;    ///< Channels with O>0
+    std::vector<size_t> _zero_v;      ///< Channels with O=0
+  };
+
+  /**
+     \class QLLMatchContext
+     Mutable state of one QLLMatch minimization: TPC/PMT scratch buffers, hypothesis cache, \n
+     minimizer and its history. A context must be used by one thread at a time. It keeps its \n
+     minimizer and buffers across calls, so a worker should hold on to one context.
+  */
+  class QLLMatchContext {
+    friend class QLLMatch;
+
+  public:
+
+    /// Default constructor
+    QLLMatchContext();
+
+    /// Default destructor
+    ~QLLMatchContext();
+
+    /// Last hypothesis PE distribution over PMTs
+    const Flash_t& Hypothesis() const { return _hypothesis; }
+    /// Flash context used in the last minimization (nullptr if none)
+    const QLLFlashContext* FlashContext() const { return _flash_ctx; }
+
+    /// Hypothesis cache (per TPC cluster, shared by both minimizer passes)
+    const HypothesisCache& HypothesisCacheInfo() const { return _hypothesis_cache; }
+
+    const std::vector<double>& HistoryLLHD() const { return _minimizer_record_llhd_v; }
+    const std::vector<double>& HistoryChi2() const { return _minimizer_record_chi2_v; }
+    const std::vector<double>& HistoryX()    const { return _minimizer_record_x_v;    }
 
   private:
-    /// Valid ctor hidden (singleton)
-    QLLMatch(const std::string);
+
+    /// No copy: the context owns its minimizer
+    QLLMatchContext(const QLLMatchContext&);
+    QLLMatchContext& operator=(const QLLMatchContext&);
+
+    flashmatch::QCluster_t _raw_trk;
+    QPoint_t _raw_xmin_pt;
+    QPoint_t _raw_xmax_pt;
+    flashmatch::Flash_t    _hypothesis;  ///< Hypothesis PE distribution over PMTs
+    flashmatch::Flash_t    _gradient;    ///< Hypothesis derivative w.r.t. the x-offset (UseGradient)
+    const QLLFlashContext* _flash_ctx; ///< Context of the flash being matched
+    QLLFlashContext _local_flash_ctx;  ///< Used for a flash not prepared by PrepareMatch
+    flashmatch::HypothesisCache _hypothesis_cache; ///< x-offset key => hypothesis cache
+    ID_t _store_cluster_id;  ///< Cluster id in the manager's hypothesis store (kINVALID_ID if none)
+    std::vector<double> _scan_x_v;                  ///< Grid scan x-offsets
+    std::vector<flashmatch::Flash_t> _scan_hypothesis_v; ///< Grid scan hypotheses
+    size_t _level;                                  ///< Hypothesis resolution level of the current MIGRAD pass
+
+    double _current_chi2;
+    double _current_llhd;
+    std::vector<double> _minimizer_record_chi2_v; ///< Minimizer record chi2 value
+    std::vector<double> _minimizer_record_llhd_v; ///< Minimizer record llhd value
+    std::vector<double> _minimizer_record_x_v;    ///< Minimizer record X values
+
+    double _reco_x_offset;     ///< reconstructed X offset (from wire-plane to min-x point)
+    double _reco_x_offset_err; ///< reconstructed X offset w/ error
+    double _qll;               ///< Minimizer return value
+
+    bool _converged;
+    int _num_steps;
+
+    TMinuit* _minuit_ptr; //!< Minimizer owned by this context (created on first use)
+  };
+
+  /**
+     \class QLLMatch
+     Flash matching by minimizing a likelihood (or chi2) of the hypothesis PE spectrum \n
+     w.r.t. the flash PE spectrum as a function of the TPC cluster x-offset. \n
+     The algorithm itself only holds the configuration: all mutable state lives in \n
+     QLLMatchContext, so Match can be called concurrently from several threads. Each call \n
+     borrows a context from an internal pool (one per concurrent caller) and gives it back.
+  */
+  class QLLMatch : public BaseFlashMatch {
 
   public:
 
-    /// Default ctor throws exception (singleton)
-    QLLMatch();
+    enum QLLMode_t { kChi2, kLLHD, kSimpleLLHD };
+    enum QLLMinimizer_t { kMIGRAD, kGridScan };
+
+    /// Default ctor
+    QLLMatch(const std::string name="QLLMatch");
 
     /// Default destructor
     ~QLLMatch(){}
 
-    /// Singleton shared instance getter
-    static QLLMatch* GetME(std::string name="")
-    {
-      if(!_me) _me = new QLLMatch(name);
-      else if(!name.empty() && name != _me->AlgorithmName()) {
-	std::cerr << "QLLMatch instance must be uniquely named. Requested: "
-		  << name << " vs. Existing: " << _me->AlgorithmName() << std::endl;
-	throw std::exception();
-      }
-      return _me;
-    }
-
-    /// Core function: execute matching
+    /// Core function: execute matching (thread-safe, uses a pooled context)
     FlashMatch_t Match(const QCluster_t&, const Flash_t&);
 
-    const Flash_t& ChargeHypothesis(const double);
-    const Flash_t& Measurement() const;
+    /// Match can be called concurrently (each call uses its own context)
+    bool ThreadSafe() const { return true; }
+
+    /// Builds the per-flash likelihood contexts shared by all clusters in this event
+    void PrepareMatch(const QClusterArray_t&, const FlashArray_t&);
+
+    /// Fills the likelihood context for a flash
+    void BuildFlashContext(const Flash_t& flash, QLLFlashContext& flash_ctx) const;
+
+    /// Execute matching with a user-provided context
+    FlashMatch_t Match(QLLMatchContext& ctx, const QCluster_t&, const Flash_t&) const;
+
+    const Flash_t& ChargeHypothesis(QLLMatchContext& ctx, const double) const;
 
-    double QLL(const flashmatch::Flash_t&,
-	       const flashmatch::Flash_t&);
+    /// Likelihood (or chi2) of a hypothesis; with gradient (dH/dx per PMT), also fills its x derivative
+    double QLL(QLLMatchContext& ctx,
+	       const flashmatch::Flash_t& hypothesis,
+	       const QLLFlashContext& flash_ctx,
+	       const flashmatch::Flash_t* gradient=nullptr,
+	       double* derivative=nullptr) const;
 
-    void Record(const double x)
-    {
-      if(_record) {
-	_minimizer_record_chi2_v.push_back(_current_chi2);
-	_minimizer_record_llhd_v.push_back(_current_llhd);
-	_minimizer_record_x_v.push_back(x);
-      }
-    }
+    /// Minimizer function value: hypothesis at x compared to the context measurement
+    double Evaluate(QLLMatchContext& ctx, const double x) const;
 
-    void OneStep() {
-        _num_steps = _num_steps + 1;
-    }
+    /// Minimizer function value and its x derivative from the hypothesis gradient (one pass)
+    double EvaluateWithGradient(QLLMatchContext& ctx, const double x, double& derivative) const;
 
-    double CallMinuit(const QCluster_t& tpc,
+    double CallMinuit(QLLMatchContext& ctx,
+		      const QCluster_t& tpc,
 		      const Flash_t& pmt,
-		      const bool init_x0=true);
+		      const bool init_x0=true) const;
 
+    /// Minimizer history of the last Match call (if RecordHistory is set)
     const std::vector<double>& HistoryLLHD() const { return _minimizer_record_llhd_v; }
     const std::vector<double>& HistoryChi2() const { return _minimizer_record_chi2_v; }
     const std::vector<double>& HistoryX()    const { return _minimizer_record_x_v;    }
 
+    /// Number of contexts created so far (= max. number of concurrent Match calls)
+    size_t NumContexts() const;
+
   protected:
 
     void _Configure_(const Config_t &pset);
 
   private:
 
-    FlashMatch_t PESpectrumMatch(const QCluster_t &pt_v, const Flash_t &flash, const bool init_x0);
+    FlashMatch_t PESpectrumMatch(QLLMatchContext& ctx, const QCluster_t &pt_v, const Flash_t &flash, const bool init_x0) const;
+
+    FlashMatch_t OnePMTMatch(QLLMatchContext& ctx, const Flash_t &flash) const;
+
+    void Record(QLLMatchContext& ctx, const double x) const;
+
+    /// Flash context prepared by PrepareMatch, or built into the matching context
+    const QLLFlashContext& GetFlashContext(QLLMatchContext& ctx, const Flash_t& flash) const;
+
+    void NormalizeHypothesis(Flash_t& hypothesis) const;
 
-    FlashMatch_t OnePMTMatch(const Flash_t &flash);
+    /// Coarse scan of [xmin,xmax] followed by a golden-section refinement around the best point
+    void GridScan(QLLMatchContext& ctx, const double xmin, const double xmax) const;
 
-    static QLLMatch* _me;
+    /// Borrow an idle context from the pool (creates one if none is available)
+    QLLMatchContext* AcquireContext();
+    /// Return a context to the pool
+    void ReleaseContext(QLLMatchContext* ctx);
 
     QLLMode_t _mode;   ///< Minimizer mode
+    QLLMinimizer_t _minimizer; ///< Minimization method
     bool _record;      ///< Boolean switch to record minimizer history
     double _normalize; ///< Noramalize hypothesis PE spectrum
 
@@ -105,28 +224,13 @@ namespace flashmatch {
     double _pe_hypothesis_threshold;
     double _pe_observation_threshold;
 
-    flashmatch::QCluster_t _raw_trk;
-    QPoint_t _raw_xmin_pt;
-    QPoint_t _raw_xmax_pt;
-    flashmatch::QCluster_t _var_trk;
-    flashmatch::Flash_t    _hypothesis;  ///< Hypothesis PE distribution over PMTs
-    flashmatch::Flash_t    _measurement; ///< Flash PE distribution over PMTs
-
-    double _current_chi2;
-    double _current_llhd;
-    std::vector<double> _minimizer_record_chi2_v; ///< Minimizer record chi2 value
-    std::vector<double> _minimizer_record_llhd_v; ///< Minimizer record llhd value
-    std::vector<double> _minimizer_record_x_v;    ///< Minimizer record X values
-
-    double _reco_x_offset;     ///< reconstructed X offset (from wire-plane to min-x point)
-    double _reco_x_offset_err; ///< reconstructed X offset w/ error
-    double _qll;               ///< Minimizer return value
-
-    bool _converged;
-
-    TMinuit* _minuit_ptr;
     double _migrad_tolerance;
-    int _num_steps;
+    bool   _use_gradient;    ///< MIGRAD: use the hypothesis x derivative (if the algorithm has one)
+    std::vector<size_t> _level_schedule_v; ///< MIGRAD: hypothesis level of each pass (ends with 0)
+    double _grid_scan_step;      ///< GridScan: coarse scan step [cm]
+    double _grid_scan_tolerance; ///< GridScan: refinement interval width to stop at [cm]
+
+    size_t _hypothesis_cache_size; ///< Max. number of cached hypotheses per context
 
     double _recox_penalty_threshold;
     double _recoz_penalty_threshold;
@@ -139,6 +243,16 @@ namespace flashmatch {
     double _vol_xmax, _vol_xmin;
     std::vector<double> _xpos_v, _ypos_v, _zpos_v;
 
+    std::vector<QLLFlashContext> _flash_ctx_v;      ///< Per-flash contexts of the current event
+    std::map<const Flash_t*, size_t> _flash_ctx_m; //!< Flash address => index in _flash_ctx_v
+
+    std::vector<double> _minimizer_record_chi2_v; ///< Minimizer record chi2 value (last Match)
+    std::vector<double> _minimizer_record_llhd_v; ///< Minimizer record llhd value (last Match)
+    std::vector<double> _minimizer_record_x_v;    ///< Minimizer record X values (last Match)
+
+    mutable std::mutex _context_mutex; //!< Protects the context pool and the history
+    std::vector<std::unique_ptr<QLLMatchContext> > _context_v; //!< All contexts (owned)
+    std::vector<QLLMatchContext*> _idle_context_v; //!< Contexts available for a new Match call
   };
 
   /**
@@ -151,7 +265,7 @@ namespace flashmatch {
     /// dtor
     ~QLLMatchFactory() {}
     /// creation method
-    BaseFlashMatch* create(const std::string instance_name) { return QLLMatch::GetME(instance_name); }
+    BaseFlashMatch* create(const std::string instance_name) { return new QLLMatch(instance_name); }
   };
 
 }
@@ -27,9 +27,6 @@ namespace flashmatch {
   FlashMatch_t QWeightPoint::Match(const QCluster_t& pt_v, const Flash_t& flash)
   {
 
-    if(_vis_array.pe_v.empty())
-      _vis_array.pe_v.resize(DetectorSpecs::GetME().NOpDets());
-
     // Prepare the return values (Mostly QWeightPoint)
     FlashMatch_t f;
     if(pt_v.empty()){
@@ -37,8 +34,6 @@ namespace flashmatch {
       return f;
     }
     
-    _tpc_qcluster.resize(pt_v.size());
-
     // Get min & max x value
     double x_max = 0;
     double x_min = 1e12;
@@ -48,28 +43,31 @@ namespace flashmatch {
       if(pt.x < x_min) x_min = pt.x;
     }
 
-    double min_dz = 1e9;
+    // Offsets w.r.t. the min x point, then hypotheses for all offsets at once. The input
+    // cluster is used as is: the hypothesis applies (offset - min x) to its points.
+    _xoffset_v.clear();
+    _shift_v.clear();
     for(double x_offset=0; x_offset<(256.35-(x_max-x_min)); x_offset+=_x_step_size) {
-      
-      // Create QCluster_t with this offset
+      _xoffset_v.push_back(x_offset);
+      _shift_v.push_back(x_offset - x_min);
+    }
 
-      for(size_t i=0; i<_tpc_qcluster.size(); ++i) {
-	_tpc_qcluster[i].x = pt_v[i].x + x_offset - x_min;
-	_tpc_qcluster[i].y = pt_v[i].y;
-	_tpc_qcluster[i].z = pt_v[i].z;
-	_tpc_qcluster[i].q = pt_v[i].q;
-      }
-            
-      FillEstimate(_tpc_qcluster,_vis_array);
+    FillEstimateBatch(pt_v,_shift_v,_vis_array_v);
+
+    double min_dz = 1e9;
+    for(size_t ioff=0; ioff<_xoffset_v.size(); ++ioff) {
+
+      double x_offset = _xoffset_v[ioff];
+      auto const& vis_array = _vis_array_v[ioff];
 
       // Calculate amplitudes corresponding to max opdet amplitudes
-      double vis_pe_sum = _vis_array.TotalPE();
+      double vis_pe_sum = vis_array.TotalPE();
 
       double weighted_z = 0;
       for(size_t pmt_index=0; pmt_index<DetectorSpecs::GetME().NOpDets(); ++pmt_index) {
 
-	if(_vis_array.pe_v[pmt_index]<0) continue;
-	weighted_z += DetectorSpecs::GetME().PMTPosition(pmt_index)[2] * _vis_array.pe_v[pmt_index] / vis_pe_sum;
+	if(vis_array.pe_v[pmt_index]<0) continue;
+	weighted_z += DetectorSpecs::GetME().PMTPosition(pmt_index)[2] * vis_array.pe_v[pmt_index] / vis_pe_sum;
 
       }
 
@@ -86,8 +84,8 @@ namespace flashmatch {
 	f.tpc_point.x = x_offset;
 
 	for(size_t pmt_index=0; pmt_index<DetectorSpecs::GetME().NOpDets(); ++pmt_index) {
-	  if(_vis_array.pe_v[pmt_index]<0) continue;
-	  f.tpc_point.y += DetectorSpecs::GetME().PMTPosition(pmt_index)[1] * _vis_array.pe_v[pmt_index] / vis_pe_sum;
+	  if(vis_array.pe_v[pmt_index]<0) continue;
+	  f.tpc_point.y += DetectorSpecs::GetME().PMTPosition(pmt_index)[1] * vis_array.pe_v[pmt_index] / vis_pe_sum;
 	}
 
 	f.tpc_point.z = weighted_z;	
@@ -110,7 +108,7 @@ namespace flashmatch {
       return f;
     }
 
-    f.hypothesis = _vis_array.pe_v;
+    f.hypothesis = _vis_array_v.back().pe_v;
     return f;
 
   }
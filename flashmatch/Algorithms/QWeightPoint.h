@@ -49,8 +49,9 @@ namespace flashmatch {
   private:
     double _x_step_size; ///< step size in x-direction
     double _zdiff_max;   ///< allowed diff in z-direction to be considered as a match
-    flashmatch::QCluster_t _tpc_qcluster;
-    flashmatch::Flash_t    _vis_array;
+    std::vector<double>    _xoffset_v;   ///< x-offsets to be scanned (w.r.t. the cluster min x)
+    std::vector<double>    _shift_v;     ///< same offsets applied to the input cluster (offset - min x)
+    std::vector<flashmatch::Flash_t> _vis_array_v; ///< hypothesis for each x-offset
   };
 
   /**
@@ -0,0 +1,196 @@
+#ifndef VOXELPATH_CXX
+#define VOXELPATH_CXX
+
+#include "VoxelPath.h"
+#include <cmath>
+#include <limits>
+#include <algorithm>
+
+namespace flashmatch {
+
+  static VoxelPathFactory __global_VoxelPathFactory__;
+
+  /// Path pieces shorter than this [cm] (rounding at voxel corners and faces) are dropped
+  static const double kMinPathLength = 1.e-6;
+
+  VoxelPath::VoxelPath(const std::string name)
+    : BaseAlgorithm(kCustomAlgo, name)
+    , _light_yield ( 40000. )
+    , _dEdxMIP     ( 2.07   ) //1.42[Mev*cm^2*g]*1.4[g/cm^3]=2.004MeV/cm
+  {}
+
+  void VoxelPath::_Configure_(const Config_t &pset)
+  {
+    _light_yield  = pset.get< double > ( "LightYield"  );
+    _dEdxMIP      = pset.get< double > ( "MIPdEdx"     );
+  }
+
+  void VoxelPath::AddPoint(const double* start, const double* direct, double s0, double s1,
+			   double dedx, int voxel, QCluster_t& Q_cluster, int& last_voxel) const
+  {
+    double length = s1 - s0;
+    if (length < kMinPathLength) return;
+
+    double s = (s0 + s1) / 2.;
+    QPoint_t q_pt(start[0] + direct[0] * s,
+		  start[1] + direct[1] * s,
+		  start[2] + direct[2] * s,
+		  _light_yield * dedx * length);
+    FLASH_DEBUG() << "Voxel " << voxel << " pt (" << q_pt.x << "," << q_pt.y << "," << q_pt.z
+		  << ") path " << length << " q=" << q_pt.q << std::endl;
+
+    // Same voxel as the previous point (e.g. at a trajectory point): one point per voxel
+    if (voxel >= 0 && voxel == last_voxel && !Q_cluster.empty()) {
+      auto& pt = Q_cluster.back();
+      double q = pt.q + q_pt.q;
+      if (q > 0.) {
+	pt.x = (pt.x * pt.q + q_pt.x * q_pt.q) / q;
+	pt.y = (pt.y * pt.q + q_pt.y * q_pt.q) / q;
+	pt.z = (pt.z * pt.q + q_pt.z * q_pt.q) / q;
+      }
+      pt.q = q;
+      return;
+    }
+    Q_cluster.push_back(q_pt);
+    last_voxel = voxel;
+  }
+
+  void VoxelPath::TraverseSegment(const ::geoalgo::Vector& pt_1,
+				  const ::geoalgo::Vector& pt_2,
+				  double dedx,
+				  const ::geoalgo::AABox* box,
+				  QCluster_t& Q_cluster,
+				  int& last_voxel) const
+  {
+    double start[3], direct[3];
+    double length = 0.;
+    for (size_t i = 0; i < 3; ++i) {
+      start[i]  = pt_1[i];
+      direct[i] = pt_2[i] - pt_1[i];
+      length += direct[i] * direct[i];
+    }
+    length = std::sqrt(length);
+    if (length < kMinPathLength) return;
+    for (size_t i = 0; i < 3; ++i) direct[i] /= length;
+
+    FLASH_INFO() << "Walking voxels between (" << pt_1[0] << "," << pt_1[1] << "," << pt_1[2] << ")"
+		 << " => (" << pt_2[0] << "," << pt_2[1] << "," << pt_2[2] << ") ... dist=" << length << std::endl;
+
+    // Clip [s_begin,s_end] (distance from pt_1) to [lo,hi] along each axis (slab method)
+    auto clip = [&start,&direct](const double* lo, const double* hi, double& s_begin, double& s_end) {
+      for (size_t i = 0; i < 3 && s_begin < s_end; ++i) {
+	if (direct[i] == 0.) {
+	  if (start[i] < lo[i] || start[i] > hi[i]) s_end = s_begin;
+	  continue;
+	}
+	double s_lo = (lo[i] - start[i]) / direct[i];
+	double s_hi = (hi[i] - start[i]) / direct[i];
+	s_begin = std::max(s_begin, std::min(s_lo, s_hi));
+	s_end   = std::min(s_end,   std::max(s_lo, s_hi));
+      }
+    };
+
+    double s_begin = 0.;
+    double s_end = length;
+    if (box) {
+      double lo[3] = { box->Min()[0], box->Min()[1], box->Min()[2] };
+      double hi[3] = { box->Max()[0], box->Max()[1], box->Max()[2] };
+      clip(lo, hi, s_begin, s_end);
+      if (s_end - s_begin < kMinPathLength) return;
+    }
+
+    auto const& vox_def = DetectorSpecs::GetME().GetVoxelDef();
+    auto const lower = vox_def.GetRegionLowerCorner();
+    auto const upper = vox_def.GetRegionUpperCorner();
+    auto const steps = vox_def.GetSteps();
+    double lo[3], hi[3], size[3];
+    int n[3];
+    for (size_t i = 0; i < 3; ++i) {
+      lo[i] = lower[i];
+      hi[i] = upper[i];
+      n[i] = int(steps[i]);
+      size[i] = (hi[i] - lo[i]) / n[i];
+    }
+
+    // Outside the voxel grid (but inside the box): one point for each side
+    double g_begin = s_begin;
+    double g_end = s_end;
+    clip(lo, hi, g_begin, g_end);
+    if (g_end - g_begin < kMinPathLength) {
+      AddPoint(start, direct, s_begin, s_end, dedx, -1, Q_cluster, last_voxel);
+      return;
+    }
+    AddPoint(start, direct, s_begin, g_begin, dedx, -1, Q_cluster, last_voxel);
+
+    // Amanatides-Woo traversal: from the entry voxel, step to the neighbour across the
+    // nearest voxel face until the end of the segment (or the grid) is reached
+    int cell[3], step[3];
+    for (size_t i = 0; i < 3; ++i) {
+      double pos = start[i] + direct[i] * g_begin;
+      cell[i] = std::min(std::max(int(std::floor((pos - lo[i]) / size[i])), 0), n[i] - 1);
+      step[i] = (direct[i] > 0. ? 1 : (direct[i] < 0. ? -1 : 0));
+    }
+    double s = g_begin;
+    while (s < g_end) {
+      // Distance to the exit face along each axis (from the voxel bounds: no accumulated error)
+      int axis = 0;
+      double s_exit = std::numeric_limits<double>::infinity();
+      for (size_t i = 0; i < 3; ++i) {
+	if (!step[i]) continue;
+	double face = lo[i] + (cell[i] + (step[i] > 0 ? 1 : 0)) * size[i];
+	double s_face = (face - start[i]) / direct[i];
+	if (s_face < s_exit) { s_exit = s_face; axis = i; }
+      }
+      s_exit = std::min(s_exit, g_end);
+      if (s_exit > s) {
+	int voxel = cell[0] + cell[1] * n[0] + cell[2] * (n[0] * n[1]);
+	AddPoint(start, direct, s, s_exit, dedx, voxel, Q_cluster, last_voxel);
+	s = s_exit;
+      }
+      if (s >= g_end) break;
+      cell[axis] += step[axis];
+      if (cell[axis] < 0 || cell[axis] >= n[axis]) break;
+    }
+
+    AddPoint(start, direct, g_end, s_end, dedx, -1, Q_cluster, last_voxel);
+  }
+
+  void VoxelPath::MakeQCluster(const ::geoalgo::Vector& pt_1,
+			       const ::geoalgo::Vector& pt_2,
+			       QCluster_t& Q_cluster,
+			       double dedx) const {
+
+    if(dedx < 0) dedx = _dEdxMIP;
+    int last_voxel = -1;
+    TraverseSegment(pt_1, pt_2, dedx, nullptr, Q_cluster, last_voxel);
+  }
+
+  QCluster_t VoxelPath::MakeQCluster(const ::geoalgo::Trajectory& trj) const {
+
+    QCluster_t result;
+    result.clear();
+
+    // Upper bound of the number of points per segment: entry voxel, one voxel per crossed
+    // face, and the two parts outside the voxel grid
+    auto const& vox_def = DetectorSpecs::GetME().GetVoxelDef();
+    auto const size = vox_def.GetVoxelSize();
+    double num_points = 0.;
+    for (size_t i = 0; i + 1 < trj.size(); ++i) {
+      num_points += 3.;
+      for (size_t axis = 0; axis < 3; ++axis)
+	num_points += std::ceil(std::fabs(trj[i + 1][axis] - trj[i][axis]) / size[axis]) + 1.;
+    }
+    result.reserve(size_t(num_points));
+
+    auto const& bbox = DetectorSpecs::GetME().ActiveVolume();
+    int last_voxel = -1;
+    for (size_t i = 0; i + 1 < trj.size(); ++i)
+      TraverseSegment(trj[i], trj[i + 1], _dEdxMIP, &bbox, result, last_voxel);
+    FLASH_INFO() << result << std::endl;
+
+    return result;
+  }
+
+}
+
+#endif
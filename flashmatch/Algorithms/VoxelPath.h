@@ -0,0 +1,96 @@
+/**
+ * \file VoxelPath.h
+ *
+ * \ingroup Algorithms
+ *
+ * \brief Class def header for a class VoxelPath
+ *
+ * @author kazuhiro
+ */
+
+/** \addtogroup Algorithms
+
+    @{*/
+#ifndef VOXELPATH_H
+#define VOXELPATH_H
+
+#include <iostream>
+
+#include "flashmatch/GeoAlgo/GeoTrajectory.h"
+#include "flashmatch/GeoAlgo/GeoAABox.h"
+#include "flashmatch/Base/BaseAlgorithm.h"
+#include "flashmatch/Base/CustomAlgoFactory.h"
+
+namespace flashmatch{
+  /**
+     \class VoxelPath
+     Same interface and light yield as LightPath, but instead of a point every SegmentSize \n
+     the trajectory is walked through the photon library voxel grid (Amanatides-Woo \n
+     traversal) and each crossed voxel gets one point: the middle of the path inside the \n
+     voxel, with a charge proportional to the exact path length. Like LightPath, only the \n
+     part of the trajectory inside the active volume is used; a part inside the active \n
+     volume but outside the voxel grid gets one point per segment.
+  */
+  class VoxelPath : public flashmatch::BaseAlgorithm {
+
+  public:
+
+    /// Default constructor
+    VoxelPath(const std::string name="VoxelPath");
+
+    /// Default destructor
+    ~VoxelPath(){}
+
+    /// Charge cluster of a trajectory: one point per crossed voxel
+    flashmatch::QCluster_t MakeQCluster(const ::geoalgo::Trajectory& trj) const;
+
+    /// Appends the points of one segment (dedx < 0 uses the configured MIP dE/dx)
+    void MakeQCluster(const ::geoalgo::Vector& pt_1,
+		      const ::geoalgo::Vector& pt_2,
+		      flashmatch::QCluster_t& Q_cluster,
+		      double dedx=-1) const;
+
+    // Getter for light yield configured paramater
+    double GetLightYield() const { return _light_yield; }
+
+  protected:
+
+    void _Configure_(const Config_t &pset);
+
+    /**
+       Walks the segment pt_1 => pt_2 through the voxel grid and appends one point per voxel. \n
+       With a box, the segment is first clipped to it. A point in the same voxel as the last \n
+       point of Q_cluster is merged into it (path-length weighted position, summed charge), \n
+       so that a voxel crossed by consecutive segments gets a single point.
+    */
+    void TraverseSegment(const ::geoalgo::Vector& pt_1,
+			 const ::geoalgo::Vector& pt_2,
+			 double dedx,
+			 const ::geoalgo::AABox* box,
+			 flashmatch::QCluster_t& Q_cluster,
+			 int& last_voxel) const;
+
+    /// Appends the part [s0,s1] of a segment (start, unit direction) as one point in a voxel
+    void AddPoint(const double* start, const double* direct, double s0, double s1,
+		  double dedx, int voxel, flashmatch::QCluster_t& Q_cluster, int& last_voxel) const;
+
+    double _light_yield;
+    double _dEdxMIP;
+  };
+
+  /**
+     \class flashmatch::VoxelPathFactory
+  */
+  class VoxelPathFactory : public CustomAlgoFactoryBase {
+  public:
+    /// ctor
+    VoxelPathFactory() { CustomAlgoFactory::get().add_factory("VoxelPath",this); }
+    /// dtor
+    ~VoxelPathFactory() {}
+    /// creation method
+    BaseAlgorithm* create(const std::string instance_name) { return new VoxelPath(instance_name); }
+  };
+}
+
+#endif
+/** @} */ // end of doxygen group
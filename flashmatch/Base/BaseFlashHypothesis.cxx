@@ -2,6 +2,8 @@
 #define BASEFLASHHYPOTHESIS_CXX
 
 #include "BaseFlashHypothesis.h"
+#include "OpT0FinderException.h"
+#include "FMWKInterface.h"
 
 namespace flashmatch {
 
@@ -14,5 +16,63 @@ namespace flashmatch {
     return res;
   }
 
+  void BaseFlashHypothesis::FillEstimateBatch(const QCluster_t& tpc,
+					      const std::vector<double>& xoffset_v,
+					      std::vector<Flash_t>& flash_v) const
+  {
+    flash_v.resize(xoffset_v.size());
+    for(size_t i=0; i<xoffset_v.size(); ++i)
+      FillShiftedEstimate(tpc,xoffset_v[i],flash_v[i]);
+  }
+
+  void BaseFlashHypothesis::FillShiftedEstimate(const QCluster_t& tpc, const double xoffset,
+						Flash_t& flash, size_t level) const
+  {
+    thread_local QCluster_t thread_shifted;
+    auto& shifted = thread_shifted;
+    shifted.resize(tpc.size());
+    shifted.idx  = tpc.idx;
+    shifted.time = tpc.time;
+    for(size_t ipt=0; ipt<tpc.size(); ++ipt) {
+      shifted[ipt] = tpc[ipt];
+      shifted[ipt].x = tpc[ipt].x + xoffset;
+    }
+    FillEstimateAtLevel(shifted,flash,level);
+  }
+
+  void BaseFlashHypothesis::FillEstimateAtLevel(const QCluster_t& tpc, Flash_t& flash, size_t level) const
+  {
+    if(level >= NumLevels())
+      throw OpT0FinderException("Hypothesis level " + std::to_string(level) + " is not available in " + AlgorithmName());
+    FillEstimate(tpc,flash);
+  }
+
+  void BaseFlashHypothesis::FillEstimateWithGradient(const QCluster_t& tpc, const double xoffset,
+						     Flash_t& flash, Flash_t& grad) const
+  {
+    thread_local Flash_t thread_upper, thread_lower;
+    auto& upper = thread_upper;
+    auto& lower = thread_lower;
+    FillShiftedEstimate(tpc,xoffset,flash);
+    FillShiftedEstimate(tpc,xoffset + kGradientStep,upper);
+    FillShiftedEstimate(tpc,xoffset - kGradientStep,lower);
+    grad.pe_v.resize(flash.pe_v.size());
+    for(size_t i=0; i<flash.pe_v.size(); ++i)
+      grad.pe_v[i] = (upper.pe_v[i] - lower.pe_v[i]) / (2. * kGradientStep);
+  }
+
+  long BaseFlashHypothesis::LibraryVoxelKey(const QCluster_t& tpc, const double xoffset)
+  {
+    auto const& vox_def = DetectorSpecs::GetME().GetVoxelDef();
+    auto const  lower   = vox_def.GetRegionLowerCorner();
+    auto const  upper   = vox_def.GetRegionUpperCorner();
+    const int   nx      = vox_def.GetSteps()[0];
+    // Out-of-range indices are summed as well: whether a point is dropped only depends on them
+    long key = 0;
+    for(auto const& pt : tpc)
+      key += int ((pt.x + xoffset - lower[0]) / (upper[0]-lower[0]) * nx );
+    return key;
+  }
+
 }
 #endif
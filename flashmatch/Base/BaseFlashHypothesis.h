@@ -40,6 +40,70 @@ namespace flashmatch {
     /// Method to simply fill provided reference of flashmatch::Flash_t
     virtual void FillEstimate(const QCluster_t&, Flash_t&) const = 0;
 
+    /**
+       Fills the estimate for the cluster shifted by xoffset along x at a resolution level \n
+       (see FillEstimateAtLevel), without building a shifted copy of the cluster. The \n
+       default implementation shifts a per-thread copy (reused across calls) instead.
+    */
+    virtual void FillShiftedEstimate(const QCluster_t&, const double xoffset, Flash_t&, size_t level=0) const;
+
+    /**
+       Fills one hypothesis per x-offset: flash_v[i] is the estimate for the cluster shifted \n
+       by xoffset_v[i] along x (flash_v is resized to xoffset_v.size()). The default \n
+       implementation calls FillEstimate for each offset; algorithms can override it to \n
+       share the offset-independent part of the computation.
+    */
+    virtual void FillEstimateBatch(const QCluster_t&,
+				   const std::vector<double>& xoffset_v,
+				   std::vector<Flash_t>& flash_v) const;
+
+    /// Number of model resolution levels accepted by FillEstimateAtLevel (1 = full resolution only)
+    virtual size_t NumLevels() const { return 1; }
+
+    /**
+       Fills a hypothesis from a coarser model: level 0 is the full resolution (same as \n
+       FillEstimate), higher levels are cheaper approximations meant for the early steps of \n
+       a minimization. The default implementation only has level 0.
+    */
+    virtual void FillEstimateAtLevel(const QCluster_t&, Flash_t&, size_t level) const;
+
+    /// True if FillEstimateWithGradient computes the derivative in the same pass as the estimate
+    virtual bool HasGradient() const { return false; }
+
+    /// True if FillEstimateWithGradient is the exact derivative of FillShiftedEstimate (not an
+    /// approximation such as a difference of neighbouring voxels), so a minimizer can trust it
+    virtual bool HasExactGradient() const { return false; }
+
+    /**
+       Fills the estimate for the cluster shifted by xoffset and its derivative w.r.t. xoffset \n
+       (grad.pe_v[i] = dH_i/dx). The default implementation calls FillShiftedEstimate three \n
+       times (central difference with a kGradientStep shift); algorithms with HasGradient() \n
+       compute both in one pass.
+    */
+    virtual void FillEstimateWithGradient(const QCluster_t&, const double xoffset,
+					  Flash_t& flash, Flash_t& grad) const;
+
+    /**
+       Key of the estimate for the cluster shifted by xoffset (level 0): two offsets of the same \n
+       cluster with the same key have identical estimates, so a stored estimate can be reused \n
+       (see flashmatch::HypothesisCache). Returns false if the algorithm has no such key, e.g. \n
+       because its estimate changes continuously with x (default).
+    */
+    virtual bool ShiftKey(const QCluster_t&, const double xoffset, long& key) const { return false; }
+
+    /// x shift of the default finite-difference gradient [cm]
+    static constexpr double kGradientStep = 0.1;
+
+  protected:
+
+    /**
+       ShiftKey of an estimate that only depends on the photon library voxel of each point: \n
+       the sum of the x-voxel indices of the shifted points (same arithmetic as \n
+       sim::PhotonVoxelDef::GetVoxelID). Each index is non-decreasing in xoffset, so the sum \n
+       stays the same only while no point crosses an x-voxel boundary.
+    */
+    static long LibraryVoxelKey(const QCluster_t&, const double xoffset);
+
   };
 }
 #endif
@@ -15,11 +15,60 @@ namespace flashmatch {
     _flash_hypothesis->FillEstimate(tpc,opdet);
   }
 
+  void BaseFlashMatch::FillShiftedEstimate(const QCluster_t& tpc, const double xoffset,
+					   Flash_t& opdet, size_t level) const
+  {
+    _flash_hypothesis->FillShiftedEstimate(tpc,xoffset,opdet,level);
+  }
+
+  void BaseFlashMatch::FillEstimateBatch(const QCluster_t& tpc,
+					 const std::vector<double>& xoffset_v,
+					 std::vector<Flash_t>& opdet_v) const
+  {
+    _flash_hypothesis->FillEstimateBatch(tpc,xoffset_v,opdet_v);
+  }
+
+  void BaseFlashMatch::FillEstimateAtLevel(const QCluster_t& tpc, Flash_t& opdet, size_t level) const
+  {
+    _flash_hypothesis->FillEstimateAtLevel(tpc,opdet,level);
+  }
+
+  size_t BaseFlashMatch::NumHypothesisLevels() const
+  {
+    return _flash_hypothesis->NumLevels();
+  }
+
+  void BaseFlashMatch::FillEstimateWithGradient(const QCluster_t& tpc, const double xoffset,
+						Flash_t& opdet, Flash_t& grad) const
+  {
+    _flash_hypothesis->FillEstimateWithGradient(tpc,xoffset,opdet,grad);
+  }
+
+  bool BaseFlashMatch::HypothesisHasGradient() const
+  {
+    return _flash_hypothesis->HasGradient();
+  }
+
+  bool BaseFlashMatch::HypothesisHasExactGradient() const
+  {
+    return _flash_hypothesis->HasExactGradient();
+  }
+
+  bool BaseFlashMatch::HypothesisShiftKey(const QCluster_t& tpc, const double xoffset, long& key) const
+  {
+    return _flash_hypothesis->ShiftKey(tpc,xoffset,key);
+  }
+
   void BaseFlashMatch::SetFlashHypothesis(flashmatch::BaseFlashHypothesis* alg)
   {
     _flash_hypothesis = alg;
   }
 
+  void BaseFlashMatch::SetHypothesisStore(flashmatch::HypothesisStore* store)
+  {
+    _hypothesis_store = store;
+  }
+
 }
 
 #endif
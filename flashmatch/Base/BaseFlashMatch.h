@@ -16,6 +16,7 @@
 
 #include "BaseAlgorithm.h"
 #include "BaseFlashHypothesis.h"
+#include "HypothesisStore.h"
 namespace flashmatch {
 
   class FlashMatchManager;
@@ -33,6 +34,8 @@ namespace flashmatch {
     
     /// Default constructor
     BaseFlashMatch(const std::string name="noname") : BaseAlgorithm(kFlashMatch,name)
+      , _flash_hypothesis(nullptr)
+      , _hypothesis_store(nullptr)
     {}
     
     /// Default destructor
@@ -54,18 +57,64 @@ namespace flashmatch {
      */
     virtual FlashMatch_t Match(const QCluster_t&, const Flash_t&) = 0;
 
+    /**
+       Called by flashmatch::FlashMatchManager once per Match() call, before any pair is \n
+       evaluated, with all TPC objects and flashes of the event. Algorithms can precompute \n
+       quantities shared by many pairs here. Default: nothing.
+    */
+    virtual void PrepareMatch(const QClusterArray_t&, const FlashArray_t&) {}
+
+    /**
+       True if Match can be called concurrently from several threads on this instance. \n
+       flashmatch::FlashMatchManager only evaluates candidate pairs in parallel if so.
+    */
+    virtual bool ThreadSafe() const { return false; }
+
     /// Method to call flash hypothesis 
     Flash_t GetEstimate(const QCluster_t&) const;
 
     /// Method to simply fill provided reference of flashmatch::Flash_t
     void FillEstimate(const QCluster_t&, Flash_t&) const;
 
+    /// Method to fill a hypothesis for a cluster shifted along x (see BaseFlashHypothesis::FillShiftedEstimate)
+    void FillShiftedEstimate(const QCluster_t&, const double xoffset, Flash_t&, size_t level=0) const;
+
+    /// Method to fill hypotheses for a list of x-offsets (see BaseFlashHypothesis::FillEstimateBatch)
+    void FillEstimateBatch(const QCluster_t&, const std::vector<double>&, std::vector<Flash_t>&) const;
+
+    /// Method to fill a hypothesis at a model resolution level (see BaseFlashHypothesis::FillEstimateAtLevel)
+    void FillEstimateAtLevel(const QCluster_t&, Flash_t&, size_t level) const;
+
+    /// Number of resolution levels of the flash hypothesis algorithm
+    size_t NumHypothesisLevels() const;
+
+    /// Method to fill a hypothesis and its x derivative (see BaseFlashHypothesis::FillEstimateWithGradient)
+    void FillEstimateWithGradient(const QCluster_t&, const double xoffset, Flash_t&, Flash_t&) const;
+
+    /// True if the flash hypothesis algorithm has an analytic x derivative
+    bool HypothesisHasGradient() const;
+
+    /// True if that derivative is exact (see BaseFlashHypothesis::HasExactGradient)
+    bool HypothesisHasExactGradient() const;
+
+    /// x-offset key of the hypothesis (see BaseFlashHypothesis::ShiftKey), false if the algorithm has none
+    bool HypothesisShiftKey(const QCluster_t&, const double xoffset, long& key) const;
+
+  protected:
+
+    /// Event-scoped hypothesis store of the manager (nullptr if not available)
+    flashmatch::HypothesisStore* GetHypothesisStore() const { return _hypothesis_store; }
+
   private:
 
     void SetFlashHypothesis(flashmatch::BaseFlashHypothesis*);
 
+    void SetHypothesisStore(flashmatch::HypothesisStore*);
+
     flashmatch::BaseFlashHypothesis* _flash_hypothesis;
 
+    flashmatch::HypothesisStore* _hypothesis_store;
+
   };
 }
 
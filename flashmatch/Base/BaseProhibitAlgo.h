@@ -15,19 +15,25 @@
 #define OPT0FINDER_BASEPROHIBITALGO_H
 
 #include "BaseAlgorithm.h"
+#include "BaseFlashHypothesis.h"
 
 namespace flashmatch {
+
+  class FlashMatchManager;
+
   /**
      \class BaseProhibitAlgo
      Algorithm base class for prohibiting the match
      between a charge cluster and a flash \n
   */
   class BaseProhibitAlgo : public BaseAlgorithm{
+    friend class FlashMatchManager;
     
   public:
     
     /// Default constructor
     BaseProhibitAlgo(const std::string name="noname") : BaseAlgorithm(kMatchProhibit,name)
+      , _flash_hypothesis(nullptr)
     {}
  
     /// Default destructor
@@ -37,6 +43,23 @@ namespace flashmatch {
      * @brief CORE FUNCTION: determines if a flash and cluster are at all compatible (bool return)
      */
     virtual bool MatchCompatible(const QCluster_t& clus, const Flash_t& flash) = 0;
+
+    /**
+       Called by flashmatch::FlashMatchManager once per Match() call, before any pair is \n
+       inspected, with all TPC objects and flashes of the event. Default: nothing.
+    */
+    virtual void PrepareMatch(const QClusterArray_t&, const FlashArray_t&) {}
+
+  protected:
+
+    /// Flash hypothesis algorithm of the manager (nullptr if not available)
+    const flashmatch::BaseFlashHypothesis* GetFlashHypothesis() const { return _flash_hypothesis; }
+
+  private:
+
+    void SetFlashHypothesis(flashmatch::BaseFlashHypothesis* alg) { _flash_hypothesis = alg; }
+
+    flashmatch::BaseFlashHypothesis* _flash_hypothesis;
     
   };
 }
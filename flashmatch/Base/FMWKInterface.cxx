@@ -45,19 +45,68 @@ namespace flashmatch{
 
     _drift_velocity = p.get<double>("DriftVelocity");
 
-    _voxel_def = phot::PhotonVisibilityService::GetME().GetVoxelDef();
+    // Photon library file (relative to FMATCH_DATADIR unless absolute, ".plib" = binary format)
+    auto const library = p.get<std::string>("PhotonLibrary","PhotonLibrary-20180801.root");
+    auto& vis_service = phot::PhotonVisibilityService::GetME(library);
+    // Opt-in: one library copy per node in POSIX shared memory, shared by all processes
+    vis_service.SetSharedMemoryName(p.get<std::string>("SharedMemoryName",""));
+    // Optional compact in-memory encoding of the library (see phot::PhotonLibraryEncoding_t)
+    vis_service.SetLibraryEncoding(p.get<std::string>("PhotonLibraryEncoding","float32"));
+    vis_service.SetSparseLibrary(p.get<float>("SparseThreshold",0.), p.get<size_t>("SparseTopK",0));
+    // Optional compressed tiles decompressed on demand into a bounded cache (low memory use)
+    vis_service.SetLibraryCompression(p.get<std::vector<int> >("PhotonLibraryTileSize",std::vector<int>()),
+				      p.get<int>("PhotonLibraryCompression",101),
+				      p.get<size_t>("PhotonLibraryCacheSize",256));
+    // Optional coarse library levels (downsampling factors), e.g. for a coarse-to-fine minimization
+    vis_service.SetLibraryLevels(p.get<std::vector<int> >("PhotonLibraryLevels",std::vector<int>()));
+    // Optional mirror symmetries: only the fundamental domain of the library is kept in memory
+    auto const symmetry_axes = p.get<std::vector<std::string> >("SymmetryAxes",std::vector<std::string>());
+    auto const symmetry_planes = p.get<std::vector<double> >("SymmetryPlanes",std::vector<double>());
+    if(symmetry_axes.size() != symmetry_planes.size()) {
+      std::cerr << "DetectorSpecs: SymmetryAxes and SymmetryPlanes must have the same length" << std::endl;
+      throw std::exception();
+    }
+    std::vector<phot::PhotonLibrarySymmetry_t> symmetry_v;
+    for(size_t i=0; i<symmetry_axes.size(); ++i) {
+      auto const& axis = symmetry_axes[i];
+      if(axis != "x" && axis != "y" && axis != "z") {
+	std::cerr << "DetectorSpecs: unknown symmetry axis " << axis << " (x, y or z)" << std::endl;
+	throw std::exception();
+      }
+      phot::PhotonLibrarySymmetry_t symmetry;
+      symmetry.Axis = axis[0] - 'x';
+      symmetry.Plane = symmetry_planes[i];
+      std::string key = "SymmetryChannelMap" + std::string(1, axis[0] - 'x' + 'X');
+      symmetry.ChannelMap = p.get<std::vector<int> >(key);
+      symmetry_v.push_back(symmetry);
+    }
+    vis_service.SetLibrarySymmetries(symmetry_v, p.get<double>("SymmetryTolerance",0.));
+    _voxel_def_v.clear();
+    for(size_t level=0; level<vis_service.GetNLibraryLevels(); ++level)
+      _voxel_def_v.push_back(vis_service.GetVoxelDef(level));
 
   }
 
   float DetectorSpecs::GetVisibility(double x, double y, double z, unsigned int opch) const
   { return phot::PhotonVisibilityService::GetME().GetVisibility(x,y,z,opch); }
 
-  const std::vector<std::vector<float > >& DetectorSpecs::GetPhotonLibraryData() const
-  { return phot::PhotonVisibilityService::GetME().GetLibraryData(); }
+  phot::PhotonLibraryView DetectorSpecs::GetPhotonLibraryData(size_t level) const
+  { return phot::PhotonVisibilityService::GetME().GetLibraryData(level); }
+
+  void DetectorSpecs::PreloadPhotonLibrary() const
+  { phot::PhotonVisibilityService::GetME().Preload(); }
+
+  void DetectorSpecs::WaitPhotonLibrary() const
+  { phot::PhotonVisibilityService::GetME().WaitReady(); }
 
 #else
   DetectorSpecs::DetectorSpecs(std::string filename)
+    : _voxel_def_v(1)
   {}
+
+  // The photon library is a LArSoft service: nothing to preload here
+  void DetectorSpecs::PreloadPhotonLibrary() const {}
+  void DetectorSpecs::WaitPhotonLibrary() const {}
 #endif
 }
 
@@ -8,6 +8,7 @@
 #if USING_LARSOFT == 0
 #include "FMWKTools/ConfigManager.h"
 #include "FMWKTools/PhotonVoxels.h"
+#include "FMWKTools/PhotonLibrary.h"
 namespace flashmatch {
   /// Configuration object
   using Config_t = flashmatch::PSet;
@@ -49,18 +50,27 @@ namespace flashmatch {
     /// Visibility
     float GetVisibility(double x, double y, double z, unsigned int opch) const;
 
-    /// Photon Library data access FIXME
-    const std::vector<std::vector<float > >& GetPhotonLibraryData() const;
+    /// Photon Library data access: data[voxel] is a row of visibilities per optical channel.
+    /// level > 0 selects a downsampled library (see PhotonLibraryLevels in the configuration).
+    phot::PhotonLibraryView GetPhotonLibraryData(size_t level=0) const;
 
-    /// Voxel definition
-    inline const sim::PhotonVoxelDef& GetVoxelDef() const { return _voxel_def; }
+    /// Voxel definition (of a library level)
+    inline const sim::PhotonVoxelDef& GetVoxelDef(size_t level=0) const { return _voxel_def_v.at(level); }
+
+    /// Number of photon library resolution levels (1 = full resolution only)
+    inline size_t NumLibraryLevels() const { return _voxel_def_v.size(); }
+
+    /// Start loading the photon library in a background thread (returns immediately)
+    void PreloadPhotonLibrary() const;
+    /// Block until the photon library is loaded (rethrows a failure of the background load)
+    void WaitPhotonLibrary() const;
 
   private:
     static DetectorSpecs* _me;
     std::vector<geoalgo::Point_t> _pmt_v;
     geoalgo::AABox _bbox;
     double _drift_velocity;
-    sim::PhotonVoxelDef _voxel_def;
+    std::vector<sim::PhotonVoxelDef> _voxel_def_v; ///< Voxel definition per library level
   };
 
 }
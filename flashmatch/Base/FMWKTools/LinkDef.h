@@ -29,6 +29,12 @@
 #pragma link C++ class sim::PhotonVoxel+;
 #pragma link C++ class sim::PhotonVoxelDef+;
 #pragma link C++ class phot::PhotonVisibilityService+;
+#pragma link C++ enum phot::PhotonLibraryEncoding_t;
+#pragma link C++ class phot::PhotonLibrarySymmetry_t+;
+#pragma link C++ class std::vector<phot::PhotonLibrarySymmetry_t>+;
+#pragma link C++ class phot::PhotonLibraryRow+;
+#pragma link C++ class phot::PhotonLibraryView+;
+#pragma link C++ class phot::PhotonLibraryTiles+;
 #pragma link C++ class phot::PhotonLibrary+;
 
 //ADD_NEW_CLASS ... do not change this line
@@ -8,29 +8,1145 @@
 #include "PhotonLibrary.h"
 #include "PhotonVoxels.h"
 #include <iostream>
+#include <cstdlib>
+#include <cstring>
+#include <new>
+#include <atomic>
+#include <cerrno>
+#include <cmath>
+#include <algorithm>
+#include <cstdio>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 //#include "messagefacility/MessageLogger/MessageLogger.h"
 
 #include "TFile.h"
 #include "TTree.h"
 #include "TKey.h"
+#include "RZip.h"
+
+#if defined(__x86_64__) && (defined(__GNUC__) || defined(__clang__))
+#define PHOTONLIBRARY_X86_SIMD
+#include <immintrin.h>
+#endif
 
 namespace phot{
 
-  std::vector<float> PhotonLibrary::EmptyChannelsList; // used for invalid return value
+  //------------------------------------------------------------
+  // Multiply-accumulate kernels: out[i] += w * row[i], float row into double output.
+  // All variants do a separate multiply and add (no FMA) so they give identical results.
+
+  namespace {
+
+    typedef void (*MultiplyAccumulateFunc_t)(double, const float*, double*, size_t);
+
+    void MultiplyAccumulateScalar(double w, const float* row, double* out, size_t n)
+    {
+      for(size_t i=0; i<n; ++i) out[i] += w * row[i];
+    }
+
+#ifdef PHOTONLIBRARY_X86_SIMD
+    __attribute__((target("sse2")))
+    void MultiplyAccumulateSSE(double w, const float* row, double* out, size_t n)
+    {
+      const __m128d vw = _mm_set1_pd(w);
+      size_t i=0;
+      for(; i+4<=n; i+=4) {
+	__m128  r  = _mm_loadu_ps(row+i);
+	__m128d lo = _mm_cvtps_pd(r);
+	__m128d hi = _mm_cvtps_pd(_mm_movehl_ps(r,r));
+	_mm_storeu_pd(out+i,   _mm_add_pd(_mm_loadu_pd(out+i),   _mm_mul_pd(vw,lo)));
+	_mm_storeu_pd(out+i+2, _mm_add_pd(_mm_loadu_pd(out+i+2), _mm_mul_pd(vw,hi)));
+      }
+      for(; i<n; ++i) out[i] += w * row[i];
+    }
+
+    __attribute__((target("avx2")))
+    void MultiplyAccumulateAVX2(double w, const float* row, double* out, size_t n)
+    {
+      const __m256d vw = _mm256_set1_pd(w);
+      size_t i=0;
+      for(; i+8<=n; i+=8) {
+	__m256  r  = _mm256_loadu_ps(row+i);
+	__m256d lo = _mm256_cvtps_pd(_mm256_castps256_ps128(r));
+	__m256d hi = _mm256_cvtps_pd(_mm256_extractf128_ps(r,1));
+	_mm256_storeu_pd(out+i,   _mm256_add_pd(_mm256_loadu_pd(out+i),   _mm256_mul_pd(vw,lo)));
+	_mm256_storeu_pd(out+i+4, _mm256_add_pd(_mm256_loadu_pd(out+i+4), _mm256_mul_pd(vw,hi)));
+      }
+      for(; i<n; ++i) out[i] += w * row[i];
+    }
+#endif
+
+    MultiplyAccumulateFunc_t SelectMultiplyAccumulate()
+    {
+#ifdef PHOTONLIBRARY_X86_SIMD
+      __builtin_cpu_init();
+      if(__builtin_cpu_supports("avx2")) return MultiplyAccumulateAVX2;
+      if(__builtin_cpu_supports("sse2")) return MultiplyAccumulateSSE;
+#endif
+      return MultiplyAccumulateScalar;
+    }
+  }
 
   //------------------------------------------------------------
+  // Compact encodings (see PhotonLibraryEncoding_t). Encoded rows store uint16 codes and
+  // one (offset, scale) pair per voxel. float16 values are relative to the voxel maximum,
+  // which keeps small visibilities away from the half-precision underflow.
 
-  PhotonLibrary::PhotonLibrary()
+  namespace {
+
+    /// IEEE half => float
+    inline float HalfToFloat(uint16_t h)
+    {
+      uint32_t sign = (uint32_t)(h & 0x8000) << 16;
+      uint32_t exp  = (h >> 10) & 0x1f;
+      uint32_t mant = h & 0x3ff;
+      uint32_t bits;
+      if(exp == 0) {
+	// zero or subnormal: mant * 2^-24
+	float value = mant * (1.f / 16777216.f);
+	return (sign ? -value : value);
+      }
+      else if(exp == 31) bits = sign | 0x7f800000 | (mant << 13);
+      else bits = sign | ((exp + 112) << 23) | (mant << 13);
+      float value;
+      memcpy(&value, &bits, sizeof(value));
+      return value;
+    }
+
+    /// float => IEEE half (round to nearest even)
+    inline uint16_t FloatToHalf(float value)
+    {
+      uint32_t bits;
+      memcpy(&bits, &value, sizeof(bits));
+      uint32_t sign = (bits >> 16) & 0x8000;
+      int32_t  exp  = (int32_t)((bits >> 23) & 0xff) - 127 + 15;
+      uint32_t mant = bits & 0x7fffff;
+      if(exp >= 31) return sign | 0x7c00;
+      if(exp <= 0) {
+	if(exp < -10) return sign;
+	mant |= 0x800000;
+	uint32_t shift = 14 - exp;
+	uint32_t h   = mant >> shift;
+	uint32_t rem = mant & ((1u << shift) - 1);
+	uint32_t half = 1u << (shift - 1);
+	if(rem > half || (rem == half && (h & 1))) ++h;
+	return sign | h;
+      }
+      uint32_t h   = ((uint32_t)(exp) << 10) | (mant >> 13);
+      uint32_t rem = mant & 0x1fff;
+      if(rem > 0x1000 || (rem == 0x1000 && (h & 1))) ++h;
+      return sign | h;
+    }
+
+    typedef void (*MultiplyAccumulateHalfFunc_t)(double, const uint16_t*, double*, size_t);
+
+    void MultiplyAccumulateHalfScalar(double w, const uint16_t* row, double* out, size_t n)
+    {
+      for(size_t i=0; i<n; ++i) out[i] += w * HalfToFloat(row[i]);
+    }
+
+#ifdef PHOTONLIBRARY_X86_SIMD
+    __attribute__((target("avx2,f16c")))
+    void MultiplyAccumulateHalfAVX2(double w, const uint16_t* row, double* out, size_t n)
+    {
+      const __m256d vw = _mm256_set1_pd(w);
+      size_t i=0;
+      for(; i+8<=n; i+=8) {
+	__m256  r  = _mm256_cvtph_ps(_mm_loadu_si128((const __m128i*)(row+i)));
+	__m256d lo = _mm256_cvtps_pd(_mm256_castps256_ps128(r));
+	__m256d hi = _mm256_cvtps_pd(_mm256_extractf128_ps(r,1));
+	_mm256_storeu_pd(out+i,   _mm256_add_pd(_mm256_loadu_pd(out+i),   _mm256_mul_pd(vw,lo)));
+	_mm256_storeu_pd(out+i+4, _mm256_add_pd(_mm256_loadu_pd(out+i+4), _mm256_mul_pd(vw,hi)));
+      }
+      for(; i<n; ++i) out[i] += w * HalfToFloat(row[i]);
+    }
+#endif
+
+    MultiplyAccumulateHalfFunc_t SelectMultiplyAccumulateHalf()
+    {
+#ifdef PHOTONLIBRARY_X86_SIMD
+      __builtin_cpu_init();
+      // every AVX2 processor also has F16C
+      if(__builtin_cpu_supports("avx2")) return MultiplyAccumulateHalfAVX2;
+#endif
+      return MultiplyAccumulateHalfScalar;
+    }
+
+    void MultiplyAccumulateLinear(double w, const uint16_t* row, double* out, size_t n)
+    {
+      for(size_t i=0; i<n; ++i) out[i] += w * row[i];
+    }
+
+    /// Sparse row: only the stored channels are touched (same multiply and add as dense rows)
+    void MultiplyAccumulateSparse(double w, const float* values, const uint16_t* channels,
+				  double* out, size_t nnz)
+    {
+      for(size_t i=0; i<nnz; ++i) out[channels[i]] += w * values[i];
+    }
+
+    /// Row of a mirrored voxel: channel i reads the stored channel perm[i]
+    void MultiplyAccumulatePermuted(double w, const float* row, const uint16_t* perm,
+				    double* out, size_t n)
+    {
+      for(size_t i=0; i<n; ++i) out[i] += w * row[perm[i]];
+    }
+
+    void MultiplyAccumulateLog(double w, double offset, double scale,
+			       const uint16_t* row, double* out, size_t n)
+    {
+      for(size_t i=0; i<n; ++i)
+	if(row[i]) out[i] += w * std::exp(offset + (row[i] - 1) * scale);
+    }
+
+    /// Encode one row of n visibilities, returns (offset, scale)
+    void EncodeRow(PhotonLibraryEncoding_t encoding, const float* row, size_t n,
+		   uint16_t* codes, float& offset, float& scale)
+    {
+      offset = 0.;
+      scale  = 0.;
+      float vmax = 0.;
+      float vmin = 0.;
+      for(size_t i=0; i<n; ++i) {
+	float v = (encoding == kEncodingFloat16 ? std::fabs(row[i]) : row[i]);
+	if(v > vmax) vmax = v;
+	if(v > 0. && (vmin == 0. || v < vmin)) vmin = v;
+      }
+      if(vmax <= 0.) {
+	for(size_t i=0; i<n; ++i) codes[i] = 0;
+	return;
+      }
+      switch(encoding) {
+      case kEncodingFloat16:
+	scale = vmax;
+	for(size_t i=0; i<n; ++i) codes[i] = FloatToHalf(row[i] / vmax);
+	break;
+      case kEncodingUInt16Linear:
+	scale = vmax / 65535.;
+	for(size_t i=0; i<n; ++i) {
+	  double code = (row[i] > 0. ? std::round(row[i] / scale) : 0.);
+	  codes[i] = (uint16_t)(std::min(code, 65535.));
+	}
+	break;
+      case kEncodingUInt16Log:
+	offset = std::log(vmin);
+	scale  = (std::log(vmax) - offset) / 65534.;
+	for(size_t i=0; i<n; ++i) {
+	  if(row[i] <= 0.) { codes[i] = 0; continue; }
+	  double code = (scale > 0. ? std::round((std::log(row[i]) - offset) / scale) : 0.);
+	  codes[i] = (uint16_t)(1 + std::max(0., std::min(code, 65534.)));
+	}
+	break;
+      default:
+	break;
+      }
+    }
+  }
+
+  PhotonLibraryEncoding_t PhotonLibraryEncodingFromName(const std::string& name)
+  {
+    if(name == "float32")   return kEncodingFloat32;
+    if(name == "float16")   return kEncodingFloat16;
+    if(name == "uint16")    return kEncodingUInt16Linear;
+    if(name == "uint16log") return kEncodingUInt16Log;
+    if(name == "sparse")    return kEncodingSparse;
+    std::cerr << "Unknown photon library encoding: " << name
+	      << " (supported: float32, float16, uint16, uint16log, sparse)" << std::endl;
+    throw std::exception();
+  }
+
+  std::string PhotonLibraryEncodingName(PhotonLibraryEncoding_t encoding)
+  {
+    switch(encoding) {
+    case kEncodingFloat16:      return "float16";
+    case kEncodingUInt16Linear: return "uint16";
+    case kEncodingUInt16Log:    return "uint16log";
+    case kEncodingSparse:       return "sparse";
+    default:                    return "float32";
+    }
+  }
+
+  float PhotonLibraryRow::Decode(size_t OpChannel) const
+  {
+    if(fPermutation)
+      return ((const float*)(fData))[fPermutation[OpChannel]];
+    if(fEncoding == kEncodingSparse) {
+      auto iter = std::lower_bound(fChannels, fChannels + fNNZ, OpChannel);
+      return (iter != fChannels + fNNZ && *iter == OpChannel ? ((const float*)(fData))[iter - fChannels] : 0.);
+    }
+    uint16_t code = ((const uint16_t*)(fData))[OpChannel];
+    switch(fEncoding) {
+    case kEncodingFloat16:      return HalfToFloat(code) * fScale;
+    case kEncodingUInt16Linear: return code * fScale;
+    case kEncodingUInt16Log:    return (code ? std::exp(fOffset + (code - 1) * (double)(fScale)) : 0.);
+    default:                    return ((const float*)(fData))[OpChannel];
+    }
+  }
+
+  void PhotonLibraryRow::MultiplyAccumulate(double weight, double* out) const
+  {
+    switch(fEncoding) {
+    case kEncodingFloat32: {
+      if(fPermutation) {
+	MultiplyAccumulatePermuted(weight, (const float*)(fData), fPermutation, out, fSize);
+	break;
+      }
+      static const MultiplyAccumulateFunc_t kernel = SelectMultiplyAccumulate();
+      kernel(weight, (const float*)(fData), out, fSize);
+      break;
+    }
+    case kEncodingFloat16: {
+      static const MultiplyAccumulateHalfFunc_t kernel = SelectMultiplyAccumulateHalf();
+      kernel(weight * fScale, (const uint16_t*)(fData), out, fSize);
+      break;
+    }
+    case kEncodingUInt16Linear:
+      MultiplyAccumulateLinear(weight * fScale, (const uint16_t*)(fData), out, fSize);
+      break;
+    case kEncodingUInt16Log:
+      MultiplyAccumulateLog(weight, fOffset, fScale, (const uint16_t*)(fData), out, fSize);
+      break;
+    case kEncodingSparse:
+      MultiplyAccumulateSparse(weight, (const float*)(fData), fChannels, out, fNNZ);
+      break;
+    }
+  }
+
+  PhotonLibraryRow PhotonLibraryView::TileRow(size_t Voxel) const
+  { return fTiles->Row(Voxel); }
+
+  //------------------------------------------------------------
+  // Compressed tiles (see PhotonLibraryTiles)
+
+  namespace {
+    /// Largest block R__zip compresses at once (3-byte sizes in its block header)
+    const size_t kMaxZipBlock = 0xffffff;
+    /// Size of the R__zip block header
+    const size_t kZipHeaderSize = 9;
+
+    /// Group the i-th byte of all floats together: exponents and high mantissa bytes of
+    /// neighbouring visibilities are similar, which the codec then compresses much better
+    void ShuffleBytes(const unsigned char* in, unsigned char* out, size_t nfloats)
+    {
+      for(size_t i=0; i<nfloats; ++i)
+	for(size_t b=0; b<sizeof(float); ++b)
+	  out[b * nfloats + i] = in[i * sizeof(float) + b];
+    }
+
+    void UnshuffleBytes(const unsigned char* in, unsigned char* out, size_t nfloats)
+    {
+      for(size_t b=0; b<sizeof(float); ++b)
+	for(size_t i=0; i<nfloats; ++i)
+	  out[i * sizeof(float) + b] = in[b * nfloats + i];
+    }
+  }
+
+  PhotonLibraryTiles::PhotonLibraryTiles(const PhotonLibraryView& Data, const sim::PhotonVoxelDef& VoxelDef,
+					 const std::vector<int>& TileSize, int Compression, size_t CacheBytes)
+    : fTileVoxels(1)
+    , fNOpChannels(Data.NOpChannels())
+    , fNumShards(0)
+    , fShards(nullptr)
+  {
+    if(TileSize.size() != 3 || TileSize[0] < 1 || TileSize[1] < 1 || TileSize[2] < 1) {
+      std::cerr << "Photon library tile size must be 3 positive numbers of voxels (x, y, z)" << std::endl;
+      throw std::exception();
+    }
+    if((int)(Data.size()) != VoxelDef.GetNVoxels()) {
+      std::cerr << "Photon library has " << Data.size() << " voxels but its voxel definition "
+		<< VoxelDef.GetNVoxels() << ": cannot split it in tiles" << std::endl;
+      throw std::exception();
+    }
+    for(size_t i=0; i<3; ++i) {
+      fSteps[i]    = VoxelDef.GetSteps()[i];
+      fTileSize[i] = TileSize[i];
+      fNTiles[i]   = (fSteps[i] + fTileSize[i] - 1) / fTileSize[i];
+      fTileVoxels *= fTileSize[i];
+    }
+    if(TileBytes() > ((size_t)(1) << 31)) {
+      std::cerr << "Photon library tile too large (" << TileBytes() << " bytes)" << std::endl;
+      throw std::exception();
+    }
+
+    const size_t ntiles = (size_t)(fNTiles[0]) * fNTiles[1] * fNTiles[2];
+    fCompressed.resize(ntiles);
+    fStored.assign(ntiles, false);
+    std::vector<char> stored(ntiles, 0); // std::vector<bool> cannot be written by several threads
+
+    #pragma omp parallel
+    {
+      const size_t nfloats = fTileVoxels * fNOpChannels;
+      std::vector<float> raw(nfloats);
+      std::vector<unsigned char> shuffled(nfloats * sizeof(float));
+      std::vector<unsigned char> zipped;
+      #pragma omp for schedule(dynamic)
+      for(size_t tile=0; tile<ntiles; ++tile) {
+	// Gather the tile rows (voxels outside the grid are zero)
+	const int tx = tile % fNTiles[0];
+	const int ty = (tile / fNTiles[0]) % fNTiles[1];
+	const int tz = tile / ((size_t)(fNTiles[0]) * fNTiles[1]);
+	std::fill(raw.begin(), raw.end(), 0.);
+	for(int lz=0; lz<fTileSize[2]; ++lz) {
+	  const int z = tz * fTileSize[2] + lz;
+	  if(z >= fSteps[2]) break;
+	  for(int ly=0; ly<fTileSize[1]; ++ly) {
+	    const int y = ty * fTileSize[1] + ly;
+	    if(y >= fSteps[1]) break;
+	    for(int lx=0; lx<fTileSize[0]; ++lx) {
+	      const int x = tx * fTileSize[0] + lx;
+	      if(x >= fSteps[0]) break;
+	      auto const row = Data[x + y * (size_t)(fSteps[0]) + z * (size_t)(fSteps[0]) * fSteps[1]];
+	      float* out = &(raw[(lx + ly * fTileSize[0] + lz * fTileSize[0] * fTileSize[1]) * fNOpChannels]);
+	      for(size_t ch=0; ch<fNOpChannels; ++ch) out[ch] = row[ch];
+	    }
+	  }
+	}
+	ShuffleBytes((const unsigned char*)(raw.data()), shuffled.data(), nfloats);
+
+	// Compress block by block; keep the tile as is if the codec does not reduce it
+	const size_t nbytes = shuffled.size();
+	zipped.resize(nbytes);
+	size_t in_pos = 0, out_pos = 0;
+	bool ok = true;
+	while(ok && in_pos < nbytes) {
+	  int srcsize = std::min(nbytes - in_pos, kMaxZipBlock);
+	  int tgtsize = std::min(nbytes - out_pos, kMaxZipBlock + kZipHeaderSize);
+	  int irep = 0;
+	  if(tgtsize > (int)(kZipHeaderSize))
+	    R__zip(Compression, &srcsize, (char*)(shuffled.data() + in_pos),
+		   &tgtsize, (char*)(zipped.data() + out_pos), &irep);
+	  ok = (irep > 0);
+	  in_pos  += srcsize;
+	  out_pos += irep;
+	}
+	if(ok)
+	  fCompressed[tile].assign(zipped.begin(), zipped.begin() + out_pos);
+	else {
+	  fCompressed[tile] = shuffled;
+	  stored[tile] = 1;
+	}
+      }
+    }
+    for(size_t tile=0; tile<ntiles; ++tile) fStored[tile] = stored[tile];
+
+    SetCacheSize(CacheBytes);
+  }
+
+  PhotonLibraryTiles::~PhotonLibraryTiles()
+  {
+    delete[] fShards;
+  }
+
+  void PhotonLibraryTiles::SetCacheSize(size_t CacheBytes)
+  {
+    size_t capacity = std::max(CacheBytes / TileBytes(), (size_t)(1));
+    // One lock per shard: up to 16 shards with at least 4 tiles each
+    size_t nshards = std::max(std::min(capacity / 4, (size_t)(16)), (size_t)(1));
+    delete[] fShards;
+    fShards    = new Shard_t[nshards];
+    fNumShards = nshards;
+    for(size_t i=0; i<nshards; ++i)
+      fShards[i].Capacity = capacity / nshards + (i < capacity % nshards ? 1 : 0);
+  }
+
+  void PhotonLibraryTiles::ClearCache()
+  {
+    for(size_t i=0; i<fNumShards; ++i) {
+      std::lock_guard<std::mutex> lock(fShards[i].Mutex);
+      fShards[i].LRU.clear();
+      fShards[i].Index.clear();
+    }
+  }
+
+  void PhotonLibraryTiles::ResetStats()
   {
-    fLookupTable.clear();
+    for(size_t i=0; i<fNumShards; ++i) {
+      std::lock_guard<std::mutex> lock(fShards[i].Mutex);
+      fShards[i].NumHits = fShards[i].NumMisses = fShards[i].NumEvictions = 0;
+    }
+  }
+
+  size_t PhotonLibraryTiles::CompressedBytes() const
+  {
+    size_t nbytes = 0;
+    for(auto const& tile : fCompressed) nbytes += tile.size();
+    return nbytes;
+  }
+
+  size_t PhotonLibraryTiles::CacheCapacity() const
+  {
+    size_t capacity = 0;
+    for(size_t i=0; i<fNumShards; ++i) capacity += fShards[i].Capacity;
+    return capacity;
+  }
+
+  size_t PhotonLibraryTiles::NumCachedTiles() const
+  {
+    size_t num = 0;
+    for(size_t i=0; i<fNumShards; ++i) {
+      std::lock_guard<std::mutex> lock(fShards[i].Mutex);
+      num += fShards[i].Index.size();
+    }
+    return num;
+  }
+
+  size_t PhotonLibraryTiles::NumHits() const
+  {
+    size_t num = 0;
+    for(size_t i=0; i<fNumShards; ++i) {
+      std::lock_guard<std::mutex> lock(fShards[i].Mutex);
+      num += fShards[i].NumHits;
+    }
+    return num;
+  }
+
+  size_t PhotonLibraryTiles::NumMisses() const
+  {
+    size_t num = 0;
+    for(size_t i=0; i<fNumShards; ++i) {
+      std::lock_guard<std::mutex> lock(fShards[i].Mutex);
+      num += fShards[i].NumMisses;
+    }
+    return num;
   }
 
+  size_t PhotonLibraryTiles::NumEvictions() const
+  {
+    size_t num = 0;
+    for(size_t i=0; i<fNumShards; ++i) {
+      std::lock_guard<std::mutex> lock(fShards[i].Mutex);
+      num += fShards[i].NumEvictions;
+    }
+    return num;
+  }
+
+  PhotonLibraryTiles::Tile_t PhotonLibraryTiles::Decompress(size_t Tile) const
+  {
+    const size_t nfloats = fTileVoxels * fNOpChannels;
+    auto const& zipped = fCompressed[Tile];
+    std::vector<unsigned char> shuffled;
+    const unsigned char* src = zipped.data();
+    if(!fStored[Tile]) {
+      shuffled.resize(nfloats * sizeof(float));
+      size_t in_pos = 0, out_pos = 0;
+      while(in_pos < zipped.size()) {
+	int srcsize = 0, tgtsize = 0;
+	if(zipped.size() - in_pos < kZipHeaderSize ||
+	   R__unzip_header(&srcsize, (unsigned char*)(zipped.data() + in_pos), &tgtsize) ||
+	   in_pos + srcsize > zipped.size() || out_pos + tgtsize > shuffled.size()) {
+	  std::cerr << "Corrupted photon library tile " << Tile << std::endl;
+	  throw std::exception();
+	}
+	int irep = 0;
+	R__unzip(&srcsize, (unsigned char*)(zipped.data() + in_pos), &tgtsize, shuffled.data() + out_pos, &irep);
+	if(irep != tgtsize) {
+	  std::cerr << "Failed to decompress photon library tile " << Tile << std::endl;
+	  throw std::exception();
+	}
+	in_pos  += srcsize;
+	out_pos += tgtsize;
+      }
+      src = shuffled.data();
+    }
+    auto tile = std::make_shared<std::vector<float> >(nfloats);
+    UnshuffleBytes(src, (unsigned char*)(tile->data()), nfloats);
+    return tile;
+  }
+
+  PhotonLibraryRow PhotonLibraryTiles::Row(size_t Voxel) const
+  {
+    const size_t nxy = (size_t)(fSteps[0]) * fSteps[1];
+    if(Voxel >= nxy * fSteps[2]) return PhotonLibraryRow();
+    const int x = Voxel % fSteps[0];
+    const int y = (Voxel / fSteps[0]) % fSteps[1];
+    const int z = Voxel / nxy;
+    const size_t tile  = (x / fTileSize[0]) + (y / fTileSize[1]) * fNTiles[0]
+      + (size_t)(z / fTileSize[2]) * fNTiles[0] * fNTiles[1];
+    const size_t local = (x % fTileSize[0]) + (y % fTileSize[1]) * fTileSize[0]
+      + (z % fTileSize[2]) * fTileSize[0] * fTileSize[1];
+
+    auto& shard = fShards[tile % fNumShards];
+    Tile_t data;
+    {
+      std::lock_guard<std::mutex> lock(shard.Mutex);
+      auto iter = shard.Index.find(tile);
+      if(iter != shard.Index.end()) {
+	++shard.NumHits;
+	shard.LRU.splice(shard.LRU.begin(), shard.LRU, (*iter).second);
+	data = (*(*iter).second).second;
+      }
+      else
+	++shard.NumMisses;
+    }
+    if(!data) {
+      // Decompress outside the lock; if another thread inserted it meanwhile, use its copy
+      data = Decompress(tile);
+      std::lock_guard<std::mutex> lock(shard.Mutex);
+      auto iter = shard.Index.find(tile);
+      if(iter != shard.Index.end())
+	data = (*(*iter).second).second;
+      else {
+	if(shard.Index.size() >= shard.Capacity) {
+	  shard.Index.erase(shard.LRU.back().first);
+	  shard.LRU.pop_back();
+	  ++shard.NumEvictions;
+	}
+	shard.LRU.emplace_front(tile, data);
+	shard.Index[tile] = shard.LRU.begin();
+      }
+    }
+    return PhotonLibraryRow(data->data() + local * fNOpChannels, fNOpChannels, data);
+  }
+
+  //------------------------------------------------------------
+  // Native binary / shared-memory format helpers
+
+  namespace {
+    const char   kBinaryMagic[8]   = {'F','M','P','H','L','I','B','1'};
+    const uint32_t kBinaryVersion  = 1;
+    const uint64_t kBinaryPageSize = 4096;
+
+    /// Control block of a shared-memory library, stored right after the header
+    struct SharedControl_t {
+      std::atomic<uint32_t> Ready;    ///< Set (last) by the publishing process
+      std::atomic<int32_t>  RefCount; ///< Number of attached processes
+      char Source[1024];              ///< File the library was loaded from
+    };
+    const size_t kSharedControlOffset =
+      (sizeof(PhotonLibraryHeader_t) + PhotonLibrary::kAlignment - 1) / PhotonLibrary::kAlignment * PhotonLibrary::kAlignment;
+    static_assert(ATOMIC_INT_LOCK_FREE == 2, "shared-memory reference counting needs lock-free atomics");
+    static_assert(kSharedControlOffset + sizeof(SharedControl_t) <= kBinaryPageSize,
+		  "shared-memory control block must fit in the header page");
+
+    /// Seconds to wait for another process to publish a shared-memory library
+    const double kSharedWaitTimeout = 600.;
+
+    inline SharedControl_t* SharedControl(void* base)
+    { return (SharedControl_t*)((char*)(base) + kSharedControlOffset); }
+
+    void FillHeader(PhotonLibraryHeader_t& header,
+		    size_t NVoxels, size_t NOpChannels, size_t Stride,
+		    const sim::PhotonVoxelDef& VoxelDef)
+    {
+      memset(&header, 0, sizeof(header));
+      memcpy(header.Magic, kBinaryMagic, sizeof(header.Magic));
+      header.Version     = kBinaryVersion;
+      header.HeaderSize  = sizeof(header);
+      header.NVoxels     = NVoxels;
+      header.NOpChannels = NOpChannels;
+      header.Stride      = Stride;
+      header.DataOffset  = kBinaryPageSize;
+      auto const lower = VoxelDef.GetRegionLowerCorner();
+      auto const upper = VoxelDef.GetRegionUpperCorner();
+      auto const steps = VoxelDef.GetSteps();
+      for(size_t i=0; i<3; ++i) {
+	header.LowerCorner[i] = lower[i];
+	header.UpperCorner[i] = upper[i];
+	header.Steps[i]       = (int32_t)(steps[i]);
+      }
+    }
+
+    /// Empty string if the header is consistent with the buffer size and voxel definition
+    std::string CheckHeader(const PhotonLibraryHeader_t& header, size_t size,
+			    const sim::PhotonVoxelDef& VoxelDef)
+    {
+      if(memcmp(header.Magic, kBinaryMagic, sizeof(header.Magic)) != 0)
+	return "not a binary photon library (bad magic)";
+      if(header.Version != kBinaryVersion || header.HeaderSize != sizeof(header))
+	return "unsupported binary library version";
+      if(header.Stride < header.NOpChannels || header.DataOffset % PhotonLibrary::kAlignment)
+	return "inconsistent row layout";
+      if(header.DataOffset + header.NVoxels * header.Stride * sizeof(float) > size)
+	return "file is truncated";
+      sim::PhotonVoxelDef file_def(header.LowerCorner[0], header.UpperCorner[0], header.Steps[0],
+				   header.LowerCorner[1], header.UpperCorner[1], header.Steps[1],
+				   header.LowerCorner[2], header.UpperCorner[2], header.Steps[2]);
+      if(file_def != VoxelDef || (int)(header.NVoxels) != VoxelDef.GetNVoxels())
+	return "voxel definition does not match the service";
+      return "";
+    }
+  }
+
+  //------------------------------------------------------------
+
+  PhotonLibrary::PhotonLibrary()
+    : fData(nullptr)
+    , fMappedBase(nullptr)
+    , fMappedSize(0)
+    , fEncoding(kEncodingFloat32)
+    , fCodes(nullptr)
+    , fTiles(nullptr)
+    , fNStoredVoxels(0)
+    , fNOpChannels(0)
+    , fNVoxels(0)
+    , fStride(0)
+  {}
+
 
   //------------------------------------------------------------
 
   PhotonLibrary::~PhotonLibrary()
   {
-    fLookupTable.clear();
+    Release();
+  }
+
+  //------------------------------------------------------------
+
+  void PhotonLibrary::Release()
+  {
+    if(fMappedBase) {
+      // The last process detaching from a shared library removes the segment. Attaching never
+      // increments a count of 0, so a segment republished under the same name is not affected.
+      if(!fSharedName.empty() && SharedControl(fMappedBase)->RefCount.fetch_sub(1) == 1)
+	shm_unlink(fSharedName.c_str());
+      munmap(fMappedBase, fMappedSize);
+      fMappedBase = nullptr;
+      fMappedSize = 0;
+      fSharedName.clear();
+    }
+    else
+      free(fData);
+    fData = nullptr;
+    free(fCodes);
+    fCodes = nullptr;
+    fParam.clear();
+    delete fTiles;
+    fTiles = nullptr;
+    std::vector<uint64_t>().swap(fSparseOffsets);
+    std::vector<uint16_t>().swap(fSparseChannels);
+    std::vector<float>().swap(fSparseValues);
+    std::vector<uint32_t>().swap(fFold);
+    std::vector<uint16_t>().swap(fFoldChannels);
+    fNStoredVoxels = 0;
+    fEncoding = kEncodingFloat32;
+    fNVoxels = fNOpChannels = fStride = 0;
+  }
+
+  //------------------------------------------------------------
+
+  void PhotonLibrary::Allocate(size_t NVoxels, size_t NOpChannels)
+  {
+    Release();
+    // Pad rows to a whole number of cache lines so that every row starts aligned
+    const size_t floats_per_line = kAlignment / sizeof(float);
+    size_t stride = (NOpChannels + floats_per_line - 1) / floats_per_line * floats_per_line;
+    size_t nbytes = NVoxels * stride * sizeof(float);
+    void* ptr = nullptr;
+    if(nbytes && posix_memalign(&ptr, kAlignment, nbytes)) {
+      std::cerr << "Failed to allocate photon library (" << nbytes << " bytes)" << std::endl;
+      throw std::bad_alloc();
+    }
+    if(nbytes) memset(ptr, 0, nbytes);
+    fData        = (float*)ptr;
+    fNVoxels     = NVoxels;
+    fNOpChannels = NOpChannels;
+    fStride      = stride;
+  }
+
+  //------------------------------------------------------------
+
+  void PhotonLibrary::Encode(PhotonLibraryEncoding_t Encoding)
+  {
+    if(Encoding == fEncoding) return;
+    if(fTiles) {
+      std::cerr << "A compressed photon library cannot be encoded" << std::endl;
+      throw std::exception();
+    }
+    if(IsFolded()) {
+      std::cerr << "A folded photon library cannot be encoded" << std::endl;
+      throw std::exception();
+    }
+    if(fEncoding != kEncodingFloat32 || (!fData && fNVoxels)) {
+      std::cerr << "Photon library can only be encoded from float32 (current: "
+		<< PhotonLibraryEncodingName(fEncoding) << ")" << std::endl;
+      throw std::exception();
+    }
+    if(Encoding == kEncodingFloat32) return;
+    if(Encoding == kEncodingSparse) {
+      Sparsify(0., 0);
+      return;
+    }
+
+    // Rows of uint16 codes, padded to whole cache lines like the float rows
+    const size_t codes_per_line = kAlignment / sizeof(uint16_t);
+    size_t stride = (fNOpChannels + codes_per_line - 1) / codes_per_line * codes_per_line;
+    size_t nbytes = fNVoxels * stride * sizeof(uint16_t);
+    void* ptr = nullptr;
+    if(nbytes && posix_memalign(&ptr, kAlignment, nbytes)) {
+      std::cerr << "Failed to allocate encoded photon library (" << nbytes << " bytes)" << std::endl;
+      throw std::bad_alloc();
+    }
+    if(nbytes) memset(ptr, 0, nbytes);
+    uint16_t* codes = (uint16_t*)ptr;
+    std::vector<float> param(2 * fNVoxels, 0.);
+
+    const float* data = fData;
+    const size_t nvoxels = fNVoxels;
+    const size_t nchannels = fNOpChannels;
+    const size_t data_stride = fStride;
+    #pragma omp parallel for schedule(static)
+    for(size_t ivox=0; ivox<nvoxels; ++ivox)
+      EncodeRow(Encoding, data + ivox * data_stride, nchannels,
+		codes + ivox * stride, param[2*ivox], param[2*ivox+1]);
+
+    std::cout << "Encoded photon library as " << PhotonLibraryEncodingName(Encoding)
+	      << " (" << nbytes / (1024*1024) << " MB)" << std::endl;
+
+    // Drop the float rows (frees, unmaps or detaches them), keep the encoded ones
+    Release();
+    fEncoding    = Encoding;
+    fCodes       = codes;
+    fParam.swap(param);
+    fNVoxels     = nvoxels;
+    fNOpChannels = nchannels;
+    fStride      = stride;
+  }
+
+  //------------------------------------------------------------
+
+  double PhotonLibrary::Sparsify(float Threshold, size_t TopK)
+  {
+    if(fTiles || IsFolded() || fEncoding != kEncodingFloat32 || (!fData && fNVoxels)) {
+      std::cerr << "Photon library can only be made sparse from float32, unfolded (current: "
+		<< PhotonLibraryEncodingName(fEncoding) << ")" << std::endl;
+      throw std::exception();
+    }
+    if(fNOpChannels > 65536) {
+      std::cerr << "Sparse photon library supports up to 65536 channels" << std::endl;
+      throw std::exception();
+    }
+
+    const float* data = fData;
+    const size_t nvoxels = fNVoxels;
+    const size_t nchannels = fNOpChannels;
+    const size_t stride = fStride;
+    const size_t topk = (TopK && TopK < nchannels ? TopK : nchannels);
+
+    // Channels kept per voxel (in increasing channel order), then packed into CSR arrays
+    auto select = [&](size_t ivox, std::vector<uint16_t>& keep) {
+      const float* row = data + ivox * stride;
+      float vmax = 0.;
+      for(size_t ch=0; ch<nchannels; ++ch) vmax = std::max(vmax, row[ch]);
+      keep.clear();
+      for(size_t ch=0; ch<nchannels; ++ch)
+	if(row[ch] > 0. && row[ch] >= Threshold * vmax) keep.push_back(ch);
+      if(keep.size() > topk) {
+	std::nth_element(keep.begin(), keep.begin() + topk, keep.end(),
+			 [row](uint16_t a, uint16_t b) { return row[a] > row[b]; });
+	keep.resize(topk);
+	std::sort(keep.begin(), keep.end());
+      }
+    };
+
+    std::vector<uint64_t> offsets(nvoxels + 1, 0);
+    #pragma omp parallel
+    {
+      std::vector<uint16_t> keep;
+      #pragma omp for schedule(static)
+      for(size_t ivox=0; ivox<nvoxels; ++ivox) {
+	select(ivox, keep);
+	offsets[ivox+1] = keep.size();
+      }
+    }
+    for(size_t ivox=0; ivox<nvoxels; ++ivox) offsets[ivox+1] += offsets[ivox];
+
+    std::vector<uint16_t> channels(offsets[nvoxels]);
+    std::vector<float> values(offsets[nvoxels]);
+    double total = 0., kept = 0.;
+    #pragma omp parallel reduction(+:total,kept)
+    {
+      std::vector<uint16_t> keep;
+      #pragma omp for schedule(static)
+      for(size_t ivox=0; ivox<nvoxels; ++ivox) {
+	const float* row = data + ivox * stride;
+	for(size_t ch=0; ch<nchannels; ++ch) total += row[ch];
+	select(ivox, keep);
+	for(size_t i=0; i<keep.size(); ++i) {
+	  channels[offsets[ivox] + i] = keep[i];
+	  values[offsets[ivox] + i] = row[keep[i]];
+	  kept += row[keep[i]];
+	}
+      }
+    }
+    double dropped = (total > 0. ? 1. - kept / total : 0.);
+
+    std::cout << "Sparse photon library: " << (nvoxels ? (double)(offsets[nvoxels]) / nvoxels : 0.)
+	      << " channels per voxel out of " << nchannels << ", dropped visibility fraction "
+	      << dropped << " ("
+	      << (offsets.size() * sizeof(uint64_t) + channels.size() * (sizeof(uint16_t) + sizeof(float))) / (1024*1024)
+	      << " MB)" << std::endl;
+
+    // Drop the float rows (frees, unmaps or detaches them), keep the sparse ones
+    Release();
+    fEncoding    = kEncodingSparse;
+    fSparseOffsets.swap(offsets);
+    fSparseChannels.swap(channels);
+    fSparseValues.swap(values);
+    fNVoxels     = nvoxels;
+    fNOpChannels = nchannels;
+    fStride      = 0;
+    return dropped;
+  }
+
+  //------------------------------------------------------------
+
+  size_t PhotonLibrary::RowBytes() const
+  {
+    if(fEncoding == kEncodingSparse)
+      return (fNVoxels ? fSparseValues.size() * (sizeof(float) + sizeof(uint16_t)) / fNVoxels : 0) + sizeof(uint64_t);
+    return fStride * (fEncoding == kEncodingFloat32 ? sizeof(float) : sizeof(uint16_t));
+  }
+
+  //------------------------------------------------------------
+
+  void PhotonLibrary::Compress(const sim::PhotonVoxelDef& VoxelDef, const std::vector<int>& TileSize,
+			       int Compression, size_t CacheBytes)
+  {
+    if(fTiles || IsFolded() || fEncoding != kEncodingFloat32 || (!fData && fNVoxels)) {
+      std::cerr << "Photon library can only be compressed from float32, unfolded" << std::endl;
+      throw std::exception();
+    }
+    auto tiles = new PhotonLibraryTiles(GetData(), VoxelDef, TileSize, Compression, CacheBytes);
+    size_t nvoxels = fNVoxels;
+    size_t nchannels = fNOpChannels;
+    std::cout << "Photon library compressed into " << tiles->NumTiles() << " tiles: "
+	      << nvoxels * fStride * sizeof(float) / 1048576. << " MB => "
+	      << tiles->CompressedBytes() / 1048576. << " MB (cache "
+	      << tiles->CacheCapacity() * tiles->TileBytes() / 1048576. << " MB)" << std::endl;
+    // Release the float buffer (or the mapping / shared segment)
+    Release();
+    fTiles       = tiles;
+    fNVoxels     = nvoxels;
+    fNOpChannels = nchannels;
+    fStride      = nchannels;
+  }
+
+  //------------------------------------------------------------
+
+  double PhotonLibrary::Fold(const sim::PhotonVoxelDef& VoxelDef,
+			     const std::vector<PhotonLibrarySymmetry_t>& Symmetries, double Tolerance)
+  {
+    if(fTiles || IsFolded() || fEncoding != kEncodingFloat32 || (!fData && fNVoxels)) {
+      std::cerr << "Photon library can only be folded once, from float32" << std::endl;
+      throw std::exception();
+    }
+    if((int)fNVoxels != VoxelDef.GetNVoxels()) {
+      std::cerr << "Photon library has " << fNVoxels << " voxels but its voxel definition "
+		<< VoxelDef.GetNVoxels() << ": cannot fold" << std::endl;
+      throw std::exception();
+    }
+    if(Symmetries.empty()) return 0.;
+    if(Symmetries.size() > 3 || fNOpChannels > 65536) {
+      std::cerr << "Photon library folding supports up to 3 symmetries and 65536 channels" << std::endl;
+      throw std::exception();
+    }
+
+    const size_t nsym = Symmetries.size();
+    const size_t nchannels = fNOpChannels;
+    const size_t stride = fStride;
+    auto const lower = VoxelDef.GetRegionLowerCorner();
+    auto const size  = VoxelDef.GetVoxelSize();
+    auto const steps = VoxelDef.GetSteps();
+    const int nx = steps[0];
+    const int ny = steps[1];
+
+    // Voxel index i along an axis is mirrored to mirror_sum - i (the plane is at index
+    // mirror_sum/2 in units of voxels, counted from the center of voxel 0)
+    std::vector<int> axis_v(nsym), mirror_sum_v(nsym);
+    std::vector<bool> used(3, false);
+    for(size_t s=0; s<nsym; ++s) {
+      auto const& sym = Symmetries[s];
+      if(sym.Axis < 0 || sym.Axis > 2 || used[sym.Axis]) {
+	std::cerr << "Invalid or repeated photon library symmetry axis " << sym.Axis << std::endl;
+	throw std::exception();
+      }
+      used[sym.Axis] = true;
+      double sum = 2. * (sym.Plane - lower[sym.Axis]) / size[sym.Axis] - 1.;
+      if(std::fabs(sum - std::round(sum)) > 1.e-3) {
+	std::cerr << "Photon library symmetry plane at " << sym.Plane << " along axis " << sym.Axis
+		  << " is neither on a voxel center nor on a voxel boundary" << std::endl;
+	throw std::exception();
+      }
+      axis_v[s] = sym.Axis;
+      mirror_sum_v[s] = (int)(std::round(sum));
+      std::vector<bool> seen(nchannels, false);
+      bool valid = (sym.ChannelMap.size() == nchannels);
+      for(size_t ch=0; valid && ch<nchannels; ++ch) {
+	int image = sym.ChannelMap[ch];
+	valid = (image >= 0 && image < (int)(nchannels) && !seen[image]);
+	if(valid) seen[image] = true;
+      }
+      if(!valid) {
+	std::cerr << "Photon library symmetry along axis " << sym.Axis << " needs a permutation of the "
+		  << nchannels << " channels (got " << sym.ChannelMap.size() << " entries)" << std::endl;
+	throw std::exception();
+      }
+    }
+
+    // Channel permutation of each mirror combination (bit s set = mirrored through plane s)
+    const size_t ncomb = (size_t)(1) << nsym;
+    std::vector<uint16_t> permutations(ncomb * nchannels);
+    for(size_t comb=0; comb<ncomb; ++comb) {
+      for(size_t ch=0; ch<nchannels; ++ch) {
+	int image = ch;
+	for(size_t s=0; s<nsym; ++s)
+	  if(comb & ((size_t)(1) << s)) image = Symmetries[s].ChannelMap[image];
+	permutations[comb * nchannels + ch] = image;
+      }
+    }
+
+    // Image in the fundamental domain and mirror combination of a voxel
+    auto image = [&](size_t ivox, size_t& comb) {
+      int idx[3] = { (int)(ivox % nx), (int)((ivox / nx) % ny), (int)(ivox / ((size_t)(nx) * ny)) };
+      comb = 0;
+      for(size_t s=0; s<nsym; ++s) {
+	int& i = idx[axis_v[s]];
+	if(2 * i > mirror_sum_v[s] && i <= mirror_sum_v[s]) {
+	  i = mirror_sum_v[s] - i;
+	  comb |= (size_t)(1) << s;
+	}
+      }
+      return idx[0] + idx[1] * (size_t)(nx) + idx[2] * (size_t)(nx) * ny;
+    };
+
+    // Stored rows: voxels that are their own image, in voxel order
+    const size_t nvoxels = fNVoxels;
+    std::vector<uint32_t> fold(nvoxels);
+    size_t nstored = 0;
+    for(size_t ivox=0; ivox<nvoxels; ++ivox) {
+      size_t comb = 0;
+      image(ivox, comb);
+      if(!comb) fold[ivox] = nstored++;
+    }
+    if(nstored >= ((size_t)(1) << PhotonLibraryView::kFoldRowBits)) {
+      std::cerr << "Too many voxels to fold the photon library (" << nstored << ")" << std::endl;
+      throw std::exception();
+    }
+
+    // Equivalence check of every dropped row against its image
+    const float* data = fData;
+    std::vector<float> deviation(nvoxels, 0.);
+    #pragma omp parallel for schedule(static)
+    for(size_t ivox=0; ivox<nvoxels; ++ivox) {
+      size_t comb = 0;
+      size_t canonical = image(ivox, comb);
+      if(!comb) continue;
+      const float* row = data + ivox * stride;
+      const float* img = data + canonical * stride;
+      const uint16_t* perm = permutations.data() + comb * nchannels;
+      float vmax = 0., diff = 0.;
+      for(size_t ch=0; ch<nchannels; ++ch) {
+	vmax = std::max(vmax, std::max(row[ch], img[perm[ch]]));
+	diff = std::max(diff, std::fabs(row[ch] - img[perm[ch]]));
+      }
+      deviation[ivox] = (vmax > 0. ? diff / vmax : 0.);
+    }
+    size_t worst = std::max_element(deviation.begin(), deviation.end()) - deviation.begin();
+    double max_deviation = (nvoxels ? deviation[worst] : 0.);
+    if(max_deviation > Tolerance) {
+      std::cerr << "Photon library is not symmetric: voxel " << worst << " differs from its mirror image by "
+		<< max_deviation << " of its maximum visibility (tolerance " << Tolerance << ")" << std::endl;
+      throw std::exception();
+    }
+    for(size_t ivox=0; ivox<nvoxels; ++ivox) {
+      size_t comb = 0;
+      size_t canonical = image(ivox, comb);
+      if(comb) fold[ivox] = fold[canonical] | (uint32_t)(comb << PhotonLibraryView::kFoldRowBits);
+    }
+
+    // Copy the stored rows into a new buffer
+    PhotonLibrary folded;
+    folded.Allocate(nstored, nchannels);
+    #pragma omp parallel for schedule(static)
+    for(size_t ivox=0; ivox<nvoxels; ++ivox)
+      if(!(fold[ivox] >> PhotonLibraryView::kFoldRowBits))
+	memcpy(folded.fData + fold[ivox] * stride, data + ivox * stride, nchannels * sizeof(float));
+
+    std::cout << "Photon library folded along " << nsym << " symmetry plane(s): " << nstored << " of "
+	      << nvoxels << " voxels stored (" << nstored * stride * sizeof(float) / (1024*1024)
+	      << " MB), max. relative difference " << max_deviation << std::endl;
+
+    // Release the full buffer (or the mapping / shared segment), keep the folded one
+    Release();
+    fData          = folded.fData;
+    folded.fData   = nullptr;
+    fNVoxels       = nvoxels;
+    fNOpChannels   = nchannels;
+    fStride        = stride;
+    fNStoredVoxels = nstored;
+    fFold.swap(fold);
+    fFoldChannels.swap(permutations);
+    return max_deviation;
+  }
+
+  //------------------------------------------------------------
+
+  sim::PhotonVoxelDef PhotonLibrary::DownsampledVoxelDef(const sim::PhotonVoxelDef& VoxelDef, int Factor)
+  {
+    if(Factor < 1) {
+      std::cerr << "Photon library downsampling factor must be positive (got " << Factor << ")" << std::endl;
+      throw std::exception();
+    }
+    // Coarse voxels are Factor fine voxels wide: the region grows on the upper side if the
+    // number of fine voxels is not a multiple of Factor
+    auto const lower = VoxelDef.GetRegionLowerCorner();
+    auto const size  = VoxelDef.GetVoxelSize();
+    auto const steps = VoxelDef.GetSteps();
+    int n[3];
+    for(size_t i=0; i<3; ++i) n[i] = ((int)(steps[i]) + Factor - 1) / Factor;
+    return sim::PhotonVoxelDef(lower[0], lower[0] + n[0] * Factor * size[0], n[0],
+			       lower[1], lower[1] + n[1] * Factor * size[1], n[1],
+			       lower[2], lower[2] + n[2] * Factor * size[2], n[2]);
+  }
+
+  //------------------------------------------------------------
+
+  void PhotonLibrary::Downsample(const PhotonLibrary& Fine, const sim::PhotonVoxelDef& FineVoxelDef, int Factor)
+  {
+    if((int)(Fine.NVoxels()) != FineVoxelDef.GetNVoxels()) {
+      std::cerr << "Photon library has " << Fine.NVoxels() << " voxels but its voxel definition "
+		<< FineVoxelDef.GetNVoxels() << ": cannot downsample" << std::endl;
+      throw std::exception();
+    }
+    auto const coarse_def = DownsampledVoxelDef(FineVoxelDef, Factor);
+    Allocate(coarse_def.GetNVoxels(), Fine.NOpChannels());
+
+    const int fnx = FineVoxelDef.GetSteps()[0];
+    const int fny = FineVoxelDef.GetSteps()[1];
+    const int fnz = FineVoxelDef.GetSteps()[2];
+    const int cnx = coarse_def.GetSteps()[0];
+    const int cny = coarse_def.GetSteps()[1];
+    const int cnz = coarse_def.GetSteps()[2];
+    const size_t nchannels = fNOpChannels;
+    const size_t stride = fStride;
+    float* data = fData;
+    auto const fine = Fine.GetData(); // decodes any encoding
+
+    // Coarse visibility = mean over the fine voxels it contains (the visibility averaged
+    // over a point uniformly distributed in the coarse voxel)
+    #pragma omp parallel for schedule(dynamic)
+    for(int cz=0; cz<cnz; ++cz) {
+      std::vector<double> sum_v(nchannels);
+      for(int cy=0; cy<cny; ++cy) {
+	for(int cx=0; cx<cnx; ++cx) {
+	  std::fill(sum_v.begin(), sum_v.end(), 0.);
+	  size_t count = 0;
+	  for(int fz=cz*Factor; fz<std::min((cz+1)*Factor,fnz); ++fz) {
+	    for(int fy=cy*Factor; fy<std::min((cy+1)*Factor,fny); ++fy) {
+	      for(int fx=cx*Factor; fx<std::min((cx+1)*Factor,fnx); ++fx) {
+		auto const row = fine[fx + fy * fnx + fz * fnx * fny];
+		for(size_t ch=0; ch<nchannels; ++ch) sum_v[ch] += row[ch];
+		++count;
+	      }
+	    }
+	  }
+	  float* out = data + (cx + cy * cnx + (size_t)(cz) * cnx * cny) * stride;
+	  for(size_t ch=0; ch<nchannels; ++ch) out[ch] = sum_v[ch] / count;
+	}
+      }
+    }
   }
 
   //------------------------------------------------------------
@@ -53,15 +1169,16 @@ namespace phot{
     tt->Branch("Visibility", &Visibility, "Visibility/F");
 
 
-    for(size_t ivox=0; ivox!=fLookupTable.size(); ++ivox)
+    for(size_t ivox=0; ivox!=fNVoxels; ++ivox)
       {
-	for(size_t ichan=0; ichan!=fLookupTable.at(ivox).size(); ++ichan)
+	auto const row = GetCounts(ivox);
+	for(size_t ichan=0; ichan!=fNOpChannels; ++ichan)
 	  {
-	    if(fLookupTable[ivox].at(ichan) > 0)
+	    if(row[ichan] > 0)
 	      {
 		Voxel      = ivox;
 		OpChannel  = ichan;
-		Visibility = fLookupTable[ivox][ichan];
+		Visibility = row[ichan];
 		tt->Fill();
 	      }
 	  }
@@ -76,25 +1193,16 @@ namespace phot{
 
   void PhotonLibrary::CreateEmptyLibrary( size_t NVoxels, size_t NOpChannels)
   {
-    fLookupTable.clear();
-
-    fNVoxels     = NVoxels;
-    fNOpChannels = NOpChannels;
-
-    fLookupTable.resize(NVoxels);
-
-    for(size_t ivox=0; ivox!=NVoxels; ivox++)
-      {
-        fLookupTable[ivox].resize(NOpChannels,0);
-      }
+    Allocate(NVoxels, NOpChannels);
   }
 
 
   //------------------------------------------------------------
 
-  void PhotonLibrary::LoadLibraryFromFile(std::string LibraryFile, size_t NVoxels)
+  void PhotonLibrary::LoadLibraryFromFile(std::string LibraryFile, size_t NVoxels, size_t NOpChannels,
+					  const std::function<void(float)>& Progress)
   {
-    fLookupTable.clear();
+    Release();
 
     std::cout<< "Reading photon library from input file: " << LibraryFile.c_str()<<std::endl;
 
@@ -134,40 +1242,32 @@ namespace phot{
     tt->SetBranchAddress("Visibility", &Visibility);
 
 
-
-
-    fNVoxels     = NVoxels;
-    fNOpChannels = 1;      // Minimum default, overwritten by library reading
-
-
-    fLookupTable.resize(NVoxels);
+    // The channel count given by the caller lays out the flat buffer (no extra pass over the
+    // tree to find the largest channel): entries beyond it are counted and reported below
+    Allocate(NVoxels, NOpChannels);
 
 
     size_t NEntries = tt->GetEntries();
+    size_t NBadChannels = 0;
+    Int_t  MaxChannel = -1;
 
     for(size_t i=0; i!=NEntries; ++i) {
+      if(Progress && i % 1000000 == 0) Progress((float)(i) / NEntries);
       tt->GetEntry(i);
 
-      // Set # of optical channels to 1 more than largest one seen
-      if (OpChannel >= (int)fNOpChannels)
-        fNOpChannels = OpChannel+1;
-
-      // Expand this voxel's vector if needed
-      if (fLookupTable[Voxel].size() < fNOpChannels)
-        fLookupTable[Voxel].resize(fNOpChannels, 0);
+      if (Voxel < 0 || Voxel >= (int)fNVoxels || OpChannel < 0) continue;
+      if (OpChannel >= (int)fNOpChannels) {
+	++NBadChannels;
+	MaxChannel = std::max(MaxChannel, OpChannel);
+	continue;
+      }
 
       // Set the visibility at this optical channel
-      fLookupTable[Voxel][OpChannel] = Visibility;
-    }
-
-    // Go through the table and fill in any missing 0's
-    for(size_t ivox=0; ivox!=NVoxels; ivox++)
-    {
-      if (fLookupTable[ivox].size() < fNOpChannels)
-	fLookupTable[ivox].resize(fNOpChannels,0);
+      fData[Voxel * fStride + OpChannel] = Visibility;
     }
 
 
+    if(Progress) Progress(1.);
     std::cout <<  NVoxels << " voxels,  " << fNOpChannels<<" channels" <<std::endl;
 
 
@@ -179,6 +1279,262 @@ namespace phot{
       {
 	std::cerr << "Error in closing file : " << LibraryFile.c_str()<<std::endl;
       }
+
+    if(NBadChannels) {
+      std::cerr << "Photon library " << LibraryFile.c_str() << " has " << NBadChannels
+		<< " entries with channels up to " << MaxChannel << ", expected fewer than "
+		<< fNOpChannels << " channels" << std::endl;
+      Release();
+      throw std::exception();
+    }
+  }
+
+  //------------------------------------------------------------
+
+  bool PhotonLibrary::IsBinaryLibraryFile(const std::string& LibraryFile)
+  {
+    const std::string ext(".plib");
+    return (LibraryFile.size() > ext.size() &&
+	    LibraryFile.compare(LibraryFile.size() - ext.size(), ext.size(), ext) == 0);
+  }
+
+  //------------------------------------------------------------
+
+  void PhotonLibrary::StoreLibraryToBinary(std::string LibraryFile, const sim::PhotonVoxelDef& VoxelDef) const
+  {
+    std::cout << "Writing binary photon library to file: " << LibraryFile.c_str()<<std::endl;
+
+    if(fEncoding != kEncodingFloat32 || fTiles || IsFolded()) {
+      std::cerr << "Only an unfolded float32 library can be stored in the binary format" << std::endl;
+      throw std::exception();
+    }
+    if((int)fNVoxels != VoxelDef.GetNVoxels()) {
+      std::cerr << "Library has " << fNVoxels << " voxels but the voxel definition has "
+		<< VoxelDef.GetNVoxels() << std::endl;
+      throw std::exception();
+    }
+
+    PhotonLibraryHeader_t header;
+    FillHeader(header, fNVoxels, fNOpChannels, fStride, VoxelDef);
+
+    FILE* fout = fopen(LibraryFile.c_str(), "wb");
+    if(!fout) {
+      std::cerr << "Failed to open a binary library file for writing: " << LibraryFile.c_str() << std::endl;
+      throw std::exception();
+    }
+    std::vector<char> padding(header.DataOffset - sizeof(header), 0);
+    size_t nfloats = fNVoxels * fStride;
+    bool ok = (fwrite(&header, sizeof(header), 1, fout) == 1);
+    if(ok && !padding.empty()) ok = (fwrite(padding.data(), 1, padding.size(), fout) == padding.size());
+    if(ok && nfloats) ok = (fwrite(fData, sizeof(float), nfloats, fout) == nfloats);
+    if(fclose(fout) != 0) ok = false;
+    if(!ok) {
+      std::cerr << "Failed to write a binary library file: " << LibraryFile.c_str() << std::endl;
+      throw std::exception();
+    }
+  }
+
+  //------------------------------------------------------------
+
+  void PhotonLibrary::LoadLibraryFromBinary(std::string LibraryFile, const sim::PhotonVoxelDef& VoxelDef)
+  {
+    Release();
+
+    std::cout<< "Mapping binary photon library from file: " << LibraryFile.c_str()<<std::endl;
+
+    int fd = open(LibraryFile.c_str(), O_RDONLY);
+    if(fd < 0) {
+      std::cerr<<"\033[95m<<"<<__FUNCTION__<<">>\033[00m " << "Failed to open a binary library file: " << LibraryFile.c_str()<<std::endl;
+      std::cerr<<"A binary library can be created from the ROOT file with bin/convert_photon_library.py"<<std::endl;
+      throw std::exception();
+    }
+    struct stat st;
+    if(fstat(fd, &st) != 0 || (size_t)(st.st_size) < sizeof(PhotonLibraryHeader_t)) {
+      close(fd);
+      std::cerr << "Binary library file is too short: " << LibraryFile.c_str() << std::endl;
+      throw std::exception();
+    }
+    size_t file_size = st.st_size;
+    void* base = mmap(nullptr, file_size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd); // the mapping stays valid
+    if(base == MAP_FAILED) {
+      std::cerr << "Failed to map a binary library file: " << LibraryFile.c_str() << std::endl;
+      throw std::exception();
+    }
+
+    PhotonLibraryHeader_t header;
+    memcpy(&header, base, sizeof(header));
+    std::string error = CheckHeader(header, file_size, VoxelDef);
+    if(!error.empty()) {
+      munmap(base, file_size);
+      std::cerr << "Invalid binary library file " << LibraryFile.c_str() << ": " << error << std::endl;
+      throw std::exception();
+    }
+
+    fMappedBase  = base;
+    fMappedSize  = file_size;
+    fData        = (float*)((char*)(base) + header.DataOffset);
+    fNVoxels     = header.NVoxels;
+    fNOpChannels = header.NOpChannels;
+    fStride      = header.Stride;
+
+    std::cout <<  fNVoxels << " voxels,  " << fNOpChannels<<" channels" <<std::endl;
+  }
+
+  //------------------------------------------------------------
+
+  void PhotonLibrary::LoadLibraryShared(std::string SharedName, std::string Source,
+					const sim::PhotonVoxelDef& VoxelDef, size_t NOpChannels,
+					const std::function<void(PhotonLibrary&)>& Loader)
+  {
+    Release();
+
+    if(SharedName.empty() || SharedName[0] != '/') SharedName = "/" + SharedName;
+    if(Source.size() >= sizeof(SharedControl_t::Source)) Source.resize(sizeof(SharedControl_t::Source) - 1);
+
+    // The first process to create the segment publishes the library, the others attach
+    int fd = shm_open(SharedName.c_str(), O_RDWR | O_CREAT | O_EXCL, 0644);
+    if(fd >= 0) {
+      std::cout << "Publishing photon library to shared memory " << SharedName << std::endl;
+      void* base = MAP_FAILED;
+      size_t size = 0;
+      try {
+	Loader(*this);
+	if(fEncoding != kEncodingFloat32) {
+	  std::cerr << "Only a float32 library can be published to shared memory" << std::endl;
+	  throw std::exception();
+	}
+	if(fNOpChannels != NOpChannels) {
+	  std::cerr << "Photon library has " << fNOpChannels << " channels, expected "
+		    << NOpChannels << std::endl;
+	  throw std::exception();
+	}
+	PhotonLibraryHeader_t header;
+	FillHeader(header, fNVoxels, fNOpChannels, fStride, VoxelDef);
+	std::string error = CheckHeader(header, header.DataOffset + fNVoxels * fStride * sizeof(float), VoxelDef);
+	if(!error.empty()) {
+	  std::cerr << "Cannot publish photon library: " << error << std::endl;
+	  throw std::exception();
+	}
+	size = header.DataOffset + fNVoxels * fStride * sizeof(float);
+	if(ftruncate(fd, size) != 0 ||
+	   (base = mmap(nullptr, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0)) == MAP_FAILED) {
+	  std::cerr << "Failed to create shared memory " << SharedName << " (" << size << " bytes)" << std::endl;
+	  throw std::exception();
+	}
+	memcpy(base, &header, sizeof(header));
+	memcpy((char*)(base) + header.DataOffset, fData, fNVoxels * fStride * sizeof(float));
+	auto control = SharedControl(base);
+	strncpy(control->Source, Source.c_str(), sizeof(control->Source) - 1);
+	control->RefCount.store(1);
+	// Rows are never written again
+	mprotect((char*)(base) + header.DataOffset, size - header.DataOffset, PROT_READ);
+	control->Ready.store(1, std::memory_order_release);
+      }
+      catch(...) {
+	if(base != MAP_FAILED) munmap(base, size);
+	close(fd);
+	shm_unlink(SharedName.c_str());
+	Release();
+	throw;
+      }
+      close(fd);
+      // Switch from the private copy to the shared one
+      float* data = (float*)((char*)(base) + kBinaryPageSize);
+      free(fData);
+      fData       = data;
+      fMappedBase = base;
+      fMappedSize = size;
+      fSharedName = SharedName;
+      return;
+    }
+    if(errno != EEXIST) {
+      std::cerr << "Failed to open shared memory " << SharedName << ": " << strerror(errno) << std::endl;
+      throw std::exception();
+    }
+
+    fd = shm_open(SharedName.c_str(), O_RDWR, 0);
+    if(fd < 0) {
+      std::cerr << "Failed to attach shared memory " << SharedName << ": " << strerror(errno) << std::endl;
+      throw std::exception();
+    }
+    std::cout << "Attaching photon library from shared memory " << SharedName << std::endl;
+
+    // Wait for the publishing process to size the segment and fill it
+    void* base = MAP_FAILED;
+    double waited = 0.;
+    while(1) {
+      struct stat st;
+      if(fstat(fd, &st) == 0 && (size_t)(st.st_size) >= kBinaryPageSize) {
+	if(base == MAP_FAILED)
+	  base = mmap(nullptr, kBinaryPageSize, PROT_READ, MAP_SHARED, fd, 0);
+	if(base != MAP_FAILED && SharedControl(base)->Ready.load(std::memory_order_acquire))
+	  break;
+      }
+      if(waited > kSharedWaitTimeout) {
+	if(base != MAP_FAILED) munmap(base, kBinaryPageSize);
+	close(fd);
+	std::cerr << "Timed out waiting for shared memory " << SharedName << " to be published "
+		  << "(remove a stale segment with PhotonLibrary::RemoveSharedLibrary)" << std::endl;
+	throw std::exception();
+      }
+      usleep(10000);
+      waited += 0.01;
+    }
+    PhotonLibraryHeader_t header;
+    memcpy(&header, base, sizeof(header));
+    munmap(base, kBinaryPageSize);
+
+    size_t size = header.DataOffset + header.NVoxels * header.Stride * sizeof(float);
+    base = mmap(nullptr, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    close(fd);
+    if(base == MAP_FAILED) {
+      std::cerr << "Failed to map shared memory " << SharedName << std::endl;
+      throw std::exception();
+    }
+    // Only the control block needs to be writable
+    mprotect((char*)(base) + header.DataOffset, size - header.DataOffset, PROT_READ);
+
+    auto control = SharedControl(base);
+    std::string error = CheckHeader(header, size, VoxelDef);
+    if(error.empty() && header.NOpChannels != NOpChannels)
+      error = "channel count does not match the service";
+    if(error.empty() && Source != control->Source)
+      error = std::string("published from a different library file (") + control->Source + ")";
+    if(!error.empty()) {
+      munmap(base, size);
+      std::cerr << "Inconsistent shared photon library " << SharedName << ": " << error << std::endl;
+      throw std::exception();
+    }
+    // A count of 0 means the last process has detached and removed (or is removing) the segment:
+    // never revive it, publish a new one under the same name instead
+    int32_t count = control->RefCount.load();
+    do {
+      if(count <= 0) {
+	munmap(base, size);
+	usleep(10000);
+	LoadLibraryShared(SharedName, Source, VoxelDef, NOpChannels, Loader);
+	return;
+      }
+    } while(!control->RefCount.compare_exchange_weak(count, count + 1));
+
+    fMappedBase  = base;
+    fMappedSize  = size;
+    fData        = (float*)((char*)(base) + header.DataOffset);
+    fNVoxels     = header.NVoxels;
+    fNOpChannels = header.NOpChannels;
+    fStride      = header.Stride;
+    fSharedName  = SharedName;
+
+    std::cout <<  fNVoxels << " voxels,  " << fNOpChannels<<" channels" <<std::endl;
+  }
+
+  //------------------------------------------------------------
+
+  bool PhotonLibrary::RemoveSharedLibrary(std::string SharedName)
+  {
+    if(SharedName.empty() || SharedName[0] != '/') SharedName = "/" + SharedName;
+    return shm_unlink(SharedName.c_str()) == 0;
   }
 
   //----------------------------------------------------
@@ -188,27 +1544,33 @@ namespace phot{
     //if(/*(Voxel<0)||*/(Voxel>=fNVoxels)||/*(OpChannel<0)||*/(OpChannel>=fNOpChannels))
     //  return 0;
     //else
-      return fLookupTable[Voxel][OpChannel]; 
+      return GetData()[Voxel][OpChannel];
   }
 
   //----------------------------------------------------
 
   void PhotonLibrary::SetCount(size_t Voxel, size_t OpChannel, float Count)
   {
-    if(/*(Voxel<0)||*/(Voxel>=fNVoxels))
+    if(fMappedBase)
+      std::cerr <<"Error - attempting to set count in a read-only (mapped) library" <<std::endl;
+    else if(fEncoding != kEncodingFloat32 || fTiles || IsFolded())
+      std::cerr <<"Error - attempting to set count in an encoded, compressed or folded library" <<std::endl;
+    else if(/*(Voxel<0)||*/(Voxel>=fNVoxels))
       std::cerr <<"Error - attempting to set count in voxel " << Voxel<<" which is out of range" <<std::endl;
+    else if(OpChannel>=fNOpChannels)
+      std::cerr <<"Error - attempting to set count in channel " << OpChannel<<" which is out of range" <<std::endl;
     else
-      fLookupTable[Voxel].at(OpChannel) = Count;
+      fData[Voxel * fStride + OpChannel] = Count;
   }
 
   //----------------------------------------------------
 
-  const std::vector<float>* PhotonLibrary::GetCounts(size_t Voxel) const
+  PhotonLibraryRow PhotonLibrary::GetCounts(size_t Voxel) const
   {
     if(/*(Voxel<0)||*/(Voxel>=fNVoxels))
-      return EmptyList(); // FIXME!!! better to throw an exception!
+      return PhotonLibraryRow(); // FIXME!!! better to throw an exception!
     else
-      return &(fLookupTable[Voxel]);
+      return GetData()[Voxel];
   }
 
 
@@ -10,40 +10,418 @@
 #include "PhotonVoxels.h"
 #include <vector>
 #include <string>
+#include <cstdint>
+#include <functional>
+#include <memory>
+#include <mutex>
+#include <list>
+#include <map>
 
 namespace phot{
-  
+
+  /*
+    Native binary library format (".plib"), native byte order:
+      header  : PhotonLibraryHeader_t (magic "FMPHLIB1", voxel definition, channel count, stride)
+      padding : zeros up to DataOffset (a multiple of 4096, so rows stay aligned when mapped)
+      data    : NVoxels rows of Stride floats, the first NOpChannels of each row are visibilities
+    It is written once from the ROOT file (bin/convert_photon_library.py) and then mapped
+    read-only, so that all processes on a node share one copy through the page cache.
+    The same layout is used for a library published in POSIX shared memory, where the padding
+    also holds a control block (ready flag, reference count, source file name).
+  */
+  struct PhotonLibraryHeader_t {
+    char     Magic[8];
+    uint32_t Version;
+    uint32_t HeaderSize;
+    uint64_t NVoxels;
+    uint64_t NOpChannels;
+    uint64_t Stride;
+    uint64_t DataOffset;
+    double   LowerCorner[3];
+    double   UpperCorner[3];
+    int32_t  Steps[3];
+    int32_t  Reserved;
+  };
+
+  /// In-memory representation of the visibilities
+  enum PhotonLibraryEncoding_t {
+    kEncodingFloat32,      ///< float (as read from file)
+    kEncodingFloat16,      ///< half precision, relative to the voxel maximum
+    kEncodingUInt16Linear, ///< uint16 code times a per-voxel scale
+    kEncodingUInt16Log,    ///< uint16 code on a per-voxel log scale (code 0 = zero)
+    kEncodingSparse        ///< float values of the significant channels only (CSR rows)
+  };
+
+  /// Encoding from its configuration name: "float32", "float16", "uint16", "uint16log" or "sparse"
+  PhotonLibraryEncoding_t PhotonLibraryEncodingFromName(const std::string& name);
+  /// Configuration name of an encoding
+  std::string PhotonLibraryEncodingName(PhotonLibraryEncoding_t encoding);
+
+  /**
+     Mirror symmetry of the detector used to fold a library (see PhotonLibrary::Fold): the
+     visibility of channel ch at a point equals that of channel ChannelMap[ch] at the mirror
+     image of the point through the plane Axis = Plane.
+  */
+  struct PhotonLibrarySymmetry_t {
+    int Axis;                    ///< 0, 1, 2 for x, y, z
+    double Plane;                ///< Position of the plane [cm] (a voxel center or boundary)
+    std::vector<int> ChannelMap; ///< Channel at the image of each channel
+  };
+
+  class PhotonLibraryTiles;
+
+  /// Visibilities of one voxel for all optical channels (non-owning)
+  class PhotonLibraryRow
+  {
+  public:
+    /// Iterator over decoded visibilities
+    class const_iterator {
+    public:
+      const_iterator(const PhotonLibraryRow* row, size_t index) : fRow(row), fIndex(index) {}
+      inline float operator*() const { return (*fRow)[fIndex]; }
+      inline const_iterator& operator++() { ++fIndex; return *this; }
+      inline bool operator!=(const const_iterator& rhs) const { return fIndex != rhs.fIndex; }
+      inline bool operator==(const const_iterator& rhs) const { return fIndex == rhs.fIndex; }
+    private:
+      const PhotonLibraryRow* fRow;
+      size_t fIndex;
+    };
+
+    /// Row of float visibilities
+    PhotonLibraryRow(const float* data=nullptr, size_t size=0)
+      : fData(data), fSize(size), fEncoding(kEncodingFloat32), fOffset(0.), fScale(1.) {}
+    /// Row of encoded visibilities with its per-voxel decoding parameters
+    PhotonLibraryRow(const uint16_t* codes, size_t size, PhotonLibraryEncoding_t encoding,
+		     float offset, float scale)
+      : fData(codes), fSize(size), fEncoding(encoding), fOffset(offset), fScale(scale) {}
+    /// Sparse row: nnz (channel, value) pairs, channels in increasing order, others are zero
+    PhotonLibraryRow(const float* values, const uint16_t* channels, size_t nnz, size_t size)
+      : fData(values), fSize(size), fEncoding(kEncodingSparse), fOffset(0.), fScale(1.)
+      , fChannels(channels), fNNZ(nnz) {}
+    /// Row of float visibilities in a decompressed tile, kept alive as long as the row
+    PhotonLibraryRow(const float* data, size_t size, const std::shared_ptr<const std::vector<float> >& tile)
+      : fData(data), fSize(size), fEncoding(kEncodingFloat32), fOffset(0.), fScale(1.), fTile(tile) {}
+    /// Row of a mirrored voxel of a folded library: row[ch] = data[permutation[ch]]
+    PhotonLibraryRow(const float* data, size_t size, const uint16_t* permutation)
+      : fData(data), fSize(size), fEncoding(kEncodingFloat32), fOffset(0.), fScale(1.)
+      , fPermutation(permutation) {}
+
+    inline float operator[](size_t OpChannel) const
+    { return (fEncoding == kEncodingFloat32 && !fPermutation ? ((const float*)(fData))[OpChannel] : Decode(OpChannel)); }
+    inline size_t size() const { return fSize; }
+    inline bool empty() const { return !fSize; }
+    inline const_iterator begin() const { return const_iterator(this, 0); }
+    inline const_iterator end() const { return const_iterator(this, fSize); }
+    inline PhotonLibraryEncoding_t Encoding() const { return fEncoding; }
+    /// Number of stored channels (size() unless sparse)
+    inline size_t NonZero() const { return (fEncoding == kEncodingSparse ? fNNZ : fSize); }
+
+    /// out[ch] += weight * row[ch] for all channels (SIMD kernel picked at run time)
+    void MultiplyAccumulate(double weight, double* out) const;
+
+  private:
+    /// Decoded visibility of an encoded row
+    float Decode(size_t OpChannel) const;
+
+    const void* fData;  //!< First channel (aligned to PhotonLibrary::kAlignment)
+    size_t fSize;       //!< Number of channels
+    PhotonLibraryEncoding_t fEncoding; //!< Representation of fData
+    float fOffset;      //!< Per-voxel decoding offset (uint16log: log of the smallest value)
+    float fScale;       //!< Per-voxel decoding scale
+    const uint16_t* fChannels = nullptr; //!< Channels of the stored values (sparse)
+    size_t fNNZ = 0;    //!< Number of stored values (sparse)
+    std::shared_ptr<const std::vector<float> > fTile; //!< Decompressed tile holding fData (compressed library)
+    const uint16_t* fPermutation = nullptr; //!< Stored channel of each channel (mirrored voxel)
+  };
+
+  /// Voxel => PhotonLibraryRow look-up over a flat library buffer (non-owning)
+  class PhotonLibraryView
+  {
+  public:
+    /// View of a float library
+    PhotonLibraryView(const float* data=nullptr, size_t nvoxels=0, size_t nchannels=0, size_t stride=0)
+      : fData(data), fParam(nullptr), fTiles(nullptr), fEncoding(kEncodingFloat32)
+      , fNVoxels(nvoxels), fNOpChannels(nchannels), fStride(stride) {}
+    /// View of an encoded library (param holds an offset and a scale per voxel)
+    PhotonLibraryView(const uint16_t* codes, const float* param, PhotonLibraryEncoding_t encoding,
+		      size_t nvoxels, size_t nchannels, size_t stride)
+      : fData(codes), fParam(param), fTiles(nullptr), fEncoding(encoding)
+      , fNVoxels(nvoxels), fNOpChannels(nchannels), fStride(stride) {}
+    /// View of a sparse library: row v holds values/channels [offsets[v], offsets[v+1])
+    PhotonLibraryView(const float* values, const uint16_t* channels, const uint64_t* offsets,
+		      size_t nvoxels, size_t nchannels)
+      : fData(values), fParam(nullptr), fTiles(nullptr), fEncoding(kEncodingSparse)
+      , fNVoxels(nvoxels), fNOpChannels(nchannels), fStride(0)
+      , fChannels(channels), fOffsets(offsets) {}
+    /// View of a compressed library (rows are decompressed on demand)
+    PhotonLibraryView(const PhotonLibraryTiles* tiles, size_t nvoxels, size_t nchannels)
+      : fData(nullptr), fParam(nullptr), fTiles(tiles), fEncoding(kEncodingFloat32)
+      , fNVoxels(nvoxels), fNOpChannels(nchannels), fStride(nchannels) {}
+    /// View of a folded library: fold[v] holds the stored row of voxel v (low kFoldRowBits bits)
+    /// and its mirror combination c, whose channel permutation is permutations[c*nchannels...]
+    PhotonLibraryView(const float* data, const uint32_t* fold, const uint16_t* permutations,
+		      size_t nvoxels, size_t nchannels, size_t stride)
+      : fData(data), fParam(nullptr), fTiles(nullptr), fEncoding(kEncodingFloat32)
+      , fNVoxels(nvoxels), fNOpChannels(nchannels), fStride(stride)
+      , fFold(fold), fPermutations(permutations) {}
+
+    /// Bits of a fold entry holding the stored row (the others hold the mirror combination)
+    static const uint32_t kFoldRowBits = 29;
+
+    inline PhotonLibraryRow operator[](size_t Voxel) const
+    {
+      if(fEncoding == kEncodingFloat32) {
+	if(fTiles) return TileRow(Voxel);
+	if(fFold)  return FoldRow(Voxel);
+	return PhotonLibraryRow((const float*)(fData) + Voxel * fStride, fNOpChannels);
+      }
+      if(fEncoding == kEncodingSparse)
+	return PhotonLibraryRow((const float*)(fData) + fOffsets[Voxel], fChannels + fOffsets[Voxel],
+				fOffsets[Voxel+1] - fOffsets[Voxel], fNOpChannels);
+      return PhotonLibraryRow((const uint16_t*)(fData) + Voxel * fStride, fNOpChannels, fEncoding,
+			      fParam[2*Voxel], fParam[2*Voxel+1]);
+    }
+    inline size_t size() const { return fNVoxels; }
+    inline bool empty() const { return !fNVoxels; }
+    inline size_t NOpChannels() const { return fNOpChannels; }
+    inline size_t Stride() const { return fStride; }
+    inline PhotonLibraryEncoding_t Encoding() const { return fEncoding; }
+    inline bool IsCompressed() const { return fTiles != nullptr; }
+    inline bool IsFolded() const { return fFold != nullptr; }
+
+  private:
+    /// Row of a compressed library
+    PhotonLibraryRow TileRow(size_t Voxel) const;
+    /// Row of a folded library (a stored row, channels permuted if the voxel is mirrored)
+    inline PhotonLibraryRow FoldRow(size_t Voxel) const
+    {
+      const uint32_t fold = fFold[Voxel];
+      const float* row = (const float*)(fData) + (size_t)(fold & ((1u << kFoldRowBits) - 1)) * fStride;
+      const uint32_t mirror = fold >> kFoldRowBits;
+      return (mirror ? PhotonLibraryRow(row, fNOpChannels, fPermutations + mirror * fNOpChannels)
+	      : PhotonLibraryRow(row, fNOpChannels));
+    }
+
+    const void*  fData;  //!< Library buffer
+    const float* fParam; //!< Per-voxel (offset, scale) of an encoded library
+    const PhotonLibraryTiles* fTiles; //!< Compressed library (nullptr if fData is used)
+    PhotonLibraryEncoding_t fEncoding; //!< Representation of fData
+    size_t fNVoxels;     //!< Number of voxels (rows)
+    size_t fNOpChannels; //!< Number of channels per row
+    size_t fStride;      //!< Elements between the starts of two consecutive rows
+    const uint16_t* fChannels = nullptr; //!< Channel of each stored value (sparse)
+    const uint64_t* fOffsets  = nullptr; //!< First stored value of each row, plus the end (sparse)
+    const uint32_t* fFold = nullptr;         //!< Stored row and mirror combination of each voxel (folded)
+    const uint16_t* fPermutations = nullptr; //!< Channel permutation of each mirror combination (folded)
+  };
+
+  /**
+     Library split into tiles of TileSize[0] x TileSize[1] x TileSize[2] voxels, each compressed
+     with a ROOT codec (R__zip: Compression = 100 x algorithm + level, e.g. 101 for zlib or 404
+     for LZ4) after a byte shuffle of its floats. Tiles are decompressed on demand into an LRU
+     cache bounded to CacheBytes and shared by all threads (split in shards, each with its own
+     lock). A returned row holds a reference to its tile, so it stays valid after an eviction.
+  */
+  class PhotonLibraryTiles
+  {
+  public:
+    PhotonLibraryTiles(const PhotonLibraryView& Data, const sim::PhotonVoxelDef& VoxelDef,
+		       const std::vector<int>& TileSize, int Compression, size_t CacheBytes);
+    ~PhotonLibraryTiles();
+
+    /// Visibilities of a voxel (empty row if out of range)
+    PhotonLibraryRow Row(size_t Voxel) const;
+
+    /// Set the cache bound [bytes] (at least one tile per shard) and drop cached tiles
+    void SetCacheSize(size_t CacheBytes);
+    /// Drop all cached tiles (statistics are kept)
+    void ClearCache();
+    /// Reset hit/miss/eviction counters
+    void ResetStats();
+
+    size_t NumTiles() const { return fCompressed.size(); }
+    /// Decompressed size of a tile [bytes]
+    size_t TileBytes() const { return fTileVoxels * fNOpChannels * sizeof(float); }
+    /// Total size of the compressed tiles [bytes]
+    size_t CompressedBytes() const;
+    /// Maximum number of cached tiles
+    size_t CacheCapacity() const;
+    /// Current number of cached tiles
+    size_t NumCachedTiles() const;
+    /// Number of rows served from a cached tile
+    size_t NumHits() const;
+    /// Number of tile decompressions
+    size_t NumMisses() const;
+    /// Number of tiles dropped from the cache
+    size_t NumEvictions() const;
+
+  private:
+    PhotonLibraryTiles(const PhotonLibraryTiles&);
+    PhotonLibraryTiles& operator=(const PhotonLibraryTiles&);
+
+    typedef std::shared_ptr<const std::vector<float> > Tile_t;
+    typedef std::pair<size_t, Tile_t> Entry_t;
+
+    /// One LRU list (tiles with Tile % fNumShards == shard)
+    struct Shard_t {
+      std::mutex Mutex;
+      std::list<Entry_t> LRU; ///< Entries ordered from most to least recently used
+      std::map<size_t, std::list<Entry_t>::iterator> Index; ///< tile => entry look-up
+      size_t Capacity = 1;
+      size_t NumHits = 0;
+      size_t NumMisses = 0;
+      size_t NumEvictions = 0;
+    };
+
+    /// Decompress a tile (voxel-major rows of fNOpChannels floats)
+    Tile_t Decompress(size_t Tile) const;
+
+    int fSteps[3];      //!< Voxels along x, y, z
+    int fTileSize[3];   //!< Voxels per tile along x, y, z
+    int fNTiles[3];     //!< Tiles along x, y, z
+    size_t fTileVoxels; //!< Voxels per tile (edge tiles are zero-padded)
+    size_t fNOpChannels;
+    std::vector<std::vector<unsigned char> > fCompressed; //!< Compressed tiles
+    std::vector<bool> fStored;  //!< Tiles kept uncompressed (the codec did not reduce them)
+    size_t fNumShards;          //!< Number of cache shards
+    Shard_t* fShards;           //!< Cache shards (owned)
+  };
+
   class PhotonLibrary
   {
   public:
+    /// Alignment of the buffer and of every row [bytes] (one cache line)
+    static const size_t kAlignment = 64;
+
     PhotonLibrary();
     ~PhotonLibrary();
 
     float GetCount(size_t Voxel, size_t OpChannel);
     void   SetCount(size_t Voxel, size_t OpChannel, float Count);
     
-    const std::vector<float>* GetCounts(size_t Voxel) const;
-    inline const std::vector<std::vector<float> >& GetData() const
-    { return fLookupTable; }
+    /// Visibilities of a voxel (empty row if out of range)
+    PhotonLibraryRow GetCounts(size_t Voxel) const;
+    inline PhotonLibraryView GetData() const
+    {
+      if(fTiles)
+	return PhotonLibraryView(fTiles, fNVoxels, fNOpChannels);
+      if(fEncoding == kEncodingFloat32 && !fFold.empty())
+	return PhotonLibraryView(fData, fFold.data(), fFoldChannels.data(), fNVoxels, fNOpChannels, fStride);
+      if(fEncoding == kEncodingFloat32)
+	return PhotonLibraryView(fData, fNVoxels, fNOpChannels, fStride);
+      if(fEncoding == kEncodingSparse)
+	return PhotonLibraryView(fSparseValues.data(), fSparseChannels.data(), fSparseOffsets.data(),
+				 fNVoxels, fNOpChannels);
+      return PhotonLibraryView(fCodes, fParam.data(), fEncoding, fNVoxels, fNOpChannels, fStride);
+    }
     
     void StoreLibraryToFile(std::string LibraryFile);
-    void LoadLibraryFromFile(std::string LibraryFile, size_t NVoxels);
+    /// Read the library from a ROOT file (throws if it has a channel >= NOpChannels). Progress, if
+    /// set, is called with the fraction of entries read.
+    void LoadLibraryFromFile(std::string LibraryFile, size_t NVoxels, size_t NOpChannels,
+			     const std::function<void(float)>& Progress=nullptr);
     void CreateEmptyLibrary(size_t NVoxels, size_t NChannels);
+
+    /// Write the library in the native binary format (header + flat buffer, see below)
+    void StoreLibraryToBinary(std::string LibraryFile, const sim::PhotonVoxelDef& VoxelDef) const;
+    /// Map a native binary library read-only (throws if its voxel definition differs)
+    void LoadLibraryFromBinary(std::string LibraryFile, const sim::PhotonVoxelDef& VoxelDef);
+    /// True if a file name has the native binary format extension (".plib")
+    static bool IsBinaryLibraryFile(const std::string& LibraryFile);
+    /// True if the buffer is a read-only mapping of a binary library file
+    bool IsMapped() const { return fMappedBase != nullptr; }
+
+    /**
+       Load through the named POSIX shared-memory segment SharedName. The first process
+       creates the segment, fills this library with Loader and publishes it; later processes
+       wait for it and attach read-only, after checking the voxel definition, the channel
+       count and the source file name. The segment is reference counted and removed when the
+       last attached library is released; a process finding a segment that is being removed
+       publishes a new one. Encoding, compressing or folding a shared library releases it.
+    */
+    void LoadLibraryShared(std::string SharedName, std::string Source,
+			   const sim::PhotonVoxelDef& VoxelDef, size_t NOpChannels,
+			   const std::function<void(PhotonLibrary&)>& Loader);
+    /// Remove a shared-memory segment left behind by crashed processes
+    static bool RemoveSharedLibrary(std::string SharedName);
+    /// True if the buffer lives in a shared-memory segment
+    bool IsShared() const { return !fSharedName.empty(); }
+
+    /// Convert the float library into a compact encoding (the float buffer is released).
+    /// kEncodingSparse keeps all non-zero visibilities (see Sparsify).
+    void Encode(PhotonLibraryEncoding_t Encoding);
+    /**
+       Convert the float library into sparse rows (CSR): per voxel, only the channels with a
+       visibility above Threshold times the voxel maximum are kept, at most TopK of them (the
+       largest; 0 = no limit). Returns the fraction of the total visibility that was dropped.
+    */
+    double Sparsify(float Threshold, size_t TopK);
+    PhotonLibraryEncoding_t Encoding() const { return fEncoding; }
+    /// Bytes read per voxel row by the hypothesis kernel
+    size_t RowBytes() const;
+
+    /**
+       Convert the float library into compressed tiles decompressed on demand (see
+       PhotonLibraryTiles); the float buffer is released.
+    */
+    void Compress(const sim::PhotonVoxelDef& VoxelDef, const std::vector<int>& TileSize,
+		  int Compression, size_t CacheBytes);
+    /// True if the library is stored as compressed tiles
+    bool IsCompressed() const { return fTiles != nullptr; }
+    /// Compressed tiles and their cache (nullptr if not compressed)
+    PhotonLibraryTiles* GetTiles() const { return fTiles; }
+
+    /**
+       Fold the float library along mirror symmetries of the detector (at most 3, one per axis):
+       only the voxels on the lower side of every plane are kept, plus those whose image falls
+       outside the grid. A mirrored voxel is read from its image with the channels permuted.
+       Every dropped row is first compared with its image: throws if a visibility differs by
+       more than Tolerance times the voxel maximum. Returns the largest relative difference.
+    */
+    double Fold(const sim::PhotonVoxelDef& VoxelDef, const std::vector<PhotonLibrarySymmetry_t>& Symmetries,
+		double Tolerance=0.);
+    /// True if the library only holds the fundamental domain of its symmetries
+    bool IsFolded() const { return !fFold.empty(); }
+    /// Number of voxel rows held in memory (NVoxels unless folded)
+    size_t NStoredVoxels() const { return (fFold.empty() ? fNVoxels : fNStoredVoxels); }
+
+    /// Voxel definition of a library downsampled by Factor along each axis (same lower corner)
+    static sim::PhotonVoxelDef DownsampledVoxelDef(const sim::PhotonVoxelDef& VoxelDef, int Factor);
+    /// Fill this (float) library with Fine averaged over blocks of Factor^3 voxels
+    void Downsample(const PhotonLibrary& Fine, const sim::PhotonVoxelDef& FineVoxelDef, int Factor);
     
 
     int NOpChannels() const { return fNOpChannels; }
     int NVoxels() const { return fNVoxels; }
+    /// Elements between the starts of two consecutive voxel rows (>= NOpChannels)
+    size_t Stride() const { return fStride; }
     
   private:
-    // fLookupTable[Voxel]->at(OpChannel) = Count
-    std::vector<std::vector<float> > fLookupTable;
+    PhotonLibrary(const PhotonLibrary&);
+    PhotonLibrary& operator=(const PhotonLibrary&);
+
+    /// Allocate a zero-filled buffer of NVoxels rows
+    void Allocate(size_t NVoxels, size_t NOpChannels);
+    void Release();
+
+    // fData[Voxel * fStride + OpChannel] = Count, rows padded with zeros up to fStride
+    float* fData; //!< Voxel-major visibility buffer (kAlignment-aligned)
+    void*  fMappedBase; //!< Start of the mapped binary file (nullptr if fData is allocated)
+    size_t fMappedSize; //!< Size of the mapping [bytes]
+    std::string fSharedName; //!< Shared-memory segment name (empty if not shared)
+    PhotonLibraryEncoding_t fEncoding; //!< Representation in memory
+    uint16_t* fCodes; //!< Encoded rows (kAlignment-aligned), used instead of fData if encoded
+    std::vector<float> fParam; //!< Per-voxel (offset, scale) of encoded rows
+    PhotonLibraryTiles* fTiles; //!< Compressed tiles, used instead of fData if compressed
+    std::vector<uint64_t> fSparseOffsets;  //!< Sparse rows: first value of each voxel, plus the end
+    std::vector<uint16_t> fSparseChannels; //!< Sparse rows: channel of each value
+    std::vector<float>    fSparseValues;   //!< Sparse rows: visibilities
+    std::vector<uint32_t> fFold;           //!< Folded: stored row and mirror combination of each voxel
+    std::vector<uint16_t> fFoldChannels;   //!< Folded: channel permutation of each mirror combination
+    size_t fNStoredVoxels;                 //!< Folded: number of stored rows
     size_t fNOpChannels;
     size_t fNVoxels;
-    
-    static std::vector<float> EmptyChannelsList;
-    
-    static std::vector<float>* EmptyList()
-      { EmptyChannelsList.clear(); return &EmptyChannelsList; }
+    size_t fStride;
   };
 
 }
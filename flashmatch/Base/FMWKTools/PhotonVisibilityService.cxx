@@ -34,6 +34,7 @@
 //#include "Geometry/CryostatGeo.h"
 //#include "Geometry/OpDetGeo.h"
 #include <chrono>
+#include <memory>
 
 using namespace std::chrono;
 namespace phot{
@@ -85,12 +86,33 @@ namespace phot{
     fDoNotLoadLibrary(false),
     fParameterization(false),
     fLibraryFile(library),
-    fTheLibrary(nullptr)
+    fLibraryEncoding(kEncodingFloat32),
+    fSparseThreshold(0.),
+    fSparseTopK(0),
+    fCompression(101),
+    fCacheSize(256),
+    fSymmetryTolerance(0.),
+    fTheLibrary(nullptr),
+    fLoadProgress(0.),
+    fLoadTime(0.)
   {
     fVoxelDef = sim::PhotonVoxelDef(fXmin, fXmax, fNx, fYmin, fYmax, fNy, fZmin, fZmax, fNz);
     return;
   }
 
+  void PhotonVisibilityService::SetLibraryLevels(const std::vector<int>& factors)
+  {
+    std::lock_guard<std::mutex> lock(fLibraryMutex);
+    if(fTheLibrary) {
+      std::cerr << "PhotonVisibilityService: library levels must be set before the library is loaded" << std::endl;
+      throw std::exception();
+    }
+    fLevelFactors = factors;
+    fLevelVoxelDefs.clear();
+    for(auto const& factor : fLevelFactors)
+      fLevelVoxelDefs.push_back(PhotonLibrary::DownsampledVoxelDef(fVoxelDef, factor));
+  }
+
   std::vector<std::vector<float> >
   PhotonVisibilityService::GetVisibilityYZ(double x) const {
     std::vector<std::vector<float> > result(fNy,std::vector<float>(fNz,0.));
@@ -103,7 +125,7 @@ namespace phot{
       for(int iz=0; iz<fNz; ++iz) {
 	int vox_id = iy*fNx + iz * (fNy + fNx);
 	double vis_sum = 0.;
-	for(auto const& vis_pmt : *(fTheLibrary->GetCounts(vox_id)))
+	for(auto const& vis_pmt : fTheLibrary.load()->GetCounts(vox_id))
 	  vis_sum += ((double)(vis_pmt));
 	result[iy][iz] = vis_sum;
       }
@@ -123,7 +145,7 @@ namespace phot{
       for(int iz=0; iz<fNz; ++iz) {
 	int vox_id = ix + iz * (fNy + fNx);
 	double vis_sum = 0.;
-	for(auto const& vis_pmt : *(fTheLibrary->GetCounts(vox_id)))
+	for(auto const& vis_pmt : fTheLibrary.load()->GetCounts(vox_id))
 	  vis_sum += ((double)(vis_pmt));
 	result[iz][ix] = vis_sum;
       }
@@ -143,7 +165,7 @@ namespace phot{
       for(int iy=0; iy<fNy; ++iy) {
 	int vox_id = ix + iy * fNx;
 	double vis_sum = 0.;
-	for(auto const& vis_pmt : *(fTheLibrary->GetCounts(vox_id)))
+	for(auto const& vis_pmt : fTheLibrary.load()->GetCounts(vox_id))
 	  vis_sum += ((double)(vis_pmt));
 	result[ix][iy] = vis_sum;
       }
@@ -162,9 +184,15 @@ namespace phot{
   void PhotonVisibilityService::LoadLibrary() const
   {
     // Don't do anything if the library has already been loaded.
-    std::cout<<"Loading library..."<<std::endl;
+    // Several threads may get here at once: only the first one loads, others wait.
+    std::lock_guard<std::mutex> lock(fLibraryMutex);
     if(fTheLibrary == 0) {
-      fTheLibrary = new PhotonLibrary();
+      std::cout<<"Loading library..."<<std::endl;
+      auto const start = steady_clock::now();
+      fLoadProgress = 0.;
+      // Owned here until fully loaded: a failing step frees everything and publishes nothing
+      std::unique_ptr<PhotonLibrary> library(new PhotonLibrary());
+      std::vector<std::unique_ptr<PhotonLibrary> > levels;
 
 
       if((!fLibraryBuildJob)&&(!fDoNotLoadLibrary)) {
@@ -184,8 +212,61 @@ namespace phot{
 	  std::cout << "PhotonVisibilityService Loading photon library from file "
 		    << LibraryFileWithPath
 		    << std::endl;
-	  size_t NVoxels = GetVoxelDef().GetNVoxels();
-	  fTheLibrary->LoadLibraryFromFile(LibraryFileWithPath, NVoxels);
+	  // Native binary libraries (".plib") are mapped read-only, others read from ROOT
+	  auto const voxel_def = GetVoxelDef();
+	  auto loader = [this,&LibraryFileWithPath,&voxel_def](PhotonLibrary& lib) {
+	    if(PhotonLibrary::IsBinaryLibraryFile(LibraryFileWithPath))
+	      lib.LoadLibraryFromBinary(LibraryFileWithPath, voxel_def);
+	    else
+	      lib.LoadLibraryFromFile(LibraryFileWithPath, voxel_def.GetNVoxels(), fNOpDetChannels,
+				      [this](float fraction) { fLoadProgress = fraction; });
+	  };
+	  if(fSharedMemoryName.empty())
+	    loader(*library);
+	  else {
+	    // Encoding, compressing or folding would drop (and unlink) the published segment
+	    if(fLibraryEncoding != kEncodingFloat32 || !fTileSize.empty() || !fSymmetries.empty()) {
+	      std::cerr << "PhotonVisibilityService: a shared-memory library cannot also be encoded, compressed or folded" << std::endl;
+	      throw std::exception();
+	    }
+	    // One copy per node: the first process publishes, the others attach
+	    library->LoadLibraryShared(fSharedMemoryName, LibraryFileWithPath,
+				       voxel_def, fNOpDetChannels, loader);
+	    // Detach at exit so that the last process removes the segment
+	    static bool unload_registered = false;
+	    if(!unload_registered) {
+	      std::atexit([]{ if(_me) _me->UnloadLibrary(); });
+	      unload_registered = true;
+	    }
+	  }
+	  // Coarse levels are averaged from the full-resolution library (private to the process)
+	  for(size_t level=0; level<fLevelFactors.size(); ++level) {
+	    std::cout << "PhotonVisibilityService building library level " << level+1
+		      << " (" << fLevelFactors[level] << "x downsampled)" << std::endl;
+	    levels.emplace_back(new PhotonLibrary());
+	    levels.back()->Downsample(*library, voxel_def, fLevelFactors[level]);
+	  }
+	  // Compact copy (an encoded, compressed or folded library is private to the process)
+	  auto encode = [this](PhotonLibrary& lib) {
+	    if(fLibraryEncoding == kEncodingSparse) lib.Sparsify(fSparseThreshold, fSparseTopK);
+	    else lib.Encode(fLibraryEncoding);
+	  };
+	  if(!fSymmetries.empty()) {
+	    if(fLibraryEncoding != kEncodingFloat32 || !fTileSize.empty()) {
+	      std::cerr << "PhotonVisibilityService: a folded library cannot also be encoded or compressed" << std::endl;
+	      throw std::exception();
+	    }
+	    library->Fold(voxel_def, fSymmetries, fSymmetryTolerance);
+	  }
+	  else if(fTileSize.empty())
+	    encode(*library);
+	  else if(fLibraryEncoding != kEncodingFloat32) {
+	    std::cerr << "PhotonVisibilityService: a compressed library cannot also be encoded" << std::endl;
+	    throw std::exception();
+	  }
+	  else
+	    library->Compress(voxel_def, fTileSize, fCompression, fCacheSize * 1048576);
+	  for(auto& coarse : levels) encode(*coarse);
 	}
       }
       else {
@@ -195,9 +276,53 @@ namespace phot{
         size_t NVoxels = GetVoxelDef().GetNVoxels();
 	std::cout << " Vis service running library build job.  Please ensure "
 		  << " job contains LightSource, LArG4, SimPhotonCounter"<<std::endl;
-	fTheLibrary->CreateEmptyLibrary(NVoxels, fNOpDetChannels);
+	library->CreateEmptyLibrary(NVoxels, fNOpDetChannels);
       }
+      // Publish only once fully loaded
+      fLoadProgress = 1.;
+      fLoadTime = duration_cast<duration<double> >(steady_clock::now() - start).count();
+      std::cout << "Library loaded in " << fLoadTime << " s" << std::endl;
+      fLevelLibraries.reserve(levels.size());
+      for(auto& coarse : levels) fLevelLibraries.push_back(coarse.release());
+      fTheLibrary = library.release();
+    }
+  }
+
+  //--------------------------------------------------------------------
+  void PhotonVisibilityService::Preload() const
+  {
+    std::lock_guard<std::mutex> lock(fPreloadMutex);
+    if(fTheLibrary || fPreload.valid()) return;
+    fPreload = std::async(std::launch::async, [this]{ LoadLibrary(); }).share();
+  }
+
+  //--------------------------------------------------------------------
+  void PhotonVisibilityService::WaitReady() const
+  {
+    std::shared_future<void> preload;
+    {
+      std::lock_guard<std::mutex> lock(fPreloadMutex);
+      preload = fPreload;
+    }
+    if(preload.valid()) preload.get();
+    if(!fTheLibrary) LoadLibrary();
+  }
+
+  //--------------------------------------------------------------------
+  void PhotonVisibilityService::UnloadLibrary()
+  {
+    // Let a background load finish first (its failure is reported by WaitReady, not here)
+    {
+      std::lock_guard<std::mutex> lock(fPreloadMutex);
+      if(fPreload.valid()) fPreload.wait();
+      fPreload = std::shared_future<void>();
     }
+    std::lock_guard<std::mutex> lock(fLibraryMutex);
+    PhotonLibrary* library = fTheLibrary.exchange(nullptr);
+    delete library;
+    for(auto coarse : fLevelLibraries) delete coarse;
+    fLevelLibraries.clear();
+    fLoadProgress = 0.;
   }
 
   //--------------------------------------------------------------------
@@ -210,7 +335,7 @@ namespace phot{
       {
 	std::cout<< " Vis service "
 		 << " Storing Library entries to file..." <<std::endl;
-	fTheLibrary->StoreLibraryToFile(fLibraryFile);
+	fTheLibrary.load()->StoreLibraryToFile(fLibraryFile);
       }
   }
 
@@ -232,7 +357,7 @@ namespace phot{
   // Get a vector of the relative visibilities of each OpDet
   //  in the event to a point xyz
 
-  const std::vector<float>* PhotonVisibilityService::GetAllVisibilities(double * xyz) const
+  PhotonLibraryRow PhotonVisibilityService::GetAllVisibilities(double * xyz) const
   {
     int VoxID = fVoxelDef.GetVoxelID(xyz);
     return GetLibraryEntries(VoxID);
@@ -303,7 +428,7 @@ namespace phot{
     if(fTheLibrary == 0)
       LoadLibrary();
 
-    fTheLibrary->SetCount(VoxID,OpChannel, N);
+    fTheLibrary.load()->SetCount(VoxID,OpChannel, N);
     std::cout<< " PVS logging " << VoxID << " " << OpChannel<<std::endl;
   }
 
@@ -311,12 +436,12 @@ namespace phot{
 
 
 
-  const std::vector<float>* PhotonVisibilityService::GetLibraryEntries(int VoxID) const
+  PhotonLibraryRow PhotonVisibilityService::GetLibraryEntries(int VoxID) const
   {
     if(fTheLibrary == 0)
       LoadLibrary();
 
-    return fTheLibrary->GetCounts(VoxID);
+    return fTheLibrary.load()->GetCounts(VoxID);
   }
 
   //------------------------------------------------------
@@ -326,7 +451,7 @@ namespace phot{
     if(fTheLibrary == 0)
       LoadLibrary();
 
-    return fTheLibrary->GetCount(VoxID, Channel);
+    return fTheLibrary.load()->GetCount(VoxID, Channel);
   }
 
   //------------------------------------------------------
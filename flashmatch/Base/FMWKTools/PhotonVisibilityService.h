@@ -17,6 +17,9 @@
 #include "PhotonLibrary.h"
 #include "PhotonVoxels.h"
 #include <cassert>
+#include <atomic>
+#include <mutex>
+#include <future>
 
 ///General LArSoft Utilities
 namespace phot{
@@ -56,13 +59,73 @@ namespace phot{
     inline int    GetNZ() const { return fNz; }
     inline size_t GetNOpChannels() const { return fNOpDetChannels; }
 
-    const std::vector<float>* GetAllVisibilities( double* xyz ) const;
+    PhotonLibraryRow GetAllVisibilities( double* xyz ) const;
 
-    inline const std::vector<std::vector<float> >& GetLibraryData() const
-    { if(!fTheLibrary) LoadLibrary(); return fTheLibrary->GetData(); }
+    /// Flat library buffer, accessed as data[voxel][channel]
+    inline PhotonLibraryView GetLibraryData() const
+    { if(!fTheLibrary) LoadLibrary(); return fTheLibrary.load()->GetData(); }
+    /// Library of a resolution level (0 = full resolution, see SetLibraryLevels)
+    inline PhotonLibraryView GetLibraryData(size_t level) const
+    {
+      if(!level) return GetLibraryData();
+      if(!fTheLibrary) LoadLibrary();
+      return fLevelLibraries.at(level-1)->GetData();
+    }
     
     void LoadLibrary() const;
     void StoreLibrary();
+    /// Release the library (detaches from shared memory, if used)
+    void UnloadLibrary();
+
+    /// Start loading the library in a background thread, e.g. right after the configuration, so
+    /// that the file is read while the job prepares its input (no-op if loaded or started).
+    /// A lookup before the end of the load blocks until the library is ready.
+    void Preload() const;
+    /// Block until the library is loaded (loads it if Preload was not called); rethrows a
+    /// failure of the background load
+    void WaitReady() const;
+    /// True once the library is loaded
+    bool IsReady() const { return fTheLibrary != nullptr; }
+    /// Fraction of the library file read so far (1 once loaded)
+    float GetLoadProgress() const { return fLoadProgress; }
+    /// Wall-clock time of the last library load, including levels, folding and encoding [s]
+    double GetLoadTime() const { return fLoadTime; }
+
+    /// Share the library between processes through this POSIX shared-memory name ("" = off).
+    /// Must be set before the library is loaded.
+    void SetSharedMemoryName(const std::string& name) { fSharedMemoryName = name; }
+    const std::string& GetSharedMemoryName() const { return fSharedMemoryName; }
+
+    /// In-memory encoding of the library ("float32", "float16", "uint16", "uint16log", "sparse"),
+    /// applied when the library is (re)loaded
+    void SetLibraryEncoding(const std::string& name) { fLibraryEncoding = PhotonLibraryEncodingFromName(name); }
+    std::string GetLibraryEncoding() const { return PhotonLibraryEncodingName(fLibraryEncoding); }
+    /// Channels kept per voxel by the "sparse" encoding: visibility >= threshold x voxel maximum,
+    /// at most topk of them (0 = no limit), see PhotonLibrary::Sparsify
+    void SetSparseLibrary(float threshold, size_t topk) { fSparseThreshold = threshold; fSparseTopK = topk; }
+
+    /// Keep the library as compressed tiles of tile_size voxels (x, y, z; empty = off), decompressed
+    /// on demand into a cache of cache_mb MB (see PhotonLibraryTiles). Applied when the library is
+    /// (re)loaded; not combined with SetLibraryEncoding.
+    void SetLibraryCompression(const std::vector<int>& tile_size, int compression=101, size_t cache_mb=256)
+    { fTileSize = tile_size; fCompression = compression; fCacheSize = cache_mb; }
+    /// Compressed tiles and cache statistics (nullptr if the library is not compressed)
+    PhotonLibraryTiles* GetLibraryTiles() const
+    { if(!fTheLibrary) LoadLibrary(); return fTheLibrary.load()->GetTiles(); }
+
+    /// Mirror symmetries folding the library at load time (only the fundamental domain is kept,
+    /// see PhotonLibrary::Fold); loading fails if a dropped row differs from its image by more
+    /// than tolerance times its maximum. Not combined with SetLibraryEncoding/SetLibraryCompression.
+    void SetLibrarySymmetries(const std::vector<PhotonLibrarySymmetry_t>& symmetries, double tolerance=0.)
+    { fSymmetries = symmetries; fSymmetryTolerance = tolerance; }
+    const std::vector<PhotonLibrarySymmetry_t>& GetLibrarySymmetries() const { return fSymmetries; }
+
+    /// Downsampling factors of the coarse library levels built at load time (level i+1 has
+    /// voxels factors[i] times larger along each axis). Must be set before the library is loaded.
+    void SetLibraryLevels(const std::vector<int>& factors);
+    const std::vector<int>& GetLibraryLevels() const { return fLevelFactors; }
+    /// Number of resolution levels including the full-resolution library
+    size_t GetNLibraryLevels() const { return fLevelFactors.size() + 1; }
     
     
     void StoreLightProd(    int  VoxID,  double  N );
@@ -70,13 +133,15 @@ namespace phot{
     
     void SetLibraryEntry(   int VoxID, int OpChannel, float N);
     float GetLibraryEntry( int VoxID, int OpChannel) const;
-    const std::vector<float>* GetLibraryEntries( int VoxID ) const;
+    PhotonLibraryRow GetLibraryEntries( int VoxID ) const;
 
     
     bool IsBuildJob() const { return fLibraryBuildJob; }
     bool UseParameterization() const {return fParameterization;}
 
     sim::PhotonVoxelDef GetVoxelDef() const {return fVoxelDef; }
+    sim::PhotonVoxelDef GetVoxelDef(size_t level) const
+    { return (level ? fLevelVoxelDefs.at(level-1) : fVoxelDef); }
     int NOpChannels() const { return fNOpDetChannels; }
 
     const std::string& GetLibraryFilename() { return fLibraryFile; }; // Allows one to check loaded filename
@@ -109,8 +174,25 @@ namespace phot{
     bool                 fDoNotLoadLibrary;
     bool                 fParameterization;
     std::string          fLibraryFile;      
-    mutable PhotonLibrary* fTheLibrary;
+    std::string          fSharedMemoryName; ///< POSIX shared-memory name for the library ("" = private copy)
+    PhotonLibraryEncoding_t fLibraryEncoding; ///< In-memory encoding of the library
+    float                fSparseThreshold;  ///< Sparse encoding: relative visibility threshold
+    size_t               fSparseTopK;       ///< Sparse encoding: max. channels per voxel (0 = all)
+    std::vector<int>     fTileSize;         ///< Compressed tile size in voxels (empty = not compressed)
+    int                  fCompression;      ///< R__zip compression setting of the tiles
+    size_t               fCacheSize;        ///< Decompressed tile cache size [MB]
+    std::vector<PhotonLibrarySymmetry_t> fSymmetries; ///< Mirror symmetries folding the library (empty = off)
+    double               fSymmetryTolerance; ///< Max. relative difference of a folded row from its image
+    mutable std::atomic<PhotonLibrary*> fTheLibrary; //!< Loaded on first use (thread-safe)
+    mutable std::mutex   fLibraryMutex;     //!< Serializes LoadLibrary
+    mutable std::mutex   fPreloadMutex;     //!< Protects fPreload
+    mutable std::shared_future<void> fPreload; //!< Background load started by Preload
+    mutable std::atomic<float>  fLoadProgress; //!< Fraction of the library file read
+    mutable std::atomic<double> fLoadTime;     //!< Duration of the last load [s]
     sim::PhotonVoxelDef  fVoxelDef;
+    std::vector<int>     fLevelFactors;     ///< Downsampling factor of each coarse level
+    std::vector<sim::PhotonVoxelDef> fLevelVoxelDefs; ///< Voxel definition of each coarse level
+    mutable std::vector<PhotonLibrary*> fLevelLibraries; //!< Coarse levels (built with fTheLibrary)
     
     
   }; // class PhotonVisibilityService
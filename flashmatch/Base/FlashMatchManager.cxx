@@ -13,6 +13,8 @@
 #include "FlashProhibitFactory.h"
 #include "CustomAlgoFactory.h"
 #include <chrono>
+#include <exception>
+#include <omp.h>
 
 using namespace std::chrono;
 namespace flashmatch {
@@ -26,6 +28,7 @@ namespace flashmatch {
     , _alg_flash_hypothesis(nullptr)
     , _configured(false)
     , _name(name)
+    , _num_threads(1)
   {
     _allow_reuse_flash = true;
   }
@@ -103,6 +106,14 @@ namespace flashmatch {
     _allow_reuse_flash = mgr_cfg.get<bool>("AllowReuseFlash");
     this->set_verbosity((msg::Level_t)(mgr_cfg.get<unsigned int>("Verbosity")));
     _store_full = mgr_cfg.get<bool>("StoreFullResult");
+    _num_threads = mgr_cfg.get<size_t>("NumThreads",1);
+
+    // Event-scoped hypothesis store (hypotheses reused across flashes are exact, see BaseFlashHypothesis::ShiftKey)
+    _hypothesis_store.Configure(mgr_cfg.get<size_t>("HypothesisStoreSize",0));
+
+    // Read the photon library in the background while the job prepares its input
+    if(mgr_cfg.get<bool>("PreloadLibrary",false))
+      DetectorSpecs::GetME().PreloadPhotonLibrary();
 
     auto const flash_filter_name = mgr_cfg.get<std::string>("FlashFilterAlgo","");
     auto const tpc_filter_name   = mgr_cfg.get<std::string>("TPCFilterAlgo","");
@@ -121,20 +132,27 @@ namespace flashmatch {
       if(!name.empty()) AddCustomAlgo(CustomAlgoFactory::get().create(name,name));
 
     // checks
-    if (_alg_match_prohibit)
-      _alg_match_prohibit->Configure(main_cfg.get<flashmatch::Config_t>(_alg_match_prohibit->AlgorithmName()));
-
     if (_alg_flash_hypothesis)
       _alg_flash_hypothesis->Configure(main_cfg.get<flashmatch::Config_t>(_alg_flash_hypothesis->AlgorithmName()));
 
+    if (_alg_match_prohibit) {
+      _alg_match_prohibit->SetFlashHypothesis(_alg_flash_hypothesis);
+      _alg_match_prohibit->Configure(main_cfg.get<flashmatch::Config_t>(_alg_match_prohibit->AlgorithmName()));
+    }
+
     if (_alg_flash_match) {
       _alg_flash_match->SetFlashHypothesis(_alg_flash_hypothesis);
+      _alg_flash_match->SetHypothesisStore(_hypothesis_store.Enabled() ? &_hypothesis_store : nullptr);
       _alg_flash_match->Configure(main_cfg.get<flashmatch::Config_t>(_alg_flash_match->AlgorithmName()));
     }
 
     for (auto& name_ptr : _custom_alg_m)
       name_ptr.second->Configure(main_cfg.get<flashmatch::Config_t>(name_ptr.first));
 
+    if (_num_threads != 1 && _alg_flash_match && !_alg_flash_match->ThreadSafe())
+      FLASH_WARNING() << _alg_flash_match->AlgorithmName()
+		      << " is not thread-safe: candidate pairs are evaluated serially (NumThreads ignored)" << std::endl;
+
     _configured = true;
   }
 
@@ -185,10 +203,10 @@ namespace flashmatch {
   }
 
   void FlashMatchManager::Add(flashmatch::QCluster_t& obj)
-  { _tpc_object_v.push_back(obj); }
+  { _tpc_object_v.push_back(obj); _hypothesis_store.Clear(); }
 
   void FlashMatchManager::Emplace(flashmatch::QCluster_t&& obj)
-  { _tpc_object_v.emplace_back(std::move(obj)); }
+  { _tpc_object_v.emplace_back(std::move(obj)); _hypothesis_store.Clear(); }
 
   void FlashMatchManager::Add(flashmatch::Flash_t& obj)
   {
@@ -257,15 +275,20 @@ namespace flashmatch {
     // Flash matching stage
     //
 
-    // use multi-map for possible equally-scored matches
-    std::multimap<double, FlashMatch_t> score_map;
+    // Clusters of this event get an id in the hypothesis store
+    _hypothesis_store.Register(_tpc_object_v);
 
-    // Double loop over a list of tpc object & flash
-    // Call matching function to inspect the compatibility.
+    // Let the algorithms precompute per-event quantities (before any pair is evaluated)
+    if (_alg_match_prohibit)
+      _alg_match_prohibit->PrepareMatch(_tpc_object_v, _flash_v);
+    _alg_flash_match->PrepareMatch(_tpc_object_v, _flash_v);
+
+    // List candidate pairs in the order of a double loop over tpc object & flash
+    std::vector<std::pair<ID_t,ID_t> > pair_v;
+    pair_v.reserve(tpc_index_v.size() * flash_index_v.size());
     for (size_t tpc_index = 0; tpc_index < tpc_index_v.size(); ++tpc_index) {
       // Loop over flash list
       for (auto const& flash_index : flash_index_v) {
-        FLASH_INFO() << "Flash index " << flash_index << std::endl;
         auto const& tpc   = _tpc_object_v[tpc_index_v[tpc_index]]; // Retrieve TPC object
         auto const& flash = _flash_v[flash_index];    // Retrieve flash
 
@@ -278,35 +301,46 @@ namespace flashmatch {
           if (compat == false)
             continue;
         }
-        auto start = high_resolution_clock::now();
-        auto res = _alg_flash_match->Match( tpc, flash ); // Run matching
-        auto end = high_resolution_clock::now();
-        auto duration = duration_cast<nanoseconds>(end - start);
-        FLASH_INFO() << "Match duration = " << duration.count() << "ns" << std::endl;
+        pair_v.emplace_back(tpc_index_v[tpc_index], flash_index);
+      }
+    }
+    if (_alg_match_prohibit)
+      FLASH_INFO() << "Match Prohibit: " << tpc_index_v.size() * flash_index_v.size()
+		   << " => " << pair_v.size() << " pairs" << std::endl;
 
-        // ignore this match if the score is <= 0
-        if (res.score <= 0) continue;
+    // Call matching function to inspect the compatibility.
+    std::vector<FlashMatch_t> pair_res_v;
+    MatchPairs(pair_v, pair_res_v);
 
-        // Else we store this match. Assign TPC & flash index info
-        res.tpc_id = tpc_index_v[tpc_index];//_index;
-        res.flash_id = flash_index;//_index;
-        res.duration = duration.count();
+    if(_hypothesis_store.Enabled())
+      FLASH_INFO() << "Hypothesis store: " << _hypothesis_store.NumHits() << " hits / "
+		   << _hypothesis_store.NumMisses() << " misses over "
+		   << _hypothesis_store.NumClusters() << " clusters" << std::endl;
 
+    // use multi-map for possible equally-scored matches
+    std::multimap<double, FlashMatch_t> score_map;
 
-	if(_store_full) {
-	  _res_tpc_flash_v[res.tpc_id][res.flash_id] = res;
-	  _res_flash_tpc_v[res.flash_id][res.tpc_id] = res;
-	}
-        // For ordering purpose, take an inverse of the score for sorting
-        score_map.emplace( 1. / res.score, res);
-
-        FLASH_DEBUG() << "Candidate Match: "
-		      << " TPC=" << tpc_index << " @ " << tpc.time
-		      << " with Flash=" << flash_index << " @ " << flash.time
-		      << " ... Score=" << res.score
-		      << " ... PE=" << flash.TotalPE()
-		      << std::endl;
+    // Merge in the pair order (independent of the number of threads)
+    for (auto& res : pair_res_v) {
+      FLASH_INFO() << "TPC index " << res.tpc_id << " Flash index " << res.flash_id
+		   << " Match duration = " << res.duration << "ns" << std::endl;
+
+      // ignore this match if the score is <= 0
+      if (res.score <= 0) continue;
+
+      if(_store_full) {
+	_res_tpc_flash_v[res.tpc_id][res.flash_id] = res;
+	_res_flash_tpc_v[res.flash_id][res.tpc_id] = res;
       }
+      // For ordering purpose, take an inverse of the score for sorting
+      score_map.emplace( 1. / res.score, res);
+
+      FLASH_DEBUG() << "Candidate Match: "
+		    << " TPC=" << res.tpc_id << " @ " << _tpc_object_v[res.tpc_id].time
+		    << " with Flash=" << res.flash_id << " @ " << _flash_v[res.flash_id].time
+		    << " ... Score=" << res.score
+		    << " ... PE=" << _flash_v[res.flash_id].TotalPE()
+		    << std::endl;
     }
 
     // We have a score-ordered list of match information at this point.
@@ -349,10 +383,70 @@ namespace flashmatch {
 
   }
 
+  void FlashMatchManager::MatchPairs(const std::vector<std::pair<ID_t,ID_t> >& pair_v,
+				     std::vector<FlashMatch_t>& res_v)
+  {
+    res_v.clear();
+    res_v.resize(pair_v.size());
+    _thread_utilization_v.clear();
+    if(pair_v.empty()) return;
+
+    int num_threads = (_num_threads ? (int)(_num_threads) : omp_get_max_threads());
+    if(num_threads > (int)(pair_v.size())) num_threads = pair_v.size();
+    if(!_alg_flash_match->ThreadSafe()) num_threads = 1;
+
+    // Exceptions cannot leave an OpenMP region: keep them per pair and rethrow the first one
+    std::vector<std::exception_ptr> error_v(pair_v.size());
+    std::vector<double> busy_v(num_threads,0.);
+
+    auto wall_start = high_resolution_clock::now();
+    #pragma omp parallel num_threads(num_threads) if(num_threads > 1)
+    {
+      size_t thread_id = omp_get_thread_num();
+      // Pairs take very different times (cluster size, minimizer steps): hand them out one by one
+      #pragma omp for schedule(dynamic,1)
+      for(size_t ipair = 0; ipair < pair_v.size(); ++ipair) {
+	auto const& tpc   = _tpc_object_v[pair_v[ipair].first];
+	auto const& flash = _flash_v[pair_v[ipair].second];
+	auto& res = res_v[ipair];
+	auto start = high_resolution_clock::now();
+	try {
+	  res = _alg_flash_match->Match( tpc, flash ); // Run matching
+	}
+	catch(...) {
+	  error_v[ipair] = std::current_exception();
+	}
+	auto end = high_resolution_clock::now();
+	auto duration = duration_cast<nanoseconds>(end - start);
+
+	// Assign TPC & flash index info
+	res.tpc_id   = pair_v[ipair].first;
+	res.flash_id = pair_v[ipair].second;
+	res.duration = duration.count();
+	busy_v[thread_id] += duration.count();
+      }
+    }
+    auto wall_end = high_resolution_clock::now();
+
+    for(auto const& error : error_v)
+      if(error) std::rethrow_exception(error);
+
+    double wall = duration_cast<nanoseconds>(wall_end - wall_start).count();
+    _thread_utilization_v.resize(num_threads,0.);
+    for(size_t thread_id = 0; thread_id < busy_v.size(); ++thread_id) {
+      if(wall > 0.) _thread_utilization_v[thread_id] = busy_v[thread_id] / wall;
+      FLASH_INFO() << "Thread " << thread_id << " utilization " << _thread_utilization_v[thread_id] * 100.
+		   << " % (busy " << busy_v[thread_id] << " / " << wall << " ns)" << std::endl;
+    }
+    FLASH_INFO() << "Evaluated " << pair_v.size() << " pairs with " << num_threads
+		 << " thread(s) in " << wall << " ns" << std::endl;
+  }
+
   void FlashMatchManager::PrintConfig() {
 
     std::cout << "---- FLASH MATCH MANAGER PRINTING CONFIG     ----" << std::endl
 	      << "_allow_reuse_flash = " << _allow_reuse_flash << std::endl
+	      << "_num_threads = " << _num_threads << std::endl
 	      << "_name = " << _name << std::endl
 	      << "_alg_flash_filter?" << std::endl;
     if (_alg_flash_filter)
@@ -22,6 +22,7 @@
 #include "BaseProhibitAlgo.h"
 #include "BaseFlashMatch.h"
 #include "BaseFlashHypothesis.h"
+#include "HypothesisStore.h"
 namespace flashmatch {
   /**
      \class FlashMatchManager
@@ -65,13 +66,17 @@ namespace flashmatch {
        0) TPC filter algorithm if provided (optional)   \n
        1) Flash filter algorithm if provided (optional) \n
        3) Flash matching algorithm (required)           \n
-       4) Returns match information for created TPC object & flash pair which respects the outcome of 3)
+       4) Returns match information for created TPC object & flash pair which respects the outcome of 3) \n
+       \n
+       Candidate pairs in 3) are evaluated by NumThreads threads if the matching algorithm is \n
+       thread-safe. Results are merged in the serial loop order, so the outcome does not depend \n
+       on the number of threads.
      */
     std::vector<flashmatch::FlashMatch_t> Match();
 
     /// Clears locally kept TPC object (QClusterArray_t) and flash (FlashArray_t), both provided by a user
     void Reset()
-    { _tpc_object_v.clear(); _flash_v.clear(); }
+    { _tpc_object_v.clear(); _flash_v.clear(); _hypothesis_store.Clear(); }
 
     /// Configuration option: true => allows an assignment of the same flash to multiple TPC objects
     void CanReuseFlash(bool ok=true)
@@ -85,6 +90,15 @@ namespace flashmatch {
     /// Access to an input: PMT objects in the form of FlashArray_t
     const FlashArray_t& FlashArray() const { return _flash_v; }
 
+    /// Number of threads used to evaluate candidate pairs (0 = OpenMP default)
+    size_t NumThreads() const { return _num_threads; }
+
+    /// Fraction of the last matching stage wall-clock time each thread spent in the matching algorithm
+    const std::vector<double>& ThreadUtilization() const { return _thread_utilization_v; }
+
+    /// Event-scoped hypothesis store shared by all flashes (cleared on Reset)
+    const HypothesisStore& GetHypothesisStore() const { return _hypothesis_store; }
+
     /// Access to a full results (if configured to store) for [tpc][flash] indexing
     const std::vector<std::vector<flashmatch::FlashMatch_t> > FullResultTPCFlash() const
     { return _res_tpc_flash_v; }
@@ -97,6 +111,10 @@ namespace flashmatch {
 
     void AddCustomAlgo(BaseAlgorithm* alg);
 
+    /// Runs the matching algorithm on a list of (tpc,flash) pairs, possibly in parallel
+    void MatchPairs(const std::vector<std::pair<ID_t,ID_t> >& pair_v,
+		    std::vector<flashmatch::FlashMatch_t>& res_v);
+
     BaseFlashFilter*     _alg_flash_filter;     ///< Flash filter algorithm
     BaseTPCFilter*       _alg_tpc_filter;       ///< TPC filter algorithm
     BaseProhibitAlgo*    _alg_match_prohibit;   ///< Flash matchinig prohibit algorithm
@@ -126,6 +144,12 @@ namespace flashmatch {
     std::vector<std::vector<flashmatch::FlashMatch_t> > _res_tpc_flash_v;
     /// Full result container indexed by [flash][tpc]
     std::vector<std::vector<flashmatch::FlashMatch_t> > _res_flash_tpc_v;    
+    /// Number of threads for the matching stage (0 = OpenMP default)
+    size_t _num_threads;
+    /// Per-thread busy time / wall-clock time of the last matching stage
+    std::vector<double> _thread_utilization_v;
+    /// Cluster hypotheses keyed by (cluster id, x-offset key), shared by all flashes of an event
+    HypothesisStore _hypothesis_store;
   };
 }
 
@@ -0,0 +1,74 @@
+#ifndef OPT0FINDER_HYPOTHESISCACHE_CXX
+#define OPT0FINDER_HYPOTHESISCACHE_CXX
+
+#include "HypothesisCache.h"
+#include "OpT0FinderException.h"
+#include <iterator>
+
+namespace flashmatch {
+
+  HypothesisCache::HypothesisCache(size_t capacity)
+    : _capacity(0)
+    , _num_hits(0)
+    , _num_misses(0)
+    , _num_evictions(0)
+  { Configure(capacity); }
+
+  void HypothesisCache::Configure(size_t capacity)
+  {
+    _capacity = capacity;
+    _lru_v.clear();
+    _index.clear();
+  }
+
+  void HypothesisCache::Clear()
+  {
+    _lru_v.clear();
+    _index.clear();
+  }
+
+  void HypothesisCache::ResetStats()
+  { _num_hits = _num_misses = _num_evictions = 0; }
+
+  const std::vector<double>* HypothesisCache::Find(const long key)
+  {
+    auto iter = _index.find(key);
+    if(iter == _index.end()) {
+      ++_num_misses;
+      return nullptr;
+    }
+    ++_num_hits;
+    // Move to the front (most recently used)
+    _lru_v.splice(_lru_v.begin(), _lru_v, (*iter).second);
+    return &((*(*iter).second).second);
+  }
+
+  const std::vector<double>& HypothesisCache::Insert(const long key, const std::vector<double>& pe_v)
+  {
+    if(!_capacity)
+      throw OpT0FinderException("HypothesisCache::Insert called on a disabled cache!");
+
+    auto iter = _index.find(key);
+    if(iter != _index.end()) {
+      _lru_v.splice(_lru_v.begin(), _lru_v, (*iter).second);
+      (*(*iter).second).second = pe_v;
+      return (*(*iter).second).second;
+    }
+
+    if(_index.size() < _capacity)
+      _lru_v.emplace_front(key, pe_v);
+    else {
+      // Recycle the least recently used entry (no new allocation)
+      auto last = std::prev(_lru_v.end());
+      _index.erase((*last).first);
+      _lru_v.splice(_lru_v.begin(), _lru_v, last);
+      _lru_v.front().first  = key;
+      _lru_v.front().second = pe_v;
+      ++_num_evictions;
+    }
+    _index[key] = _lru_v.begin();
+    return _lru_v.front().second;
+  }
+
+}
+#endif
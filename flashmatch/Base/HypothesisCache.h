@@ -0,0 +1,83 @@
+/**
+ * \file HypothesisCache.h
+ *
+ * \ingroup Base
+ *
+ * \brief Class def header for a class HypothesisCache
+ *
+ * @author kazuhiro
+ */
+
+/** \addtogroup Base
+
+    @{*/
+#ifndef OPT0FINDER_HYPOTHESISCACHE_H
+#define OPT0FINDER_HYPOTHESISCACHE_H
+
+#include <vector>
+#include <list>
+#include <map>
+#include "OpT0FinderTypes.h"
+
+namespace flashmatch {
+  /**
+     \class HypothesisCache
+     Size-bounded cache of flash hypotheses (PE per photo-detector) of one cluster keyed by \n
+     the x-offset key of the hypothesis algorithm (see BaseFlashHypothesis::ShiftKey): \n
+     offsets with the same key have identical hypotheses, so a cached value is the one that \n
+     would be computed at the requested offset. When the cache is full the least recently \n
+     used entry is evicted and its buffer is recycled for the new entry.
+  */
+  class HypothesisCache {
+
+  public:
+
+    /// Default constructor (capacity 0 = disabled)
+    HypothesisCache(size_t capacity=0);
+
+    /// Default destructor
+    ~HypothesisCache(){}
+
+    /// Set capacity, then clear the content
+    void Configure(size_t capacity);
+
+    /// Drop all cached hypotheses (statistics are kept)
+    void Clear();
+
+    /// Reset hit/miss/eviction counters
+    void ResetStats();
+
+    /// True if the cache can hold at least one entry
+    inline bool Enabled() const { return _capacity > 0; }
+
+    /// Returns a cached hypothesis or nullptr (updates hit/miss counters)
+    const std::vector<double>* Find(const long key);
+
+    /// Stores a hypothesis for a key (evicts the least recently used entry if full)
+    const std::vector<double>& Insert(const long key, const std::vector<double>& pe_v);
+
+    /// Maximum number of entries
+    inline size_t Capacity() const { return _capacity; }
+    /// Current number of entries
+    inline size_t Size() const { return _index.size(); }
+    /// Number of successful look-ups
+    inline size_t NumHits() const { return _num_hits; }
+    /// Number of failed look-ups
+    inline size_t NumMisses() const { return _num_misses; }
+    /// Number of evicted entries
+    inline size_t NumEvictions() const { return _num_evictions; }
+
+  private:
+
+    typedef std::pair<long, std::vector<double> > Entry_t;
+
+    size_t _capacity; ///< Maximum number of entries
+    std::list<Entry_t> _lru_v; //!< Entries ordered from most to least recently used
+    std::map<long, std::list<Entry_t>::iterator> _index; //!< key => entry look-up
+    size_t _num_hits;
+    size_t _num_misses;
+    size_t _num_evictions;
+  };
+}
+#endif
+/** @} */ // end of doxygen group
@@ -0,0 +1,83 @@
+#ifndef OPT0FINDER_HYPOTHESISSTORE_CXX
+#define OPT0FINDER_HYPOTHESISSTORE_CXX
+
+#include "HypothesisStore.h"
+#include "OpT0FinderException.h"
+
+namespace flashmatch {
+
+  HypothesisStore::HypothesisStore()
+    : _capacity(0)
+  {}
+
+  void HypothesisStore::Configure(size_t capacity)
+  {
+    _capacity = capacity;
+    Clear();
+  }
+
+  void HypothesisStore::Clear()
+  {
+    _cluster_v.clear();
+    _cluster_m.clear();
+    _cache_v.clear();
+    _mutex_v.clear();
+  }
+
+  void HypothesisStore::Register(const QClusterArray_t& cluster_v)
+  {
+    bool same = (cluster_v.size() == _cluster_v.size());
+    for(size_t i=0; same && i<cluster_v.size(); ++i)
+      same = (&(cluster_v[i]) == _cluster_v[i]);
+    if(same) return;
+
+    Clear();
+    if(!Enabled()) return;
+    // Reserve: a HypothesisCache must not be copied once it holds entries
+    _cache_v.reserve(cluster_v.size());
+    for(size_t i=0; i<cluster_v.size(); ++i) {
+      _cluster_v.push_back(&(cluster_v[i]));
+      _cluster_m[&(cluster_v[i])] = i;
+      _cache_v.emplace_back(_capacity);
+      _mutex_v.emplace_back(new std::mutex);
+    }
+  }
+
+  ID_t HypothesisStore::ClusterID(const QCluster_t& cluster) const
+  {
+    auto iter = _cluster_m.find(&cluster);
+    if(iter == _cluster_m.end()) return kINVALID_ID;
+    return (*iter).second;
+  }
+
+  bool HypothesisStore::Find(const ID_t cluster_id, const long key, std::vector<double>& pe_v)
+  {
+    std::lock_guard<std::mutex> lock(*(_mutex_v.at(cluster_id)));
+    auto ptr = _cache_v[cluster_id].Find(key);
+    if(!ptr) return false;
+    pe_v = *ptr;
+    return true;
+  }
+
+  void HypothesisStore::Insert(const ID_t cluster_id, const long key, const std::vector<double>& pe_v)
+  {
+    std::lock_guard<std::mutex> lock(*(_mutex_v.at(cluster_id)));
+    _cache_v[cluster_id].Insert(key, pe_v);
+  }
+
+  size_t HypothesisStore::NumHits() const
+  {
+    size_t res = 0;
+    for(auto const& cache : _cache_v) res += cache.NumHits();
+    return res;
+  }
+
+  size_t HypothesisStore::NumMisses() const
+  {
+    size_t res = 0;
+    for(auto const& cache : _cache_v) res += cache.NumMisses();
+    return res;
+  }
+
+}
+#endif
@@ -0,0 +1,84 @@
+/**
+ * \file HypothesisStore.h
+ *
+ * \ingroup Base
+ *
+ * \brief Class def header for a class HypothesisStore
+ *
+ * @author kazuhiro
+ */
+
+/** \addtogroup Base
+
+    @{*/
+#ifndef OPT0FINDER_HYPOTHESISSTORE_H
+#define OPT0FINDER_HYPOTHESISSTORE_H
+
+#include <vector>
+#include <map>
+#include <mutex>
+#include <memory>
+#include "OpT0FinderTypes.h"
+#include "HypothesisCache.h"
+
+namespace flashmatch {
+  /**
+     \class HypothesisStore
+     Event-scoped store of flash hypotheses owned by flashmatch::FlashMatchManager and shared \n
+     by all flashes of an event. An entry is keyed by (cluster id, x-offset key) where the key \n
+     (see BaseFlashHypothesis::ShiftKey) is computed for the offset of the cluster's minimum-x \n
+     point, i.e. the hypothesis does not depend on the flash. \n
+     Each cluster has its own size-bounded flashmatch::HypothesisCache and mutex, so the store \n
+     can be used by several matching threads at once.
+  */
+  class HypothesisStore {
+
+  public:
+
+    /// Default constructor (capacity 0 = disabled)
+    HypothesisStore();
+
+    /// Default destructor
+    ~HypothesisStore(){}
+
+    /// Set per-cluster capacity, then clear the content
+    void Configure(size_t capacity);
+
+    /// Drop all registered clusters and their hypotheses
+    void Clear();
+
+    /// Register the clusters of an event (content is kept if the same clusters are registered)
+    void Register(const QClusterArray_t& cluster_v);
+
+    /// True if hypotheses are stored
+    inline bool Enabled() const { return _capacity > 0; }
+
+    /// Cluster id of a registered cluster (kINVALID_ID if not registered)
+    ID_t ClusterID(const QCluster_t& cluster) const;
+
+    /// Copies a stored hypothesis into pe_v and returns true if found
+    bool Find(const ID_t cluster_id, const long key, std::vector<double>& pe_v);
+
+    /// Stores a hypothesis
+    void Insert(const ID_t cluster_id, const long key, const std::vector<double>& pe_v);
+
+    /// Maximum number of entries per cluster
+    inline size_t Capacity() const { return _capacity; }
+    /// Number of registered clusters
+    inline size_t NumClusters() const { return _cache_v.size(); }
+    /// Number of successful look-ups (all clusters)
+    size_t NumHits() const;
+    /// Number of failed look-ups (all clusters)
+    size_t NumMisses() const;
+
+  private:
+
+    size_t _capacity; ///< Maximum number of entries per cluster
+    std::vector<const QCluster_t*> _cluster_v; //!< Registered clusters
+    std::map<const QCluster_t*, ID_t> _cluster_m; //!< Cluster address => cluster id
+    std::vector<HypothesisCache> _cache_v; //!< Per-cluster hypotheses
+    std::vector<std::unique_ptr<std::mutex> > _mutex_v; //!< Per-cluster locks
+  };
+}
+#endif
+/** @} */ // end of doxygen group